@@ -15,9 +15,9 @@
 
 import os
 import sys
+import time
 import argparse
 import logging
-import yaml
 
 __version__ = (0, 3, 1)
 __version_string__ = ".".join(map(str, __version__))
@@ -27,9 +27,45 @@ from vdisk.actions.create import action as action_create
 from vdisk.actions.bootstrap import action as action_bootstrap
 from vdisk.actions.enter import action as action_enter
 from vdisk.actions.puppet import action as action_puppet
+from vdisk.actions.delta import action as action_delta
+from vdisk.actions.apply import action as action_apply
+from vdisk.actions.info import action as action_info
+from vdisk.actions.verify import action as action_verify
+from vdisk.actions.variants import action as action_variants
+from vdisk.actions.stats import action as action_stats
+from vdisk.actions.resize import action as action_resize
+from vdisk.actions.benchmark import action as action_benchmark
+from vdisk.actions.snapshot import action as action_snapshot
+from vdisk.actions.store import action as action_store
+from vdisk.actions.finalize import action as action_finalize
+
+from vdisk.preset.ec2_preset import EC2Preset
+from vdisk.preset.generic_preset import GenericPreset
+from vdisk.preset.compressed_preset import SquashfsPreset
+from vdisk.preset.compressed_preset import ErofsPreset
+
+from vdisk.config import read_config
+from vdisk.events import EventStream
+from vdisk.events import open_stream
+from vdisk.native_bootstrap import DEFAULT_KEYRING
+from vdisk.stages import add_listener
+from vdisk.stages import notify
+from vdisk.stages import remove_listener
+from vdisk.stages import stage
+from vdisk.snapshots import rollback_on_failure
+from vdisk.sampler import ResourceSampler
+from vdisk.stats import StatsRecorder
+from vdisk.stats import stats_path
 
 log = logging.getLogger(__name__)
 
+PRESETS = {
+    "generic": GenericPreset,
+    "ec2": EC2Preset,
+    "squashfs": SquashfsPreset,
+    "erofs": ErofsPreset,
+}
+
 
 class sizeunit(object):
     units = {
@@ -64,14 +100,6 @@ class sizeunit(object):
         return int(string), self.DEFAULT_UNIT
 
 
-def read_config(path):
-    if not os.path.isfile(path):
-        raise Exception("Missing configuration: {0}".format(path))
-
-    with open(path) as f:
-        return yaml.load(f)
-
-
 def setup_argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--version", action="version",
@@ -92,6 +120,27 @@ def setup_argument_parser():
                         help=("Create an ec2-compatible image for pv-grub/hd00 AKI"),
                         default=False)
 
+    parser.add_argument("-P", "--preset",
+                        metavar="<name>",
+                        help=("Image layout, one of: {0}. "
+                              "Default: generic").format(
+                                  ", ".join(sorted(PRESETS))),
+                        choices=sorted(PRESETS),
+                        default="generic")
+
+    parser.add_argument("--compressor",
+                        metavar="<name>",
+                        help=("Compressor of read-only roots, default: xz "
+                              "for squashfs, lz4hc for erofs"),
+                        default=None)
+
+    parser.add_argument("--compression-jobs",
+                        metavar="<count>",
+                        help=("Threads compressing read-only roots, "
+                              "default: one per cpu"),
+                        default=None,
+                        type=int)
+
     parser.add_argument("-V", "--volume-group",
                         metavar="<name>",
                         help="Name of volume group, default: VolGroup00",
@@ -104,11 +153,62 @@ def setup_argument_parser():
                         default=sizeunit('7G'),
                         type=sizeunit)
 
+    parser.add_argument("--thin",
+                        help=("Create root in a thin pool, with a snapshot "
+                              "taken before every bootstrap, install and "
+                              "puppet run, see the 'snapshot' action"),
+                        default=False,
+                        action="store_true")
+
+    parser.add_argument("--no-rollback",
+                        help=("Keep the state of failed actions on images "
+                              "with a thin layout instead of restoring the "
+                              "snapshot taken before them"),
+                        default=False,
+                        action="store_true")
+
     parser.add_argument("-m", "--mountpoint",
                         metavar="<dir>",
                         help="Mount point for disk images, default: tmp/mount",
                         default="tmp/mount")
 
+    parser.add_argument("--session-dir",
+                        metavar="<dir>",
+                        help=("Directory of read-only sessions, default: "
+                              "tmp/sessions"),
+                        default="tmp/sessions")
+
+    parser.add_argument("-C", "--cache-dir",
+                        metavar="<dir>",
+                        help=("Directory for caches shared between builds, "
+                              "default: tmp/cache"),
+                        default="tmp/cache")
+
+    parser.add_argument("--no-stats",
+                        help=("Do not record stage and command durations in "
+                              "the statistics database of the cache "
+                              "directory"),
+                        default=False,
+                        action="store_true")
+
+    parser.add_argument("--events",
+                        metavar="<target>",
+                        help=("Write progress events as JSON lines to "
+                              "'fd:<number>', 'unix:<socket path>' or a file"),
+                        default=None)
+
+    parser.add_argument("--sample-resources",
+                        help=("Sample disk, cpu and memory usage in the "
+                              "background and summarize it per stage"),
+                        default=False,
+                        action="store_true")
+
+    parser.add_argument("--sample-interval",
+                        metavar="<seconds>",
+                        help="Seconds between resource samples, default: 1",
+                        default=1.0,
+                        type=float)
+
     parser.add_argument("-S", "--shell",
                         metavar="<bin>",
                         help="Shell to use in chroot, default: /bin/sh",
@@ -144,7 +244,7 @@ def setup_argument_parser():
                         metavar="<image>",
                         help="Path to image")
 
-    actions = parser.add_subparsers()
+    actions = parser.add_subparsers(dest="action_name")
 
     create = actions.add_parser("create",
                                 help="Create a new disk image")
@@ -160,6 +260,44 @@ def setup_argument_parser():
                         default=False,
                         action="store_true")
 
+    create.add_argument("--minimal-allocation",
+                        help=("Write as few blocks of the image as possible, "
+                              "with lazily initialized filesystems and "
+                              "volumes which are not zeroed"),
+                        default=False,
+                        action="store_true")
+
+    create.add_argument("--auto-size",
+                        help=("Size the image and root to fit the packages "
+                              "of the bootstrap, configuration and "
+                              "selections, and the files of the manifest, "
+                              "instead of using '--size' and '--root-size'"),
+                        default=False,
+                        action="store_true")
+
+    create.add_argument("--headroom",
+                        metavar="<percent>",
+                        help=("Free space on root with '--auto-size', "
+                              "default: 25"),
+                        default=25.0,
+                        type=float)
+
+    create.add_argument("--selections",
+                        metavar="<file>",
+                        help=("Selections counted by '--auto-size', default: "
+                              "selections/default"),
+                        default=None)
+
+    create.add_argument("-S", "--suite", default="squeeze",
+                        metavar="<suite>",
+                        help=("Suite counted by '--auto-size', default: "
+                              "squeeze"))
+
+    create.add_argument("-A", "--arch", default="amd64",
+                        metavar="<arch>",
+                        help=("Architecture counted by '--auto-size', "
+                              "default: amd64"))
+
     create.set_defaults(action=action_create)
 
     bootstrap = actions.add_parser("bootstrap",
@@ -172,7 +310,40 @@ def setup_argument_parser():
     bootstrap.add_argument("-A", "--arch", default="amd64",
                            help="Installation architecture, default: amd64")
 
-    bootstrap.set_defaults(action=action_bootstrap)
+    bootstrap.add_argument("-E", "--engine", default="debootstrap",
+                           choices=["debootstrap", "native"],
+                           help=("Bootstrap engine, native resolves, fetches "
+                                 "and extracts packages in parallel. "
+                                 "Default: debootstrap"))
+
+    bootstrap.add_argument("-j", "--jobs",
+                           help=("Concurrent downloads and extractions of "
+                                 "the native engine, default: one per cpu"),
+                           metavar="<count>",
+                           default=None,
+                           type=int)
+
+    bootstrap.add_argument("--keyring",
+                           help=("Keyring verifying the Release file of the "
+                                 "mirror with the native engine, default: "
+                                 "{0}").format(DEFAULT_KEYRING),
+                           metavar="<file>",
+                           default=DEFAULT_KEYRING)
+
+    bootstrap.add_argument("--no-verify",
+                           help=("Do not verify the mirror with the native "
+                                 "engine, for unsigned local repositories"),
+                           default=False,
+                           action="store_true")
+
+    bootstrap.add_argument("--keep-archives",
+                           help=("Keep the packages downloaded by the native "
+                                 "engine in the archives of the image, for "
+                                 "'install --download --repository'"),
+                           default=False,
+                           action="store_true")
+
+    bootstrap.set_defaults(action=action_bootstrap, mutates=True)
 
     install = actions.add_parser("install",
                                  help=("Install packages and selections into "
@@ -188,12 +359,48 @@ def setup_argument_parser():
                          default=False,
                          action="store_true")
 
-    install.set_defaults(action=action_install)
+    install.add_argument("-R", "--repository",
+                         help=("Local flat repository, populated with the "
+                               "downloaded packages when used with "
+                               "'--download', otherwise used as the only "
+                               "package source during installation."),
+                         metavar="<dir>",
+                         default=None)
+
+    install.add_argument("-T", "--defer-triggers",
+                         help=("Defer dpkg triggers and initramfs updates "
+                               "until all packages are installed, running "
+                               "each of them once."),
+                         default=False,
+                         action="store_true")
+
+    install.add_argument("--shrink-to-fit",
+                         help=("Shrink root and the image to fit their "
+                               "contents once installed, like "
+                               "'resize --shrink'."),
+                         default=False,
+                         action="store_true")
+
+    install.add_argument("-r", "--resume",
+                         help=("Skip the steps completed by an earlier run "
+                               "with unchanged inputs, and continue from the "
+                               "first step which failed or changed."),
+                         default=False,
+                         action="store_true")
+
+    install.set_defaults(action=action_install, mutates=True)
 
     enter = actions.add_parser("enter",
                                help="Open a shell into a disk image")
 
-    enter.set_defaults(action=action_enter)
+    enter.add_argument("-r", "--read-only",
+                       help=("Enter the image in a read-only session, which "
+                             "can run alongside other read-only sessions of "
+                             "the image; changes are discarded when it ends"),
+                       default=False,
+                       action="store_true")
+
+    enter.set_defaults(action=action_enter, record_stats=False)
 
     puppet = actions.add_parser("puppet",
                                 help="Run puppet inside a disk image")
@@ -206,40 +413,499 @@ def setup_argument_parser():
                         metavar="<name>=<value>",
                         help="Override puppet facts")
 
+    puppet.add_argument("--top",
+                        metavar="<count>",
+                        help=("Number of slowest resources and classes to "
+                              "report, default: 10"),
+                        default=10,
+                        type=int)
+
+    puppet.add_argument("--catalog-cache",
+                        help=("Cache the compiled catalog, keyed by the "
+                              "module tree, facts and arguments, and skip "
+                              "compilation when they are unchanged"),
+                        default=False,
+                        action="store_true")
+
+    puppet.add_argument("-r", "--read-only",
+                        help=("Run puppet in a read-only session, its changes "
+                              "are discarded afterwards, see enter "
+                              "'--read-only'"),
+                        default=False,
+                        action="store_true")
+
     puppet.add_argument("puppetargs",
                         metavar="<puppet-args...>",
                         help="Arguments passed into puppet",
                         nargs=argparse.REMAINDER)
 
-    puppet.set_defaults(action=action_puppet)
+    puppet.set_defaults(action=action_puppet, mutates=True)
+
+    delta = actions.add_parser("delta",
+                               help=("Write a block-level delta from an "
+                                     "older image to this one"))
+
+    delta.add_argument("old_image",
+                       metavar="<old-image>",
+                       help="Path to the image the delta is based on")
+
+    delta.add_argument("patch",
+                       metavar="<patch>",
+                       help="Path to write the delta to")
+
+    delta.add_argument("-b", "--block-size",
+                       help="Size of compared blocks, default: 64K",
+                       metavar="<size>",
+                       default=sizeunit("64K"),
+                       type=sizeunit)
+
+    delta.add_argument("-z", "--compression",
+                       help="zlib compression level of changed blocks, "
+                            "default: 6",
+                       metavar="<level>",
+                       default=6,
+                       type=int)
+
+    delta.add_argument("-j", "--jobs",
+                       help="Number of hashing processes, default: one per cpu",
+                       metavar="<count>",
+                       default=None,
+                       type=int)
+
+    delta.add_argument("-f", "--force",
+                       help="Overwrite the delta if it exists",
+                       default=False,
+                       action="store_true")
+
+    delta.set_defaults(action=action_delta, requires_root=False)
+
+    apply = actions.add_parser("apply",
+                               help=("Reconstruct this image from an older "
+                                     "image and a delta"))
+
+    apply.add_argument("old_image",
+                       metavar="<old-image>",
+                       help="Path to the image the delta is based on")
+
+    apply.add_argument("patch",
+                       metavar="<patch>",
+                       help="Path to the delta")
+
+    apply.add_argument("-j", "--jobs",
+                       help="Number of hashing processes, default: one per cpu",
+                       metavar="<count>",
+                       default=None,
+                       type=int)
+
+    apply.add_argument("-f", "--force",
+                       help="Overwrite the image if it exists",
+                       default=False,
+                       action="store_true")
+
+    apply.set_defaults(action=action_apply, requires_root=False)
+
+    info = actions.add_parser("info",
+                              help=("Describe a disk image without "
+                                    "mounting it"))
+
+    info.add_argument("-Y", "--yaml",
+                      help="Print the description as yaml",
+                      default=False,
+                      action="store_true")
+
+    info.add_argument("--no-system",
+                      help=("Do not read release and package information "
+                            "from the root filesystem"),
+                      default=False,
+                      action="store_true")
+
+    info.set_defaults(action=action_info, requires_root=False)
+
+    verify = actions.add_parser("verify",
+                                help=("Verify installed files against dpkg "
+                                      "and manifest checksums"))
+
+    verify.add_argument("-j", "--jobs",
+                        help="Number of hashing processes, default: one per cpu",
+                        metavar="<count>",
+                        default=None,
+                        type=int)
+
+    verify.add_argument("-r", "--read-only",
+                        help=("Verify in a read-only session, see enter "
+                              "'--read-only'"),
+                        default=False,
+                        action="store_true")
+
+    verify.set_defaults(action=action_verify)
+
+    variants = actions.add_parser("variants",
+                                  help=("Build variant images on top of a "
+                                        "shared base image"))
+
+    variants.add_argument("names",
+                          metavar="<variant>",
+                          nargs="*",
+                          help="Variants to build, default: all")
+
+    variants.add_argument("-o", "--output",
+                          metavar="<dir>",
+                          help=("Directory to write variant images to, "
+                                "default: directory of the base image"),
+                          default=None)
+
+    variants.add_argument("-w", "--work-dir",
+                          metavar="<dir>",
+                          help=("Directory for overlays of each variant, "
+                                "default: tmp/variants"),
+                          default="tmp/variants")
+
+    variants.add_argument("-V", "--variant-volume-group",
+                          metavar="<name>",
+                          help=("Name of volume group in variant images, "
+                                "default: VolGroup00"),
+                          default="VolGroup00")
+
+    variants.add_argument("-j", "--jobs",
+                          help=("Number of variants installed concurrently, "
+                                "default: one per cpu"),
+                          metavar="<count>",
+                          default=None,
+                          type=int)
+
+    variants.add_argument("--skip-base",
+                          help="The base system is already configured",
+                          default=False,
+                          action="store_true")
+
+    variants.add_argument("-f", "--force",
+                          help="Overwrite existing variant images",
+                          default=False,
+                          action="store_true")
+
+    variants.add_argument("--finalize",
+                          help=("Finalize every variant image, like the "
+                                "'finalize' action"),
+                          default=False,
+                          action="store_true")
+
+    variants.set_defaults(action=action_variants)
+
+    finalize = actions.add_parser("finalize",
+                                  help=("Replace root with a read-only "
+                                        "compressed image of itself, with "
+                                        "the squashfs and erofs presets"))
+
+    finalize.set_defaults(action=action_finalize)
+
+    resize = actions.add_parser("resize",
+                                help=("Grow or shrink a disk image in "
+                                      "place"))
+
+    resize.add_argument("-s", "--size",
+                        help=("New size of the image, the root volume "
+                              "grows into the added space unless "
+                              "'--root-volume' is given"),
+                        metavar="<size>",
+                        default=None,
+                        type=sizeunit)
+
+    resize.add_argument("--root-volume", dest="new_root_size",
+                        help=("New size of the root volume, swap takes "
+                              "what is left of the volume group"),
+                        metavar="<size>",
+                        default=None,
+                        type=sizeunit)
+
+    resize.add_argument("--shrink",
+                        help=("Shrink the root volume to fit its data, and "
+                              "the image to fit the volumes"),
+                        default=False,
+                        action="store_true")
+
+    resize.set_defaults(action=action_resize)
+
+    stats = actions.add_parser("stats",
+                               help=("Show build durations, regressions and "
+                                     "estimates for running builds"))
+
+    stats.add_argument("-n", "--builds",
+                       metavar="<count>",
+                       help="Number of builds to show, default: 10",
+                       default=10,
+                       type=int)
+
+    stats.add_argument("-w", "--window",
+                       metavar="<count>",
+                       help=("Number of earlier runs in the baseline of a "
+                             "stage, default: 5"),
+                       default=5,
+                       type=int)
+
+    stats.add_argument("-t", "--threshold",
+                       metavar="<percent>",
+                       help=("Flag stages slower than their baseline by "
+                             "more than this, default: 20"),
+                       default=20.0,
+                       type=float)
+
+    stats.add_argument("--minimum",
+                       metavar="<seconds>",
+                       help=("Ignore stages less than this much slower than "
+                             "their baseline, default: 5"),
+                       default=5.0,
+                       type=float)
+
+    stats.add_argument("-a", "--all-images",
+                       help="Show builds of all images",
+                       default=False,
+                       action="store_true")
+
+    stats.add_argument("--fail-on-regression",
+                       help="Exit with a non-zero status on regressions",
+                       default=False,
+                       action="store_true")
+
+    stats.set_defaults(action=action_stats, requires_root=False,
+                       record_stats=False)
+
+    benchmark = actions.add_parser("benchmark",
+                                   help=("Build a reference image from a "
+                                         "local repository and measure it"))
+
+    benchmark.add_argument("fixture",
+                           metavar="<dir>",
+                           help=("Flat repository with all packages of the "
+                                 "image, like written by 'install "
+                                 "--download'"))
+
+    benchmark.add_argument("selections",
+                           metavar="<selections>",
+                           nargs="?",
+                           help=("Package selections to install, default: "
+                                 "selections/default"),
+                           default=None)
+
+    benchmark.add_argument("-s", "--size",
+                           metavar="<size>",
+                           help="Size of the image, default: 8G",
+                           default=sizeunit("8G"),
+                           type=sizeunit)
+
+    benchmark.add_argument("-S", "--suite", default="squeeze",
+                           metavar="<suite>",
+                           help="Suite to bootstrap, default: squeeze")
+
+    benchmark.add_argument("-A", "--arch", default="amd64",
+                           metavar="<arch>",
+                           help="Architecture to bootstrap, default: amd64")
+
+    benchmark.add_argument("-j", "--jobs",
+                           metavar="<count>",
+                           help=("Concurrent downloads and extractions of "
+                                 "the bootstrap, default: one per cpu"),
+                           default=None,
+                           type=int)
+
+    benchmark.add_argument("-T", "--defer-triggers",
+                           help="Defer dpkg triggers while installing",
+                           default=False,
+                           action="store_true")
+
+    benchmark.add_argument("-n", "--runs",
+                           metavar="<count>",
+                           help=("Number of builds, measurements are the "
+                                 "median of all of them, default: 1"),
+                           default=1,
+                           type=int)
+
+    benchmark.add_argument("--http",
+                           help=("Serve the repository over HTTP on localhost "
+                                 "instead of reading it through file://"),
+                           default=False,
+                           action="store_true")
+
+    benchmark.add_argument("--warm-cache",
+                           help=("Use the cache directory instead of an empty "
+                                 "one for every run"),
+                           default=False,
+                           action="store_true")
+
+    benchmark.add_argument("-b", "--baseline",
+                           metavar="<file>",
+                           help="Compare with the results in this file",
+                           default=None)
+
+    benchmark.add_argument("-o", "--save-baseline",
+                           metavar="<file>",
+                           help="Write the results to this file",
+                           default=None)
+
+    benchmark.add_argument("-t", "--threshold",
+                           metavar="<percent>",
+                           help=("Flag measurements higher than the baseline "
+                                 "by more than this, default: 10"),
+                           default=10.0,
+                           type=float)
+
+    benchmark.set_defaults(action=action_benchmark, record_stats=False)
+
+    snapshot = actions.add_parser("snapshot",
+                                  help=("Manage snapshots of images with a "
+                                        "thin layout"))
+
+    snapshot.add_argument("command",
+                          choices=["list", "create", "restore", "drop",
+                                   "flatten"],
+                          help=("List, create, restore or drop snapshots of "
+                                "root, or flatten the image into the regular "
+                                "layout, dropping all snapshots"))
+
+    snapshot.add_argument("name",
+                          metavar="<name>",
+                          nargs="?",
+                          help="Name of the snapshot",
+                          default=None)
+
+    snapshot.set_defaults(action=action_snapshot)
+
+    store = actions.add_parser("store",
+                               help=("Push images to, or pull them from, a "
+                                     "store of chunks shared by all images"))
+
+    store.add_argument("command",
+                       choices=["push", "pull", "list", "drop"],
+                       help=("Push or pull the image, list the images in "
+                             "the store, or drop an image and the chunks "
+                             "only it uses"))
+
+    store.add_argument("-s", "--store",
+                       metavar="<dir>",
+                       help="Directory of the store, default: tmp/store",
+                       default="tmp/store")
+
+    store.add_argument("-n", "--name",
+                       metavar="<name>",
+                       help=("Name of the image in the store, default: the "
+                             "file name of the image"),
+                       default=None)
+
+    store.add_argument("-z", "--compression",
+                       help="zlib compression level of chunks, default: 6",
+                       metavar="<level>",
+                       default=6,
+                       type=int)
+
+    store.add_argument("-j", "--jobs",
+                       help=("Number of chunking and compression processes, "
+                             "default: one per cpu"),
+                       metavar="<count>",
+                       default=None,
+                       type=int)
+
+    store.add_argument("-f", "--force",
+                       help=("Replace the image in the store when pushing, "
+                             "or the image file when pulling"),
+                       default=False,
+                       action="store_true")
+
+    store.set_defaults(action=action_store, requires_root=False)
 
     return parser
 
 
-def main(args):
-    from vdisk.preset.ec2_preset import EC2Preset
-    from vdisk.preset.generic_preset import GenericPreset
+def create_preset(ns):
+    if ns.ec2:
+        return EC2Preset(ns)
+
+    if isinstance(ns.preset, basestring):
+        return PRESETS[ns.preset](ns)
+
+    return ns.preset(ns)
+
+
+def run_action(ns, local=False):
+    """
+    Run the action of a fully prepared namespace, recording statistics,
+    sampling resources and writing events as requested by it.
+
+    With local set, only events of the current thread are observed.
+    """
+    events = None
+    recorder = None
+    sampler = None
+    started = None
+    success = False
+
+    # everything opened so far is closed if setting up the rest fails.
+    try:
+        if getattr(ns, "events", None):
+            events = EventStream(open_stream(ns.events))
+            add_listener(events, local=local)
+
+        if not ns.no_stats and getattr(ns, "record_stats", True):
+            try:
+                recorder = StatsRecorder(stats_path(ns), ns)
+            except Exception, e:
+                log.warning("Not recording build statistics: {0}".format(e))
+            else:
+                add_listener(recorder, local=local)
+
+        if ns.sample_resources:
+            sampler = ResourceSampler(ns.image_path, ns.sample_interval)
+            sampler.start()
+            add_listener(sampler, local=local)
+
+        started = time.time()
+
+        notify("action-started", action=ns.action_name, image=ns.image_path)
+
+        with stage(ns.action_name):
+            if getattr(ns, "mutates", False) and \
+                    not getattr(ns, "read_only", False):
+                with rollback_on_failure(ns):
+                    result = ns.action(ns)
+            else:
+                result = ns.action(ns)
+
+        success = result == 0
+        return result
+    finally:
+        if started is not None:
+            notify("action-finished", action=ns.action_name,
+                   image=ns.image_path, success=success,
+                   duration=time.time() - started)
+
+        if sampler is not None:
+            remove_listener(sampler, local=local)
+            sampler.stop()
+
+        if recorder is not None:
+            remove_listener(recorder, local=local)
+            recorder.finish(success)
+
+        if events is not None:
+            remove_listener(events, local=local)
+            events.close()
 
+
+def main(args):
     logging.basicConfig(level=logging.INFO)
     parser = setup_argument_parser()
     ns = parser.parse_args(args)
     logging.getLogger().setLevel(ns.log_level)
 
-    if os.getuid() != 0:
+    if getattr(ns, "requires_root", True) and os.getuid() != 0:
         log.error("vdisk uses loopback mounting, and needs to be run as root")
         return -1
 
     if ns.config is None:
         ns.config = os.path.join(ns.root, "vdisk.yaml")
 
-    ns.config = read_config(ns.config)
-
-    if ns.ec2:
-        ns.preset = EC2Preset(ns)
-    else:
-        ns.preset = GenericPreset(ns)
+    ns.config, ns.config_digest = read_config(ns.config, ns.cache_dir)
+    ns.preset = create_preset(ns)
 
-    return ns.action(ns)
+    return run_action(ns)
 
 
 def entry():
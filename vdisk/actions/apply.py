@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.actions.delta import RECORD_COPY
+from vdisk.actions.delta import read_header
+from vdisk.actions.delta import read_records
+from vdisk.blockmap import block_digests
+from vdisk.blockmap import content_digest
+
+COPY_BUFFER = 2 ** 20
+
+
+def copy_range(source, target, offset, length):
+    source.seek(offset)
+    target.seek(offset)
+
+    while length > 0:
+        data = source.read(min(length, COPY_BUFFER))
+
+        if not data:
+            raise Exception("Unexpected end of {0} at {1}".format(
+                source.name, source.tell()))
+
+        target.write(data)
+        length -= len(data)
+
+
+def verify_digest(path, block_size, expected, processes):
+    actual = content_digest(block_digests(path, block_size,
+                                          processes=processes))
+
+    if actual != expected:
+        raise Exception("Checksum mismatch for {0}: {1} != {2}".format(
+            path, actual, expected))
+
+
+def action(ns):
+    """
+    Reconstruct image_path from old_image and a delta written by 'delta'.
+    """
+    for path in (ns.old_image, ns.patch):
+        if not os.path.isfile(path):
+            raise Exception("No such file: {0}".format(path))
+
+    if not ns.force and os.path.exists(ns.image_path):
+        raise Exception("path already exists: {0}".format(ns.image_path))
+
+    with open(ns.patch, "rb") as f:
+        header = read_header(f)
+        block_size, old_size, new_size, old_digest, new_digest = header
+
+        if os.path.getsize(ns.old_image) != old_size:
+            raise Exception("Size mismatch for {0}, expected {1}".format(
+                ns.old_image, old_size))
+
+        log.info("Verifying {0}".format(ns.old_image))
+        verify_digest(ns.old_image, block_size, old_digest, ns.jobs)
+
+        log.info("Writing {0}".format(ns.image_path))
+
+        with open(ns.old_image, "rb") as old:
+            with open(ns.image_path, "wb") as new:
+                # anything not covered by a record is left as a hole.
+                new.truncate(new_size)
+
+                for kind, offset, length, data in read_records(f):
+                    if kind == RECORD_COPY:
+                        copy_range(old, new, offset, length)
+                    else:
+                        new.seek(offset)
+                        new.write(data)
+
+    log.info("Verifying {0}".format(ns.image_path))
+    verify_digest(ns.image_path, block_size, new_digest, ns.jobs)
+
+    return 0
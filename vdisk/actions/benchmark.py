@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+An end-to-end benchmark, building a reference image from a local package
+repository without any network access.
+
+The fixture is a flat repository holding every package of the image, as
+written by:
+
+    bin/vdisk foo.img create
+    bin/vdisk foo.img bootstrap --engine native --keep-archives
+    bin/vdisk foo.img install --download --repository <fixture>
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+import posixpath
+import urllib
+import SocketServer
+import SimpleHTTPServer
+
+log = logging.getLogger(__name__)
+
+from vdisk import __version_string__
+from vdisk.blockmap import allocated_size
+from vdisk.blockmap import data_extents
+from vdisk.actions.apply import copy_range
+from vdisk.sampler import ResourceSampler
+from vdisk.stages import add_listener
+from vdisk.stages import current_stage
+from vdisk.stages import remove_listener
+from vdisk.stages import stage
+from vdisk.stats import host_info
+from vdisk.stats import median
+
+# Stages faster than this are too noisy to compare against a baseline.
+MINIMUM_DURATION = 1.0
+
+
+class _FixtureHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    root = None
+
+    def translate_path(self, path):
+        path = posixpath.normpath(urllib.unquote(path.split("?", 1)[0]))
+        parts = [p for p in path.split("/") if p not in ("", ".", "..")]
+        return os.path.join(self.root, *parts)
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureServer(object):
+    """
+    Serve a directory over HTTP on localhost, in a background thread.
+    """
+    def __init__(self, root):
+        class Handler(_FixtureHandler):
+            pass
+
+        Handler.root = root
+
+        self.server = SocketServer.ThreadingTCPServer(("127.0.0.1", 0),
+                                                      Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(*self.server.server_address)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        return False
+
+
+class RunCollector(object):
+    """
+    Stage listener collecting stage durations, command counts and bytes
+    written of a single run.
+    """
+    def __init__(self):
+        parent = current_stage()
+        self.prefix = parent + "/" if parent else ""
+        self.stages = dict()
+        self.commands = dict()
+        self.written = dict()
+
+    def _name(self, stage):
+        if stage.startswith(self.prefix):
+            return stage[len(self.prefix):]
+
+        return stage
+
+    def __call__(self, event, data):
+        if event == "stage-finished":
+            self.stages[self._name(data["stage"])] = data["duration"]
+        elif event == "command-finished":
+            command = os.path.basename(data["args"][0])
+            self.commands[command] = self.commands.get(command, 0) + 1
+        elif event == "stage-resources":
+            self.written[self._name(data["stage"])] = data["write_bytes"]
+
+
+def export_image(source, target):
+    """
+    Write a sparse copy of an image, returning the number of bytes copied.
+    """
+    copied = 0
+
+    with open(source, "rb") as s:
+        with open(target, "wb") as t:
+            t.truncate(os.path.getsize(source))
+
+            for offset, length in data_extents(source):
+                copy_range(s, t, offset, length)
+                copied += length
+
+    return copied
+
+
+def run_once(ns, context, mirror, cache_dir):
+    """
+    Build the reference image once, returning its measurements.
+    """
+    export_path = "{0}.export".format(ns.image_path)
+    session = context.session(ns.image_path, mirror=mirror,
+                              cache_dir=cache_dir, no_stats=True,
+                              sample_resources=False)
+
+    collector = RunCollector()
+    sampler = ResourceSampler(ns.image_path, ns.sample_interval)
+    listeners = [collector, sampler]
+
+    sampler.start()
+
+    for listener in listeners:
+        add_listener(listener, local=True)
+
+    try:
+        session.create(size=ns.size, force=True)
+        # the fixture is an unsigned flat repository.
+        session.bootstrap(engine="native", suite=ns.suite, arch=ns.arch,
+                          jobs=ns.jobs, no_verify=True)
+        session.install(selections=ns.selections, repository=ns.fixture,
+                        defer_triggers=ns.defer_triggers)
+
+        with stage("export"):
+            exported = export_image(ns.image_path, export_path)
+    finally:
+        for listener in listeners:
+            remove_listener(listener, local=True)
+
+        sampler.stop()
+
+    size, allocated = allocated_size(ns.image_path)
+    os.unlink(export_path)
+
+    return {
+        "stages": collector.stages,
+        "commands": collector.commands,
+        "written": collector.written,
+        "image_size": size,
+        "allocated": allocated,
+        "exported": exported,
+    }
+
+
+def summarize_runs(runs):
+    """
+    Combine several runs, using the median of every measurement.
+    """
+    result = {"runs": len(runs)}
+
+    for key in ("stages", "commands", "written"):
+        names = set()
+
+        for run in runs:
+            names.update(run[key])
+
+        result[key] = dict(
+            (name, median([run[key][name] for run in runs
+                           if name in run[key]]))
+            for name in names)
+
+    for key in ("image_size", "allocated", "exported"):
+        result[key] = median([run[key] for run in runs])
+
+    result["command_count"] = sum(result["commands"].values())
+    return result
+
+
+def flatten(results):
+    """
+    Generate (name, value) of all measurements where lower is better.
+    """
+    for name, value in sorted(results["stages"].items()):
+        yield "time {0}".format(name), value
+
+    for name, value in sorted(results["written"].items()):
+        yield "written {0}".format(name), value
+
+    yield "commands", results["command_count"]
+    yield "allocated", results["allocated"]
+    yield "exported", results["exported"]
+
+
+def compare(results, baseline, threshold):
+    """
+    Print all measurements, against the baseline if there is one, and return
+    the names of those which regressed beyond threshold percent.
+    """
+    previous = dict(flatten(baseline)) if baseline is not None else dict()
+    regressed = []
+
+    for name, value in flatten(results):
+        before = previous.get(name)
+
+        if not before:
+            print "  {0}: {1}".format(name, _format(name, value))
+            continue
+
+        if name.startswith("time ") and \
+                max(value, before) < MINIMUM_DURATION:
+            continue
+
+        change = (float(value) / before - 1) * 100
+        flag = ""
+
+        if change > threshold:
+            regressed.append(name)
+            flag = " REGRESSED"
+
+        print "  {0}: {1} (baseline {2}, {3:+.1f}%){4}".format(
+            name, _format(name, value), _format(name, before), change, flag)
+
+    return regressed
+
+
+def _format(name, value):
+    if name.startswith("time "):
+        return "{0:.1f}s".format(value)
+
+    if name == "commands":
+        return "{0:g}".format(value)
+
+    return "{0:.1f}MB".format(value / float(2 ** 20))
+
+
+def action(ns):
+    """
+    Build a reference image from a local fixture repository and measure it.
+    """
+    from vdisk.api import Context
+
+    ns.fixture = os.path.abspath(ns.fixture)
+
+    if not os.path.isfile(os.path.join(ns.fixture, "Packages")):
+        raise Exception("Not a repository: {0}".format(ns.fixture))
+
+    if ns.baseline is not None and not os.path.isfile(ns.baseline):
+        raise Exception("No such baseline: {0}".format(ns.baseline))
+
+    context = Context(root=ns.root, volume_group=ns.volume_group,
+                      mountpoint=ns.mountpoint, ec2=ns.ec2,
+                      preset=ns.preset.__class__, root_size=ns.root_size,
+                      compressor=ns.compressor,
+                      compression_jobs=ns.compression_jobs)
+
+    runs = []
+
+    # every run starts with empty caches, unless measuring warm builds.
+    if ns.warm_cache:
+        cache_dir = ns.cache_dir
+    else:
+        cache_dir = "{0}.cache".format(os.path.abspath(ns.image_path))
+
+    for i in range(ns.runs):
+        if not ns.warm_cache and os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+
+        log.info("Benchmark run {0} of {1}".format(i + 1, ns.runs))
+
+        with stage("run-{0}".format(i + 1)):
+            if ns.http:
+                with FixtureServer(ns.fixture) as server:
+                    runs.append(run_once(ns, context, server.url, cache_dir))
+            else:
+                runs.append(run_once(ns, context, "file://" + ns.fixture,
+                                     cache_dir))
+
+        if not ns.warm_cache:
+            shutil.rmtree(cache_dir)
+
+    results = summarize_runs(runs)
+    results["vdisk"] = __version_string__
+    results["host"] = host_info()
+    results["time"] = time.time()
+    results["mirror"] = "http" if ns.http else "file"
+
+    print "benchmark of {0} run(s):".format(ns.runs)
+
+    baseline = None
+
+    if ns.baseline is not None:
+        with open(ns.baseline) as f:
+            baseline = json.load(f)
+
+    regressed = compare(results, baseline, ns.threshold)
+
+    if ns.save_baseline:
+        with open(ns.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        log.info("Wrote results: {0}".format(ns.save_baseline))
+
+    if regressed:
+        log.warning("Regressed against baseline: {0}".format(
+            ", ".join(regressed)))
+        return 1
+
+    return 0
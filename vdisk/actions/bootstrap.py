@@ -18,6 +18,8 @@ import logging
 
 log = logging.getLogger(__name__)
 
+from vdisk.actions.install import APTITUDE_ENV
+from vdisk.native_bootstrap import bootstrap
 from vdisk.externalcommand import ExternalCommand
 
 debootstrap = ExternalCommand("debootstrap")
@@ -25,7 +27,8 @@ debootstrap = ExternalCommand("debootstrap")
 
 def action(ns):
     """
-    Invoke debootstrap on an already created image.
+    Invoke debootstrap, or the native bootstrap engine, on an already created
+    image.
     """
     if not os.path.isfile(ns.image_path):
         raise Exception("No such file: {0}".format(ns.image_path))
@@ -38,6 +41,13 @@ def action(ns):
     with ns.preset.entered_system(mount_proc=False, mount_dev=False) as d:
         devices, logical_volumes, mountpoint = d
         log.info("Installing on {0}".format(mountpoint))
-        debootstrap("--arch", ns.arch, ns.suite, mountpoint, ns.mirror)
+
+        if ns.engine == "native":
+            keyring = None if ns.no_verify else ns.keyring
+            bootstrap(mountpoint, ns.mirror, ns.suite, ns.arch,
+                      dict(APTITUDE_ENV), jobs=ns.jobs, keyring=keyring,
+                      keep_archives=ns.keep_archives)
+        else:
+            debootstrap("--arch", ns.arch, ns.suite, mountpoint, ns.mirror)
 
     return 0
@@ -18,6 +18,9 @@ import logging
 
 log = logging.getLogger(__name__)
 
+from vdisk.blockmap import allocated_size
+from vdisk.sizing import estimate
+
 
 def action(ns):
     """
@@ -26,7 +29,24 @@ def action(ns):
     if not ns.force and os.path.isfile(ns.image_path):
         raise Exception("path already exists: {0}".format(ns.image_path))
 
+    if ns.auto_size:
+        from vdisk import sizeunit
+
+        root_size, size = estimate(ns)
+        log.info("Estimated root size {0}MB, image size {1}MB".format(
+            root_size // 2 ** 20, size // 2 ** 20))
+
+        ns.size = sizeunit("{0}M".format(size // 2 ** 20))
+        ns.root_size = sizeunit("{0}M".format(root_size // 2 ** 20))
+        ns.preset.root_size = ns.root_size
+
     with open(ns.image_path, "w") as f:
         f.truncate(ns.size.size)
 
     ns.preset.setup_disks()
+
+    size, allocated = allocated_size(ns.image_path)
+    log.info("Created {0}: {1}MB apparent, {2}MB allocated".format(
+        ns.image_path, size // 2 ** 20, allocated // 2 ** 20))
+
+    return 0
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import struct
+import zlib
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.blockmap import block_digests
+from vdisk.blockmap import content_digest
+
+MAGIC = "VDISKDELTA\x01"
+
+HEADER = struct.Struct(">IQQ40s40s")
+RECORD = struct.Struct(">cQQ")
+DATA_LENGTH = struct.Struct(">I")
+
+RECORD_COPY = "C"
+RECORD_DATA = "D"
+RECORD_END = "E"
+
+# upper limit of literal data compressed as a single unit.
+MAX_DATA_RECORD = 4 * 2 ** 20
+
+
+def write_header(f, block_size, old_size, new_size, old_digest, new_digest):
+    f.write(MAGIC)
+    f.write(HEADER.pack(block_size, old_size, new_size,
+                        old_digest, new_digest))
+
+
+def read_header(f):
+    magic = f.read(len(MAGIC))
+
+    if magic != MAGIC:
+        raise Exception("Not a vdisk delta: {0}".format(f.name))
+
+    return HEADER.unpack(f.read(HEADER.size))
+
+
+def read_records(f):
+    """
+    Generate (kind, offset, length, data) tuples from a delta, data is None
+    for anything but data records.
+    """
+    while True:
+        kind, offset, length = RECORD.unpack(f.read(RECORD.size))
+
+        if kind == RECORD_END:
+            return
+
+        if kind == RECORD_COPY:
+            yield kind, offset, length, None
+            continue
+
+        if kind == RECORD_DATA:
+            size, = DATA_LENGTH.unpack(f.read(DATA_LENGTH.size))
+            data = zlib.decompress(f.read(size))
+
+            if len(data) != length:
+                raise Exception("Corrupt data record at {0}".format(offset))
+
+            yield kind, offset, length, data
+            continue
+
+        raise Exception("Unknown record type: {0!r}".format(kind))
+
+
+def plan_records(old_digests, new_digests, block_size, new_size):
+    """
+    Compare block digests and generate coalesced (kind, offset, length)
+    ranges describing the new image in terms of the old one.
+    """
+    current = None
+
+    for offset in sorted(new_digests):
+        length = min(block_size, new_size - offset)
+
+        if old_digests.get(offset) == new_digests[offset]:
+            kind = RECORD_COPY
+        else:
+            kind = RECORD_DATA
+
+        if current is not None:
+            c_kind, c_offset, c_length = current
+
+            contiguous = c_offset + c_length == offset
+            fits = kind == RECORD_COPY or c_length < MAX_DATA_RECORD
+
+            if c_kind == kind and contiguous and fits:
+                current = (kind, c_offset, c_length + length)
+                continue
+
+            yield current
+
+        current = (kind, offset, length)
+
+    if current is not None:
+        yield current
+
+
+def action(ns):
+    """
+    Write a block-level delta which turns old_image into image_path.
+    """
+    for path in (ns.image_path, ns.old_image):
+        if not os.path.isfile(path):
+            raise Exception("No such file: {0}".format(path))
+
+    if not ns.force and os.path.exists(ns.patch):
+        raise Exception("path already exists: {0}".format(ns.patch))
+
+    block_size = ns.block_size.size
+
+    log.info("Hashing {0}".format(ns.old_image))
+    old_digests = block_digests(ns.old_image, block_size,
+                                processes=ns.jobs)
+
+    log.info("Hashing {0}".format(ns.image_path))
+    new_digests = block_digests(ns.image_path, block_size,
+                                processes=ns.jobs)
+
+    old_size = os.path.getsize(ns.old_image)
+    new_size = os.path.getsize(ns.image_path)
+
+    copied = 0
+    literal = 0
+
+    with open(ns.image_path, "rb") as image:
+        with open(ns.patch, "wb") as f:
+            write_header(f, block_size, old_size, new_size,
+                         content_digest(old_digests),
+                         content_digest(new_digests))
+
+            records = plan_records(old_digests, new_digests, block_size,
+                                   new_size)
+
+            for kind, offset, length in records:
+                f.write(RECORD.pack(kind, offset, length))
+
+                if kind == RECORD_COPY:
+                    copied += length
+                    continue
+
+                image.seek(offset)
+                data = zlib.compress(image.read(length), ns.compression)
+                f.write(DATA_LENGTH.pack(len(data)))
+                f.write(data)
+                literal += length
+
+            f.write(RECORD.pack(RECORD_END, 0, 0))
+
+    log.info("Wrote {0}: {1} bytes reused, {2} bytes changed, "
+             "{3} bytes on disk".format(
+                 ns.patch, copied, literal, os.path.getsize(ns.patch)))
+
+    return 0
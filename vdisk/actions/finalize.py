@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+
+
+def action(ns):
+    """
+    Replace the root of an image with a read-only compressed image of itself,
+    with a preset which supports it.
+    """
+    if not os.path.isfile(ns.image_path):
+        raise Exception("No such file: {0}".format(ns.image_path))
+
+    if not hasattr(ns.preset, 'finalize'):
+        raise Exception("Nothing to finalize with the {0} preset".format(
+            ns.preset.__class__.__name__))
+
+    ns.preset.finalize()
+    return 0
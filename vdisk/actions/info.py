@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import logging
+import yaml
+
+log = logging.getLogger(__name__)
+
+from vdisk.imageinfo import inspect
+from vdisk.externalcommand import ExternalCommand
+
+debugfs = ExternalCommand("debugfs")
+
+
+def read_image_file(image_path, offset, path):
+    """
+    Read a file from the ext filesystem at offset in the image, without
+    attaching the image to any devices.
+
+    Returns None if the file does not exist.
+    """
+    spec = "{0}?offset={1}".format(image_path, offset)
+    exitcode, out, err = debugfs("-R", "cat {0}".format(path), spec,
+                                 capture=True, split_output=False)
+
+    if "File not found" in err:
+        return None
+
+    return out
+
+
+def parse_os_release(content):
+    release = dict()
+
+    for line in content.splitlines():
+        line = line.strip()
+
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+
+        key, value = line.split("=", 1)
+        release[key] = value.strip('"\'')
+
+    return release
+
+
+def count_installed(status):
+    """
+    Count installed packages in the content of a dpkg status file.
+    """
+    return sum(1 for line in status.splitlines()
+               if line.startswith("Status:") and line.endswith(" installed"))
+
+
+def find_root(info):
+    for vg in info["volume_groups"]:
+        for lv in vg["logical_volumes"]:
+            fs = lv.get("filesystem")
+
+            if lv["name"] == "root" and fs and fs["type"] == "ext" and \
+                    lv.get("offset") is not None:
+                return lv["offset"]
+
+    return None
+
+
+def inspect_system(image_path, info):
+    """
+    Read release and package information from the root filesystem.
+    """
+    offset = find_root(info)
+
+    if offset is None:
+        log.warning("No readable root volume in {0}".format(image_path))
+        return None
+
+    system = dict()
+
+    os_release = read_image_file(image_path, offset, "/etc/os-release")
+
+    if os_release is not None:
+        system["os_release"] = parse_os_release(os_release)
+
+    debian_version = read_image_file(image_path, offset,
+                                     "/etc/debian_version")
+
+    if debian_version is not None:
+        system["debian_version"] = debian_version.strip()
+
+    status = read_image_file(image_path, offset, "/var/lib/dpkg/status")
+
+    if status is not None:
+        system["installed_packages"] = count_installed(status)
+
+    return system
+
+
+def _mb(size):
+    if size is None:
+        return "-"
+
+    return "{0:.1f}M".format(size / float(2 ** 20))
+
+
+def _describe_fs(fs):
+    if not fs:
+        return "unknown"
+
+    if "size" not in fs:
+        return fs["type"]
+
+    return "{0} {1}/{2} used".format(fs["type"], _mb(fs["used"]),
+                                     _mb(fs["size"]))
+
+
+def print_info(info):
+    print "image: {0}".format(info["image"])
+    print "size: {0} apparent, {1} allocated".format(
+        _mb(info["size"]), _mb(info["allocated"]))
+    print "partition table: {0}".format(info["partition_table"])
+
+    for p in info["partitions"]:
+        print "  partition {0}: {1} {2} apparent, {3} allocated, {4}".format(
+            p["number"], p["type"], _mb(p["size"]), _mb(p["allocated"]),
+            _describe_fs(p["filesystem"]))
+
+    for vg in info["volume_groups"]:
+        print "volume group: {0} ({1} extents of {2})".format(
+            vg["name"], vg["extent_count"], _mb(vg["extent_size"]))
+
+        for lv in vg["logical_volumes"]:
+            print "  {0}: {1} apparent, {2} allocated, {3}".format(
+                lv["name"], _mb(lv["size"]), _mb(lv["allocated"]),
+                _describe_fs(lv["filesystem"]))
+
+    system = info.get("system")
+
+    if not system:
+        return
+
+    release = system.get("os_release", {})
+    name = release.get("PRETTY_NAME")
+
+    if name is None and "debian_version" in system:
+        name = "Debian {0}".format(system["debian_version"])
+
+    print "system: {0}".format(name or "unknown")
+
+    if "installed_packages" in system:
+        print "installed packages: {0}".format(system["installed_packages"])
+
+
+def action(ns):
+    """
+    Describe an image without mounting it.
+    """
+    if not os.path.isfile(ns.image_path):
+        raise Exception("No such file: {0}".format(ns.image_path))
+
+    info = inspect(ns.image_path)
+
+    if not ns.no_system:
+        info["system"] = inspect_system(ns.image_path, info)
+
+    if ns.yaml:
+        print yaml.safe_dump(info, default_flow_style=False),
+    else:
+        print_info(info)
+
+    return 0
@@ -15,14 +15,28 @@
 
 import os
 import re
+import glob
+import shutil
 import logging
+import contextlib
 
 log = logging.getLogger(__name__)
 
 from vdisk.helpers import copy_file
 from vdisk.helpers import create_directory
 from vdisk.helpers import install_packages
+from vdisk.helpers import mounted_device
 from vdisk.helpers import write_mounted
+from vdisk.actions.resize import shrink
+from vdisk.aptrepo import build_repository
+from vdisk.aptcache import update_apt
+from vdisk.events import output_handler
+from vdisk.initramfs import initramfs_digest
+from vdisk.initramfs import update_initramfs
+from vdisk.journal import Journal
+from vdisk.snapshots import has_thin_root
+from vdisk.stages import stage
+from vdisk.stats import file_digest
 
 from vdisk.externalcommand import ExternalCommand
 
@@ -36,6 +50,24 @@ APTITUDE_ENV = {
     "LANG": "C",
 }
 
+# Where a local repository is bind mounted inside of the image.
+REPOSITORY_PATH = "var/lib/vdisk/repository"
+# The local repository is unsigned, this is only present during installation.
+REPOSITORY_APT_CONF = "etc/apt/apt.conf.d/00vdisk-repository"
+# The apt sources of the image are moved here while the local repository is
+# used, and moved back afterwards.
+SOURCES_PATHS = ["etc/apt/sources.list", "etc/apt/sources.list.d"]
+SOURCES_BACKUP = "{0}.vdisk"
+
+TRIGGERS_APT_CONF = "etc/apt/apt.conf.d/00vdisk-triggers"
+TRIGGERS_APT_OPTIONS = [
+    'DPkg::NoTriggers "true";',
+    'DPkg::ConfigurePending "true";',
+    'DPkg::TriggersPending "false";',
+]
+
+UPDATE_INITRAMFS = "/usr/sbin/update-initramfs"
+
 
 def action(ns):
     if not os.path.isfile(ns.image_path):
@@ -47,50 +79,214 @@ def action(ns):
     if not os.path.isfile(ns.selections):
         raise Exception("Missing selections file: {0}".format(ns.selections))
 
+    local_repository = ns.repository is not None and not ns.download
+
+    if local_repository and not os.path.isfile(
+            os.path.join(ns.repository, "Packages")):
+        raise Exception("Not a repository: {0}".format(ns.repository))
+
+    if ns.shrink_to_fit and not ns.download:
+        if hasattr(ns.preset, 'finalize'):
+            raise Exception("--shrink-to-fit is not supported by the preset")
+
+        if has_thin_root(ns.image_path):
+            raise Exception("--shrink-to-fit needs a flattened image")
+
+        if getattr(ns.preset, "custom_layout", False):
+            raise Exception("--shrink-to-fit is not supported with a "
+                            "declared layout")
+
     with ns.preset.entered_system() as d:
         devices, logical_volumes, mountpoint = d
 
-        # find first device as soon as possible
-        apt_env = dict(APTITUDE_ENV)
+        contexts = []
 
-        preinst = ns.config.get("preinst")
-        if preinst:
-            execute_chrooted(ns, preinst)
+        if local_repository:
+            contexts.append(mounted_device(
+                ns.repository, os.path.join(mountpoint, REPOSITORY_PATH),
+                mount_bind=True))
 
-        log.info("Configuring apt")
-        configure_base_system(ns, apt_env, mountpoint)
+        if ns.defer_triggers:
+            contexts.append(deferred_triggers(ns, mountpoint))
 
-        log.info("Install selected packages")
+        with contextlib.nested(*contexts):
+            # find first device as soon as possible
+            apt_env = dict(APTITUDE_ENV)
+            journal = Journal(mountpoint, resume=ns.resume)
 
-        if ns.download:
-            download_selections(ns, apt_env, mountpoint)
-        else:
-            install_selections(ns, apt_env, mountpoint)
+            preinst = ns.config.get("preinst")
+            if preinst:
+                with stage("preinst"):
+                    journal.run("preinst", preinst,
+                                execute_chrooted, ns, preinst)
+
+            repository = []
+
+            if local_repository:
+                log.info("Using local repository: {0}".format(ns.repository))
+                repository.append(
+                    local_repository_sources(ns, apt_env, mountpoint))
 
-        ns.preset.setup_boot(devices, mountpoint)
+            with contextlib.nested(*repository) as digests:
+                sources_digest = digests[0] if digests else None
 
-        log.info("Writing fstab")
-        fstab = generate_fstab(ns)
-        write_mounted(mountpoint, "etc/fstab", fstab)
+                log.info("Configuring apt")
 
-        log.info("Writing real device.map")
-        new_devicemap = generate_devicemap(ns, logical_volumes)
-        write_mounted(mountpoint, "boot/grub/device.map", new_devicemap)
+                with stage("configure"):
+                    journal.run("configure",
+                                base_system_inputs(ns, not local_repository),
+                                configure_base_system, ns, apt_env,
+                                mountpoint,
+                                write_sources=not local_repository,
+                                sources_digest=sources_digest)
 
-        manifest = ns.config.get("manifest")
-        postinst = ns.config.get("postinst")
+                log.info("Install selected packages")
 
-        if manifest:
-            install_manifest(ns, manifest)
+                if ns.download:
+                    with stage("download"):
+                        journal.run("download", file_digest(ns.selections),
+                                    download_selections, ns, apt_env,
+                                    mountpoint)
 
-        if postinst:
-            execute_chrooted(ns, postinst)
+                    if ns.repository is not None:
+                        with stage("repository"):
+                            export_repository(ns, mountpoint)
+                else:
+                    with stage("selections"):
+                        journal.run("selections", file_digest(ns.selections),
+                                    install_selections, ns, apt_env,
+                                    mountpoint)
 
-        chroot(ns.mountpoint, "update-initramfs", "-u")
+            with stage("boot"):
+                journal.run("boot",
+                            [ns.preset.__class__.__name__, ns.volume_group],
+                            ns.preset.setup_boot, devices, mountpoint)
+
+                fstab = generate_preset_fstab(ns)
+                journal.run("fstab", fstab,
+                            write_fstab, ns, mountpoint, fstab)
+
+                devicemap = list(generate_devicemap(ns, logical_volumes))
+                journal.run("device.map", devicemap,
+                            write_devicemap, ns, mountpoint, devicemap)
+
+            with stage("files"):
+                manifest = ns.config.get("manifest")
+
+                if manifest:
+                    journal.run("manifest", manifest_inputs(ns, manifest),
+                                install_manifest, ns, manifest)
+
+                for i, line in enumerate(ns.config.get("postinst") or []):
+                    journal.run("postinst {0}".format(i), line,
+                                execute_chrooted, ns, [line])
+
+        with stage("initramfs"):
+            journal.run("initramfs", initramfs_digest(mountpoint),
+                        update_initramfs, ns, mountpoint)
+
+    if ns.shrink_to_fit and not ns.download:
+        with stage("shrink"):
+            shrink(ns)
 
     return 0
 
 
+def base_system_inputs(ns, write_sources):
+    """
+    Everything configure_base_system depends on, the content of keys and
+    preferences included.
+    """
+    keys = ns.config.get("keys", [])
+    preferences = ns.config.get("preferences", [])
+
+    return {
+        "pre-packages": ns.config.get("pre-packages"),
+        "sources": ns.config.get("sources") if write_sources else None,
+        "keys": [(key, file_digest(os.path.join(ns.root, "keys", key)))
+                 for key in keys],
+        "preferences": [
+            (preference, file_digest(
+                os.path.join(ns.root, "preferences", preference)))
+            for preference in preferences],
+        "packages": ns.config.get("packages"),
+        "preset": ns.preset.__class__.__name__,
+    }
+
+
+def manifest_inputs(ns, manifest):
+    return [(item, file_digest(os.path.join(ns.root, item["source"]))
+             if item.get("source") else None)
+            for item in manifest]
+
+
+def setup_boot(ns, devices, logical_volumes, mountpoint):
+    ns.preset.setup_boot(devices, mountpoint)
+    write_fstab(ns, mountpoint, generate_preset_fstab(ns))
+    write_devicemap(ns, mountpoint,
+                    list(generate_devicemap(ns, logical_volumes)))
+
+
+def generate_preset_fstab(ns):
+    if hasattr(ns.preset, 'generate_fstab'):
+        return list(ns.preset.generate_fstab())
+
+    return list(generate_fstab(ns))
+
+
+def write_fstab(ns, mountpoint, fstab):
+    log.info("Writing fstab")
+    write_mounted(mountpoint, "etc/fstab", fstab)
+
+
+def write_devicemap(ns, mountpoint, devicemap):
+    log.info("Writing real device.map")
+    write_mounted(mountpoint, "boot/grub/device.map", devicemap)
+
+
+def install_files(ns):
+    manifest = ns.config.get("manifest")
+    postinst = ns.config.get("postinst")
+
+    if manifest:
+        install_manifest(ns, manifest)
+
+    if postinst:
+        execute_chrooted(ns, postinst)
+
+
+@contextlib.contextmanager
+def deferred_triggers(ns, mountpoint):
+    """
+    Defer dpkg triggers and initramfs generation until the end of the
+    session, at which point every pending trigger runs once.
+
+    update-initramfs is diverted to a no-op while deferring, the initramfs is
+    expected to be generated explicitly afterwards, including the images of
+    kernels installed in the meantime.
+    """
+    stub = os.path.join(mountpoint, UPDATE_INITRAMFS.lstrip("/"))
+
+    log.info("Deferring dpkg triggers")
+    write_mounted(mountpoint, TRIGGERS_APT_CONF, TRIGGERS_APT_OPTIONS)
+    chroot(mountpoint, "dpkg-divert", "--local", "--rename", "--add",
+           UPDATE_INITRAMFS)
+    write_mounted(mountpoint, UPDATE_INITRAMFS.lstrip("/"),
+                  ["#!/bin/sh", "exit 0"])
+    chroot(mountpoint, "chmod", "755", UPDATE_INITRAMFS)
+
+    try:
+        yield
+        log.info("Running deferred triggers")
+        chroot(mountpoint, ns.dpkg, "--triggers-only", "--pending",
+               env=APTITUDE_ENV)
+    finally:
+        os.unlink(os.path.join(mountpoint, TRIGGERS_APT_CONF))
+        os.unlink(stub)
+        chroot(mountpoint, "dpkg-divert", "--local", "--rename", "--remove",
+               UPDATE_INITRAMFS)
+
+
 def generate_sources(sources, default_components=["main"],
                      default_source_type="deb"):
     for name, opts in sources.items():
@@ -138,7 +334,128 @@ def insert_apt_preferences(ns, mountpoint, preferences):
         log.info("Inserting apt preference: {0}".format(preference_path))
         copy_file(ns, preference_path, "etc/apt/preferences.d/{0}".format(preference))
 
-def configure_base_system(ns, apt_env, mountpoint):
+def enable_local_repository(ns, apt_env, mountpoint):
+    """
+    Replace all apt sources with the local repository.
+
+    Returns the digest of the apt sources after updating.
+    """
+    for path in SOURCES_PATHS:
+        source = os.path.join(mountpoint, path)
+        backup = SOURCES_BACKUP.format(source)
+
+        # a backup left by an interrupted build is the original.
+        if os.path.lexists(source) and not os.path.lexists(backup):
+            os.rename(source, backup)
+
+    sources_d = os.path.join(mountpoint, "etc/apt/sources.list.d")
+
+    if not os.path.isdir(sources_d):
+        os.mkdir(sources_d)
+
+    write_mounted(mountpoint, REPOSITORY_APT_CONF,
+                  ['APT::Get::AllowUnauthenticated "true";'])
+    write_mounted(mountpoint, "etc/apt/sources.list",
+                  ["# local vdisk repository",
+                   "deb file:/{0} ./".format(REPOSITORY_PATH)])
+
+    return update_apt(ns, apt_env, mountpoint)
+
+
+def restore_sources(mountpoint):
+    """
+    Move back the apt sources of the image which were replaced by the local
+    repository.
+
+    Sources added to sources.list.d in the meantime, by installed packages,
+    are kept.
+    """
+    for path in SOURCES_PATHS:
+        source = os.path.join(mountpoint, path)
+        backup = SOURCES_BACKUP.format(source)
+
+        if not os.path.lexists(backup):
+            continue
+
+        if os.path.isdir(backup) and os.path.isdir(source):
+            for name in os.listdir(backup):
+                os.rename(os.path.join(backup, name),
+                          os.path.join(source, name))
+
+            os.rmdir(backup)
+            continue
+
+        if os.path.isdir(source):
+            shutil.rmtree(source)
+        elif os.path.lexists(source):
+            os.unlink(source)
+
+        os.rename(backup, source)
+
+
+def disable_local_repository(ns, mountpoint):
+    """
+    Restore the apt sources of the image, followed by the configured ones,
+    and remove all traces of the local repository.
+    """
+    apt_conf = os.path.join(mountpoint, REPOSITORY_APT_CONF)
+
+    if os.path.isfile(apt_conf):
+        os.unlink(apt_conf)
+
+    lists = os.path.join(mountpoint, "var/lib/apt/lists",
+                         "*{0}*".format(REPOSITORY_PATH.replace("/", "_")))
+
+    for path in glob.glob(lists):
+        os.unlink(path)
+
+    restore_sources(mountpoint)
+
+    sources = ns.config.get("sources")
+
+    if sources:
+        log.info("Writing sources.list")
+        write_mounted(mountpoint, "etc/apt/sources.list",
+                      generate_sources(sources))
+
+
+@contextlib.contextmanager
+def local_repository_sources(ns, apt_env, mountpoint):
+    """
+    Use the local repository as the only apt source, until the end of the
+    block, also when it fails.
+
+    Yields the digest of the apt sources after updating.
+    """
+    try:
+        yield enable_local_repository(ns, apt_env, mountpoint)
+    finally:
+        disable_local_repository(ns, mountpoint)
+
+
+def export_repository(ns, mountpoint):
+    """
+    Copy all downloaded packages into a flat repository on the host.
+    """
+    if not os.path.isdir(ns.repository):
+        os.makedirs(ns.repository)
+
+    archives = os.path.join(mountpoint, "var/cache/apt/archives")
+
+    for source in glob.glob(os.path.join(archives, "*.deb")):
+        target = os.path.join(ns.repository, os.path.basename(source))
+
+        if os.path.isfile(target) and \
+                os.path.getsize(target) == os.path.getsize(source):
+            continue
+
+        shutil.copy2(source, target)
+
+    build_repository(ns.repository)
+
+
+def configure_base_system(ns, apt_env, mountpoint, write_sources=True,
+                          sources_digest=None):
     prepackages = ns.config.get("pre-packages")
 
     if prepackages:
@@ -149,7 +466,7 @@ def configure_base_system(ns, apt_env, mountpoint):
 
     sources = ns.config.get("sources")
 
-    if sources:
+    if sources and write_sources:
         log.info("Writing sources.list")
         sourceslist = generate_sources(sources)
         write_mounted(mountpoint, "etc/apt/sources.list", sourceslist)
@@ -165,8 +482,7 @@ def configure_base_system(ns, apt_env, mountpoint):
     if hasattr(ns.preset, 'setup_apt'):
         ns.preset.setup_apt()
 
-    log.info("Updating apt")
-    chroot(mountpoint, ns.apt_get, "-y", "update", env=apt_env)
+    sources_digest = update_apt(ns, apt_env, mountpoint, sources_digest)
 
     packages = ns.config.get("packages")
 
@@ -176,8 +492,8 @@ def configure_base_system(ns, apt_env, mountpoint):
                          env=apt_env,
                          extra=["-y", "--force-yes"])
 
-    log.info("Updating apt")
-    chroot(mountpoint, ns.apt_get, "-y", "update", env=apt_env)
+    # installed packages might have added sources or keys.
+    update_apt(ns, apt_env, mountpoint, sources_digest)
 
 
 def download_selections(ns, apt_env, mountpoint):
@@ -188,7 +504,7 @@ def download_selections(ns, apt_env, mountpoint):
 
     log.info("Downloading selections")
     chroot(mountpoint, ns.apt_get, "-y", "-u", "--download-only",
-           "dselect-upgrade", env=apt_env)
+           "dselect-upgrade", env=apt_env, output_handler=output_handler())
 
 
 def install_selections(ns, apt_env, mountpoint):
@@ -202,7 +518,7 @@ def install_selections(ns, apt_env, mountpoint):
     write_mounted(ns.mountpoint, "usr/sbin/policy-rc.d", ["exit 101"])
     chroot(mountpoint, 'chmod', '755', '/usr/sbin/policy-rc.d')
     chroot(mountpoint, ns.apt_get, "-y", "-u",
-           "dselect-upgrade", env=apt_env)
+           "dselect-upgrade", env=apt_env, output_handler=output_handler())
     chroot(mountpoint, 'rm', '-f', '/usr/sbin/policy-rc.d')
 
 
@@ -217,6 +533,16 @@ def generate_fstab(ns):
 def generate_devicemap(ns, logical_volumes):
     yield "(hd0) /dev/sda"
 
+    layout = getattr(ns.preset, "layout", None)
+
+    if layout:
+        # volumes in the order they were created, the rest after them.
+        order = [volume["name"] for volume in layout]
+        logical_volumes = sorted(
+            logical_volumes,
+            key=lambda name: (order.index(name) if name in order
+                              else len(order), name))
+
     for i, logical_volume in enumerate(logical_volumes):
         yield "(hd0,{0}) {1}".format(i, logical_volume)
 
@@ -14,14 +14,215 @@
 # the License.
 
 import os
+import time
+import shutil
+import hashlib
+import logging
+
+import yaml
+
+log = logging.getLogger(__name__)
 
 from vdisk.helpers import mounted_device
+from vdisk.puppetreport import find_report
+from vdisk.puppetreport import read_report
+from vdisk.puppetreport import summarize
+from vdisk.puppetreport import write_summary
+from vdisk.stages import stage
 
 from vdisk.externalcommand import ExternalCommand
 
 
 chroot = ExternalCommand("chroot")
 
+# Where a cached catalog is put inside of the image while applying it.
+CATALOG_PATH = "var/lib/vdisk/catalog.json"
+
+# Settings of 'puppet apply' which also affect compilation.
+COMPILE_SETTINGS = [
+    "--modulepath", "--manifestdir", "--templatedir", "--hiera_config",
+    "--environment", "--environmentpath", "--confdir", "--parser",
+]
+
+# Facts which change between runs, and are not used to key the cache.
+VOLATILE_FACTS = (
+    "uptime", "system_uptime", "memoryfree", "swapfree", "memory",
+    "load_averages", "timestamp", "last_run", "path",
+)
+
+IGNORED_DIRECTORIES = set([".git", ".svn", ".hg"])
+
+
+def tree_digest(path):
+    """
+    Calculate a digest of the names and contents of all files in a tree.
+    """
+    h = hashlib.sha1()
+
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in IGNORED_DIRECTORIES)
+
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            h.update(os.path.relpath(full, path) + "\0")
+
+            if os.path.islink(full):
+                h.update(os.readlink(full))
+            else:
+                with open(full, "rb") as f:
+                    for data in iter(lambda: f.read(2 ** 16), ""):
+                        h.update(data)
+
+            h.update("\0")
+
+    return h.hexdigest()
+
+
+def stable_facts(mountpoint, env):
+    exitcode, out, err = chroot(mountpoint, "facter", "-p", "--yaml",
+                                env=env, capture=True, split_output=False)
+
+    facts = yaml.safe_load(out) or {}
+
+    return dict((name, value) for name, value in facts.items()
+                if not name.startswith(VOLATILE_FACTS))
+
+
+def parse_apply_args(puppetargs):
+    """
+    Split the arguments of 'puppet apply' into the settings which affect
+    compilation, the remaining options and the manifest.
+    """
+    if not puppetargs or puppetargs[0] != "apply":
+        raise Exception("Catalog caching requires 'apply' as the puppet "
+                        "command")
+
+    settings = []
+    options = []
+    manifest = None
+
+    args = list(puppetargs[1:])
+
+    while args:
+        arg = args.pop(0)
+
+        if not arg.startswith("-"):
+            manifest = arg
+            continue
+
+        name = arg.split("=", 1)[0]
+        values = []
+
+        if "=" not in arg and name in COMPILE_SETTINGS and args:
+            values.append(args.pop(0))
+
+        if name in COMPILE_SETTINGS:
+            settings.extend([arg] + values)
+        else:
+            options.extend([arg] + values)
+
+    if manifest is None:
+        raise Exception("Catalog caching requires a manifest")
+
+    return settings, options, manifest
+
+
+def compile_catalog(mountpoint, env, settings, manifest, node):
+    exitcode, out, err = chroot(
+        mountpoint, "puppet", "master", "--compile", node,
+        "--manifest", manifest, "--facts_terminus", "facter", *settings,
+        env=env, capture=True, split_output=False)
+
+    # log messages may precede the catalog.
+    start = out.find("\n{")
+    catalog = out if out.startswith("{") else out[start + 1:]
+
+    if not catalog.startswith("{"):
+        raise Exception("No catalog in output of puppet master --compile")
+
+    return catalog
+
+
+def cached_apply(ns, mountpoint, env):
+    """
+    Apply a catalog from the cache, compiling and caching it first unless
+    the modules, facts and arguments are unchanged since an earlier run.
+    """
+    settings, options, manifest = parse_apply_args(ns.puppetargs)
+    facts = stable_facts(mountpoint, env)
+
+    h = hashlib.sha1()
+    h.update(tree_digest(ns.puppetpath))
+    h.update(yaml.safe_dump(facts))
+    h.update("\0".join(settings + [manifest]))
+    key = h.hexdigest()
+
+    cached = os.path.join(ns.cache_dir, "puppet-catalogs",
+                          "{0}.json".format(key))
+
+    if os.path.isfile(cached):
+        log.info("Using cached catalog: {0}".format(cached))
+    else:
+        node = str(facts.get("fqdn") or facts.get("hostname")).lower()
+
+        with stage("compile"):
+            catalog = compile_catalog(mountpoint, env, settings, manifest,
+                                      node)
+
+        if not os.path.isdir(os.path.dirname(cached)):
+            os.makedirs(os.path.dirname(cached))
+
+        with open(cached + ".tmp", "w") as f:
+            f.write(catalog)
+
+        os.rename(cached + ".tmp", cached)
+
+    target = os.path.join(mountpoint, CATALOG_PATH)
+
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+
+    shutil.copy(cached, target)
+
+    try:
+        chroot(mountpoint, "puppet", "apply", "--catalog",
+               "/" + CATALOG_PATH, *(settings + options), env=env)
+    finally:
+        os.unlink(target)
+
+
+def profile_run(ns, mountpoint, started):
+    """
+    Summarize the report of the puppet run and write it next to the image.
+    """
+    report_path = find_report(mountpoint, since=started)
+
+    if report_path is None:
+        log.warning("No puppet report written, not profiling run")
+        return
+
+    summary = summarize(read_report(report_path), top=ns.top)
+    path = "{0}.puppet.yaml".format(ns.image_path)
+    write_summary(path, summary)
+
+    metrics = summary["metrics"]
+
+    if "total" in metrics:
+        log.info("Puppet run took {0:.1f}s, {1} resources".format(
+            metrics["total"], summary["resource_count"]))
+
+    if "config_retrieval" in metrics:
+        log.info("  catalog: {0:.1f}s".format(metrics["config_retrieval"]))
+
+    for entry in summary["classes"]:
+        log.info("  class {0}: {1:.1f}s, {2} resources".format(
+            entry["class"], entry["time"], entry["resources"]))
+
+    for entry in summary["resources"]:
+        log.info("  {0}: {1:.1f}s".format(entry["resource"], entry["time"]))
+
+    log.info("Wrote puppet profile: {0}".format(path))
+
 
 def action(ns):
     if not os.path.isfile(ns.image_path):
@@ -41,12 +242,26 @@ def action(ns):
     with ns.preset.entered_system() as d:
         devices, logical_volumes, mountpoint = d
 
-        puppetpath = "{0}/puppet".format(ns.mountpoint)
+        puppetpath = "{0}/puppet".format(mountpoint)
 
         if not os.path.isdir(puppetpath):
             os.makedirs(puppetpath)
 
-        with mounted_device(ns.puppetpath, puppetpath, mount_bind=True):
-            chroot(mountpoint, "puppet", *ns.puppetargs, env=puppet_env)
+        # report timestamps have a resolution of seconds.
+        started = int(time.time())
+
+        try:
+            with mounted_device(ns.puppetpath, puppetpath, mount_bind=True):
+                if ns.catalog_cache:
+                    cached_apply(ns, mountpoint, puppet_env)
+                else:
+                    chroot(mountpoint, "puppet", *ns.puppetargs,
+                           env=puppet_env)
+        finally:
+            # failed runs are profiled as well, without hiding their error.
+            try:
+                profile_run(ns, mountpoint, started)
+            except Exception, e:
+                log.warning("Failed to profile puppet run: {0}".format(e))
 
     return 0
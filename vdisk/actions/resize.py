@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import re
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.helpers import available_lvm
+from vdisk.helpers import mounted_device
+from vdisk.helpers import mounted_loopback
+from vdisk.imageinfo import SECTOR_SIZE
+from vdisk.imageinfo import read_filesystem
+from vdisk.imageinfo import read_lvm_metadata
+from vdisk.imageinfo import read_partitions
+from vdisk.snapshots import has_thin_root
+
+from vdisk.externalcommand import ExternalCommand
+
+lvm = ExternalCommand("lvm")
+parted = ExternalCommand("parted")
+sgdisk = ExternalCommand("sgdisk")
+e2fsck = ExternalCommand("e2fsck")
+resize2fs = ExternalCommand("resize2fs")
+dumpe2fs = ExternalCommand("dumpe2fs")
+mkswap = ExternalCommand("mkswap")
+
+# Room at the end of the image for the backup GPT.
+TRAILER_SIZE = 2 ** 20
+
+# Free space left in the root filesystem when shrinking it to fit.
+SHRINK_MARGIN = 0.1
+
+_MINIMUM_SIZE = re.compile(r"Estimated minimum size of the filesystem: (\d+)")
+_BLOCK_SIZE = re.compile(r"^Block size:\s+(\d+)", re.M)
+
+
+def find_physical_volume(path):
+    """
+    Find the partition table type and the partition holding the physical
+    volume of an image.
+    """
+    with open(path, "rb") as f:
+        table, partitions = read_partitions(f)
+
+        for partition in partitions:
+            if read_lvm_metadata(f, partition["start"]) is not None:
+                return table, partition
+
+    raise Exception("No LVM physical volume in: {0}".format(path))
+
+
+def set_partition_end(path, table, partition, end):
+    """
+    Move the end of a partition, keeping its start. end is exclusive and in
+    bytes.
+    """
+    start = partition["start"] // SECTOR_SIZE
+    last = end // SECTOR_SIZE - 1
+    number = str(partition["number"])
+
+    log.info("Moving end of partition {0} to sector {1}".format(number, last))
+
+    parted("-s", "-a", "none", "--", path, "unit", "s",
+           "rm", number,
+           "mkpart", "primary", "{0}s".format(start), "{0}s".format(last),
+           "set", number, "lvm", "on")
+
+
+def relocate_backup_gpt(path, table):
+    if table == "gpt":
+        sgdisk("-e", path)
+
+
+def lvm_values(*args):
+    exitcode, out, err = lvm(*(args[:1] + ("--noheadings", "--nosuffix",
+                                           "--units", "b") + args[1:]),
+                             capture=True, remove_empty=True)
+    return [line.split() for line in out]
+
+
+def volume_sizes(volume_group):
+    return dict((name, int(size)) for name, size in lvm_values(
+        "lvs", "-o", "lv_name,lv_size", volume_group))
+
+
+def volume_group_state(volume_group):
+    free, extent_size = lvm_values(
+        "vgs", "-o", "vg_free,vg_extent_size", volume_group)[0]
+    return int(free), int(extent_size)
+
+
+def round_up(value, unit):
+    return (value + unit - 1) // unit * unit
+
+
+def check_ext(device):
+    with open(device, "rb") as f:
+        fs = read_filesystem(f, 0)
+
+    if fs is None or fs.get("type") != "ext":
+        raise Exception("Only ext filesystems can be resized: {0}".format(
+            device))
+
+
+def check_filesystem(device):
+    """
+    Force a check of the filesystem on device, which resize2fs requires
+    before shrinking it.
+    """
+    exitcode, out, err = e2fsck("-f", "-p", device, raise_on_exit=False)
+
+    # 1 and 2 mean that errors were corrected.
+    if exitcode & ~3:
+        raise Exception("Filesystem check failed: {0}".format(device))
+
+
+def minimum_size(device):
+    """
+    Estimate the smallest size the filesystem on device can be shrunk to.
+    """
+    exitcode, out, err = resize2fs("-P", device, capture=True,
+                                   split_output=False)
+    minimum = _MINIMUM_SIZE.search(out)
+
+    exitcode, out, err = dumpe2fs("-h", device, capture=True,
+                                  split_output=False)
+    block_size = _BLOCK_SIZE.search(out)
+
+    if minimum is None or block_size is None:
+        raise Exception("Unable to estimate minimum size of: {0}".format(
+            device))
+
+    return int(minimum.group(1)) * int(block_size.group(1))
+
+
+def resize_root(ns, lv, current, target):
+    """
+    Resize the root volume and its filesystem, growing online and shrinking
+    offline.
+    """
+    if target == current:
+        return
+
+    root = "{0}/root".format(ns.volume_group)
+
+    if target > current:
+        log.info("Growing root to {0} bytes".format(target))
+        lvm("lvextend", "-L", "{0}b".format(target), root)
+
+        with mounted_device(lv["root"], ns.mountpoint):
+            resize2fs(lv["root"])
+
+        return
+
+    log.info("Shrinking root to {0} bytes".format(target))
+    check_filesystem(lv["root"])
+    resize2fs(lv["root"], "{0}K".format(target // 1024))
+    lvm("lvreduce", "-f", "-L", "{0}b".format(target), root)
+
+
+def create_swap(ns, size=None):
+    """
+    Create swap on the first free extents, of the given size or on all of
+    them.
+    """
+    if size is None:
+        lvm("lvcreate", "-l", "100%FREE", "-n", "swap", ns.volume_group)
+    else:
+        lvm("lvcreate", "-L", "{0}b".format(size), "-n", "swap",
+            ns.volume_group)
+
+    mkswap("-f", "/dev/mapper/{0}-swap".format(ns.volume_group))
+
+
+def used_pv_size(pv):
+    pe_start, allocated = lvm_values(
+        "pvs", "-o", "pe_start,pv_pe_alloc_count", pv)[0]
+    return int(pe_start), int(allocated)
+
+
+def grow(ns, size):
+    image_size = os.path.getsize(ns.image_path)
+
+    if size is not None and size < image_size:
+        raise Exception("Image is larger than {0} bytes, use --shrink to "
+                        "shrink it".format(size))
+
+    table, partition = find_physical_volume(ns.image_path)
+
+    if size is not None and size > image_size:
+        log.info("Extending image to {0} bytes".format(size))
+
+        with open(ns.image_path, "r+") as f:
+            f.truncate(size)
+
+        relocate_backup_gpt(ns.image_path, table)
+
+        end = size - TRAILER_SIZE
+
+        if end > partition["start"] + partition["size"]:
+            set_partition_end(ns.image_path, table, partition, end)
+
+    with mounted_loopback(ns.image_path) as devices:
+        for loop, partitions in devices.items():
+            lvm("pvresize", partitions[partition["number"] - 1])
+
+        with available_lvm(ns.volume_group) as lv:
+            check_ext(lv["root"])
+
+            sizes = volume_sizes(ns.volume_group)
+            free, extent_size = volume_group_state(ns.volume_group)
+
+            if ns.new_root_size is None:
+                target = sizes["root"] + free
+            else:
+                target = round_up(ns.new_root_size.size, extent_size)
+
+            if "swap" in sizes and ns.new_root_size is not None:
+                if target >= sizes["root"] + free + sizes["swap"]:
+                    raise Exception("No room left for swap with a root of "
+                                    "{0} bytes".format(target))
+
+                # swap takes what is left, like when created.
+                lvm("lvremove", "-f", "{0}/swap".format(ns.volume_group))
+                resize_root(ns, lv, sizes["root"], target)
+                create_swap(ns)
+            else:
+                if target > sizes["root"] + free:
+                    raise Exception("No room for a root of {0} bytes".format(
+                        target))
+
+                resize_root(ns, lv, sizes["root"], target)
+
+
+def shrink(ns):
+    # volumes after root would have to be moved to free the space.
+    if getattr(ns.preset, "custom_layout", False):
+        raise Exception("Images with a declared layout can not be shrunk")
+
+    table, partition = find_physical_volume(ns.image_path)
+
+    with mounted_loopback(ns.image_path) as devices:
+        pv = [partitions[partition["number"] - 1]
+              for partitions in devices.values()][0]
+
+        with available_lvm(ns.volume_group) as lv:
+            check_ext(lv["root"])
+
+            sizes = volume_sizes(ns.volume_group)
+            free, extent_size = volume_group_state(ns.volume_group)
+
+            check_filesystem(lv["root"])
+            target = round_up(
+                int(minimum_size(lv["root"]) * (1 + SHRINK_MARGIN)),
+                extent_size)
+
+            if target < sizes["root"]:
+                resize_root(ns, lv, sizes["root"], target)
+
+            # allocated extents must be contiguous from the start.
+            if "swap" in sizes:
+                lvm("lvremove", "-f", "{0}/swap".format(ns.volume_group))
+                create_swap(ns, sizes["swap"])
+
+            pe_start, allocated = used_pv_size(pv)
+            pv_size = pe_start + allocated * extent_size
+
+            lvm("pvresize", "--setphysicalvolumesize",
+                "{0}b".format(pv_size), pv)
+
+    end = partition["start"] + pv_size
+    set_partition_end(ns.image_path, table, partition, end)
+
+    size = end + TRAILER_SIZE
+    log.info("Truncating image to {0} bytes".format(size))
+
+    with open(ns.image_path, "r+") as f:
+        f.truncate(size)
+
+    relocate_backup_gpt(ns.image_path, table)
+
+
+def action(ns):
+    """
+    Grow or shrink an image in place.
+    """
+    if not os.path.isfile(ns.image_path):
+        raise Exception("No such file: {0}".format(ns.image_path))
+
+    # the pool would have to be resized along with root.
+    if has_thin_root(ns.image_path):
+        raise Exception("Resizing needs a flattened image")
+
+    if ns.shrink:
+        if ns.size is not None or ns.new_root_size is not None:
+            raise Exception("--shrink can not be combined with a size")
+
+        shrink(ns)
+        return 0
+
+    if ns.size is None and ns.new_root_size is None:
+        raise Exception("Nothing to do, specify --size, --root-volume or "
+                        "--shrink")
+
+    grow(ns, ns.size.size if ns.size is not None else None)
+    return 0
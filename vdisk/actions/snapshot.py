@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.helpers import available_lvm
+from vdisk.helpers import mounted_loopback
+from vdisk.snapshots import create_snapshot
+from vdisk.snapshots import drop_snapshot
+from vdisk.snapshots import flatten
+from vdisk.snapshots import has_thin_root
+from vdisk.snapshots import list_snapshots
+from vdisk.snapshots import restore_snapshot
+
+NEEDS_NAME = set(["restore", "drop"])
+
+
+def print_snapshots(snapshots):
+    if not snapshots:
+        print "no snapshots"
+        return
+
+    for snapshot in snapshots:
+        print "{0:<32} {1}  {2:>6}% of pool{3}".format(
+            snapshot["name"], snapshot["time"],
+            snapshot["data_percent"] or "-",
+            " (automatic)" if snapshot["automatic"] else "")
+
+
+def action(ns):
+    """
+    Manage snapshots of root in images with a thin layout.
+    """
+    if not has_thin_root(ns.image_path):
+        raise Exception("Not an image with a thin layout: {0}".format(
+            ns.image_path))
+
+    if ns.command in NEEDS_NAME and ns.name is None:
+        raise Exception("'{0}' needs the name of a snapshot".format(
+            ns.command))
+
+    if ns.command == "flatten":
+        flatten(ns.image_path, ns.volume_group)
+        return 0
+
+    with mounted_loopback(ns.image_path):
+        with available_lvm(ns.volume_group):
+            if ns.command == "list":
+                print_snapshots(list_snapshots(ns.volume_group))
+            elif ns.command == "create":
+                name = ns.name or "manual-{0}".format(
+                    time.strftime("%Y%m%d-%H%M%S"))
+                create_snapshot(ns.volume_group, name)
+            elif ns.command == "restore":
+                restore_snapshot(ns.volume_group, ns.name)
+            elif ns.command == "drop":
+                drop_snapshot(ns.volume_group, ns.name)
+
+    return 0
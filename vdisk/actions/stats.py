@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.stats import baseline
+from vdisk.stats import build_commands
+from vdisk.stats import build_resources
+from vdisk.stats import build_stages
+from vdisk.stats import connect
+from vdisk.stats import is_running
+from vdisk.stats import recent_builds
+from vdisk.stats import stage_history
+from vdisk.stats import stats_path
+from vdisk.sampler import format_summary
+
+
+def _seconds(value):
+    if value is None:
+        return "-"
+
+    return "{0:.1f}s".format(value)
+
+
+def _status(build):
+    if build["finished"] is None:
+        if is_running(build):
+            return "running"
+
+        return "aborted"
+
+    if build["success"]:
+        return "ok"
+
+    return "failed"
+
+
+def print_builds(builds):
+    print "builds:"
+
+    for build in builds:
+        duration = None
+
+        if build["finished"] is not None:
+            duration = build["finished"] - build["started"]
+
+        print "  #{0} {1} {2} {3} {4} ({5})".format(
+            build["id"],
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(build["started"])),
+            build["action"], _seconds(duration), _status(build),
+            os.path.basename(build["image"]))
+
+
+def print_trends(db, build, window):
+    """
+    Print the stages of a build against their history on the same host, and
+    of the same inputs if there is any.
+    """
+    print "stages of build #{0}:".format(build["id"])
+
+    resources = build_resources(db, build["id"])
+
+    for stage in build_stages(db, build["id"]):
+        history = stage_history(db, stage["name"], build, window=window)
+        recent = " ".join("{0:.1f}".format(d) for d in reversed(history))
+
+        print "  {0}: {1} (previous: {2})".format(
+            stage["name"], _seconds(stage["duration"]), recent or "-")
+
+        if stage["name"] in resources:
+            print "    {0}".format(format_summary(resources[stage["name"]]))
+
+    commands = build_commands(db, build["id"])
+
+    if commands:
+        print "commands of build #{0}:".format(build["id"])
+
+    for command in commands:
+        print "  {0}: {1} runs, {2}".format(
+            command["command"], command["count"],
+            _seconds(command["duration"]))
+
+
+def regressions(db, build, window, threshold, minimum):
+    """
+    Generate (stage, duration, baseline) for all stages of a build which took
+    more than threshold percent longer than their rolling baseline.
+    """
+    for stage in build_stages(db, build["id"]):
+        if stage["duration"] is None:
+            continue
+
+        expected = baseline(db, stage["name"], build, window=window)
+
+        if expected is None:
+            continue
+
+        if stage["duration"] - expected < minimum:
+            continue
+
+        if stage["duration"] > expected * (1 + threshold / 100.0):
+            yield stage["name"], stage["duration"], expected
+
+
+def print_running(db, build, window):
+    """
+    Print the estimated time left of the unfinished stages of a running
+    build.
+    """
+    print "running build #{0}:".format(build["id"])
+    now = time.time()
+
+    for stage in build_stages(db, build["id"]):
+        if stage["duration"] is not None:
+            continue
+
+        elapsed = now - stage["started"]
+        expected = baseline(db, stage["name"], build, window=window)
+
+        if expected is None:
+            eta = "no history"
+        elif expected > elapsed:
+            eta = "about {0} left".format(_seconds(expected - elapsed))
+        else:
+            eta = "{0} over the usual {1}".format(
+                _seconds(elapsed - expected), _seconds(expected))
+
+        print "  {0}: {1} elapsed, {2}".format(
+            stage["name"], _seconds(elapsed), eta)
+
+
+def action(ns):
+    """
+    Show the history of builds, regressions in the latest finished build and
+    estimates for builds in progress.
+    """
+    path = stats_path(ns)
+
+    if not os.path.isfile(path):
+        raise Exception("No build statistics: {0}".format(path))
+
+    db = connect(path)
+
+    try:
+        image = None
+
+        if not ns.all_images:
+            image = os.path.abspath(ns.image_path)
+
+        builds = recent_builds(db, image=image, limit=ns.builds)
+
+        if not builds:
+            log.info("No builds recorded")
+            return 0
+
+        print_builds(builds)
+
+        for build in builds:
+            if _status(build) == "running":
+                print_running(db, build, ns.window)
+
+        finished = [b for b in builds if b["finished"] is not None]
+
+        if not finished:
+            return 0
+
+        latest = finished[0]
+        print_trends(db, latest, ns.window)
+
+        found = list(regressions(db, latest, ns.window, ns.threshold,
+                                 ns.minimum))
+
+        for name, duration, expected in found:
+            log.warning("{0}: regressed, {1} against a baseline of "
+                        "{2}".format(name, _seconds(duration),
+                                     _seconds(expected)))
+
+        if found and ns.fail_on_regression:
+            return 1
+    finally:
+        db.close()
+
+    return 0
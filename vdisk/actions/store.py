@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.chunkstore import drop
+from vdisk.chunkstore import index_path
+from vdisk.chunkstore import list_images
+from vdisk.chunkstore import pull
+from vdisk.chunkstore import push
+from vdisk.chunkstore import read_index
+from vdisk.chunkstore import store_usage
+
+MB = float(2 ** 20)
+
+
+def print_images(store):
+    images = list_images(store)
+
+    if not images:
+        print "no images in {0}".format(store)
+
+    for name in images:
+        size, chunks = read_index(index_path(store, name))
+        data = sum(length for offset, length, digest in chunks)
+
+        print "{0:<40} {1:>10.1f}MB {2:>10.1f}MB data {3:>8} chunks".format(
+            name, size / MB, data / MB, len(chunks))
+
+    count, total = store_usage(store)
+    print "{0} chunks, {1:.1f}MB on disk".format(count, total / MB)
+
+
+def action(ns):
+    """
+    Push images to, and pull them from, a content addressed chunk store.
+    """
+    store = os.path.join(ns.root, ns.store)
+    name = ns.name or os.path.basename(ns.image_path)
+
+    if ns.command == "list":
+        print_images(store)
+        return 0
+
+    if ns.command == "push":
+        if not os.path.isfile(ns.image_path):
+            raise Exception("No such file: {0}".format(ns.image_path))
+
+        if not ns.force and os.path.isfile(index_path(store, name)):
+            raise Exception("Image already in store: {0}".format(name))
+
+        stats = push(store, name, ns.image_path, ns.compression, ns.jobs)
+
+        log.info("Pushed {0}: {1:.1f}MB of data in {2} chunks, {3} new "
+                 "chunks with {4:.1f}MB of data, {5:.1f}MB added to the "
+                 "store".format(name, stats["data"] / MB, stats["chunks"],
+                                stats["new_chunks"], stats["new_data"] / MB,
+                                stats["stored"] / MB))
+        return 0
+
+    if ns.command == "pull":
+        if not ns.force and os.path.exists(ns.image_path):
+            raise Exception("path already exists: {0}".format(ns.image_path))
+
+        written = pull(store, name, ns.image_path, ns.jobs)
+        log.info("Pulled {0}: {1:.1f}MB of data".format(name, written / MB))
+        return 0
+
+    if ns.command == "drop":
+        removed, freed = drop(store, name)
+        log.info("Dropped {0}: removed {1} chunks, {2:.1f}MB".format(
+            name, removed, freed / MB))
+        return 0
+
+    raise Exception("Unknown command: {0}".format(ns.command))
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import copy
+import shutil
+import logging
+import contextlib
+
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+from vdisk.actions.install import APTITUDE_ENV
+from vdisk.actions.install import configure_base_system
+from vdisk.actions.install import execute_chrooted
+from vdisk.actions.install import install_files
+from vdisk.actions.install import install_selections
+from vdisk.actions.install import setup_boot
+from vdisk.config import config_digest
+from vdisk.helpers import mount
+from vdisk.helpers import mounted_device
+from vdisk.helpers import submounts
+from vdisk.initramfs import update_initramfs
+from vdisk.stages import inherit
+from vdisk.stages import stage
+
+from vdisk.externalcommand import ExternalCommand
+
+chroot = ExternalCommand("chroot")
+cp = ExternalCommand("cp")
+
+# Mounts of the base system which are not part of its content.
+IGNORED_MOUNTS = set(["proc", "dev"])
+
+# Configuration which a variant may override.
+VARIANT_KEYS = ["manifest", "postinst"]
+
+
+def read_variants(ns):
+    variants = ns.config.get("variants")
+
+    if not variants:
+        raise Exception("No variants in configuration")
+
+    names = ns.names or sorted(variants)
+
+    for name in names:
+        if name not in variants:
+            raise Exception("No such variant: {0}".format(name))
+
+        selections = variants[name].get("selections")
+
+        if selections is None:
+            raise Exception("'selections' required for variant "
+                            "{0}".format(name))
+
+        if not os.path.isfile(os.path.join(ns.root, selections)):
+            raise Exception("Missing selections file: {0}".format(selections))
+
+    return [(name, variants[name]) for name in names]
+
+
+def variant_namespace(ns, name, variant):
+    """
+    Build the namespace used to install and flatten a single variant.
+    """
+    directory = os.path.join(ns.work_dir, name)
+
+    vns = copy.copy(ns)
+    vns.name = name
+    vns.directory = directory
+    vns.mountpoint = os.path.join(directory, "root")
+    vns.selections = os.path.join(ns.root, variant["selections"])
+    vns.image_path = os.path.join(ns.output, "{0}.img".format(name))
+    vns.volume_group = ns.variant_volume_group
+
+    vns.config = dict(ns.config)
+
+    for key in VARIANT_KEYS:
+        if key in variant:
+            vns.config[key] = variant[key]
+
+    vns.config_digest = config_digest(vns.config)
+    return vns
+
+
+def mounted_overlays(vns, lower, layers):
+    """
+    Mount an overlay for every mount of the base system, with the variant
+    specific upper and work directories.
+    """
+    mounts = []
+
+    for i, layer in enumerate(layers):
+        upper = os.path.join(vns.directory, "upper", str(i))
+        work = os.path.join(vns.directory, "work", str(i))
+
+        for path in (upper, work):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        options = "lowerdir={0},upperdir={1},workdir={2}".format(
+            os.path.join(lower, layer), upper, work)
+
+        mounts.append(mounted_device(
+            "overlay", os.path.join(vns.mountpoint, layer),
+            mount_type="overlay", mount_options=options))
+
+    return contextlib.nested(*mounts)
+
+
+def chroot_mounts(mountpoint):
+    return contextlib.nested(
+        mounted_device("null", os.path.join(mountpoint, "proc"),
+                       mount_type="proc"),
+        mounted_device("/dev", os.path.join(mountpoint, "dev"),
+                       mount_bind=True))
+
+
+def install_variant(vns, lower, layers):
+    log.info("{0}: Installing in {1}".format(vns.name, vns.mountpoint))
+
+    if os.path.isdir(vns.directory):
+        shutil.rmtree(vns.directory)
+
+    apt_env = dict(APTITUDE_ENV)
+
+    with stage("{0}/install".format(vns.name)):
+        with mounted_overlays(vns, lower, layers):
+            with chroot_mounts(vns.mountpoint):
+                install_selections(vns, apt_env, vns.mountpoint)
+                install_files(vns)
+
+    log.info("{0}: Installed".format(vns.name))
+
+
+def flatten_variant(vns, lower, layers, size):
+    """
+    Create the image of a variant with the layout of the preset, and copy the
+    merged tree of the variant into it.
+    """
+    merged = vns.mountpoint
+
+    fns = copy.copy(vns)
+    fns.mountpoint = os.path.join(vns.directory, "target")
+    fns.preset = vns.preset.__class__(fns)
+
+    log.info("{0}: Creating {1}".format(vns.name, fns.image_path))
+
+    with open(fns.image_path, "w") as f:
+        f.truncate(size)
+
+    fns.preset.setup_disks()
+
+    with mounted_overlays(vns, lower, layers):
+        with fns.preset.entered_system(mount_proc=False,
+                                       mount_dev=False) as d:
+            devices, logical_volumes, mountpoint = d
+
+            log.info("{0}: Copying {1} to {2}".format(
+                vns.name, merged, mountpoint))
+            cp("-a", "--sparse=always", merged + "/.", mountpoint + "/")
+
+            with chroot_mounts(mountpoint):
+                setup_boot(fns, devices, logical_volumes, mountpoint)
+                # grub.cfg of the base refers to its volume group.
+                chroot(mountpoint, "update-grub")
+                update_initramfs(fns, mountpoint)
+
+    if vns.finalize and hasattr(fns.preset, 'finalize'):
+        fns.preset.finalize()
+
+
+def action(ns):
+    """
+    Build several images which share a single base system.
+
+    The base image is configured once, every variant then installs its
+    selections into an overlay on top of the read-only base, and is finally
+    flattened into an image of its own.
+    """
+    if not os.path.isfile(ns.image_path):
+        raise Exception("Missing image file: {0}".format(ns.image_path))
+
+    if ns.variant_volume_group == ns.volume_group:
+        raise Exception("The volume group of the base image must differ "
+                        "from the variant volume group: {0}".format(
+                            ns.volume_group))
+
+    if ns.output is None:
+        ns.output = os.path.dirname(os.path.abspath(ns.image_path))
+
+    variants = [variant_namespace(ns, name, variant)
+                for name, variant in read_variants(ns)]
+
+    for vns in variants:
+        if not ns.force and os.path.exists(vns.image_path):
+            raise Exception("path already exists: {0}".format(
+                vns.image_path))
+
+    size = os.path.getsize(ns.image_path)
+
+    with ns.preset.entered_system() as d:
+        devices, logical_volumes, lower = d
+
+        if not ns.skip_base:
+            apt_env = dict(APTITUDE_ENV)
+
+            preinst = ns.config.get("preinst")
+
+            if preinst:
+                execute_chrooted(ns, preinst)
+
+            log.info("Configuring base system")
+
+            with stage("configure"):
+                configure_base_system(ns, apt_env, lower)
+
+        layers = [layer for layer in submounts(lower)
+                  if layer not in IGNORED_MOUNTS]
+
+        # overlays require their lower directories to stay untouched.
+        for layer in layers:
+            mount("-o", "remount,ro", os.path.join(lower, layer))
+
+        pool = ThreadPool(ns.jobs)
+
+        try:
+            install = inherit(
+                lambda vns: install_variant(vns, lower, layers))
+            pool.map(install, variants)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        # every image uses the same volume group name, so they can not be
+        # attached concurrently.
+        for vns in variants:
+            with stage("{0}/flatten".format(vns.name)):
+                flatten_variant(vns, lower, layers, size)
+
+    return 0
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import re
+import glob
+import time
+import hashlib
+import logging
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+DPKG_INFO = "var/lib/dpkg/info"
+DPKG_DIVERSIONS = "var/lib/dpkg/diversions"
+
+MISSING = "missing"
+MODIFIED = "modified"
+OK = "ok"
+
+HASH_BUFFER = 2 ** 20
+MAX_SYMLINKS = 40
+
+
+def resolve_in_root(root, path):
+    """
+    Resolve path as seen from inside of root, following symlinks in all but
+    the last component and keeping absolute links inside of root.
+    """
+    parts = [p for p in path.split("/") if p]
+    current = []
+    hops = 0
+
+    while parts:
+        part = parts.pop(0)
+
+        if part == ".":
+            continue
+
+        if part == "..":
+            if current:
+                current.pop()
+            continue
+
+        full = os.path.join(root, *(current + [part]))
+
+        if parts and os.path.islink(full):
+            hops += 1
+
+            if hops > MAX_SYMLINKS:
+                raise Exception("Too many levels of symlinks: {0}".format(
+                    path))
+
+            target = os.readlink(full)
+
+            if target.startswith("/"):
+                current = []
+
+            parts = [p for p in target.split("/") if p] + parts
+            continue
+
+        current.append(part)
+
+    return os.path.join(root, *current)
+
+
+def _check_file(task):
+    root, path, expected = task
+    full = resolve_in_root(root, path)
+
+    if not os.path.lexists(full):
+        return path, MISSING, 0
+
+    if os.path.islink(full) or not os.path.isfile(full):
+        return path, MODIFIED, 0
+
+    h = hashlib.md5()
+    size = 0
+
+    with open(full, "rb") as f:
+        while True:
+            data = f.read(HASH_BUFFER)
+
+            if not data:
+                break
+
+            h.update(data)
+            size += len(data)
+
+    if h.hexdigest() != expected:
+        return path, MODIFIED, size
+
+    return path, OK, size
+
+
+def read_diversions(root):
+    """
+    Read dpkg diversions as a dict of diverted path to a tuple of the
+    diverted-to path and the diverting package.
+    """
+    path = os.path.join(root, DPKG_DIVERSIONS)
+    diversions = dict()
+
+    if not os.path.isfile(path):
+        return diversions
+
+    with open(path) as f:
+        lines = [line.rstrip("\n") for line in f]
+
+    for i in range(0, len(lines) - 2, 3):
+        diversions[lines[i]] = (lines[i + 1], lines[i + 2])
+
+    return diversions
+
+
+def dpkg_checksums(root):
+    """
+    Generate (path, md5) tuples for all files registered in the dpkg
+    database of root, honoring diversions.
+    """
+    diversions = read_diversions(root)
+
+    for md5sums in sorted(glob.glob(os.path.join(root, DPKG_INFO,
+                                                 "*.md5sums"))):
+        package = os.path.basename(md5sums)[:-len(".md5sums")]
+        package = package.split(":")[0]
+
+        with open(md5sums) as f:
+            for line in f:
+                line = line.rstrip("\n")
+
+                if not line:
+                    continue
+
+                checksum, path = line.split(None, 1)
+                path = "/" + path.lstrip("/")
+
+                diversion = diversions.get(path)
+
+                if diversion is not None and diversion[1] != package:
+                    path = diversion[0]
+
+                yield path, checksum
+
+
+def manifest_checksums(ns, manifest):
+    """
+    Generate (path, md5) tuples for all files in the manifest, based on the
+    current content of their sources.
+    """
+    for item in manifest:
+        if item.get("type", "file") != "file":
+            continue
+
+        target = "/" + re.sub("^/", "", item["target"])
+        source = os.path.join(ns.root, item["source"])
+
+        with open(source, "rb") as f:
+            yield target, hashlib.md5(f.read()).hexdigest()
+
+
+def verify_tree(root, checksums, processes=None):
+    """
+    Verify checksums against the tree at root using a pool of processes.
+
+    Returns a dict with lists of missing and modified paths, and statistics
+    about the verification.
+    """
+    tasks = [(root, path, checksum) for path, checksum in checksums]
+    result = {MISSING: [], MODIFIED: [], "files": 0, "bytes": 0}
+
+    started = time.time()
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        for path, status, size in pool.imap_unordered(_check_file, tasks,
+                                                      chunksize=64):
+            result["files"] += 1
+            result["bytes"] += size
+
+            if status != OK:
+                result[status].append(path)
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    result["duration"] = time.time() - started
+    return result
+
+
+def action(ns):
+    """
+    Verify installed files against dpkg and manifest checksums.
+    """
+    if not os.path.isfile(ns.image_path):
+        raise Exception("No such file: {0}".format(ns.image_path))
+
+    with ns.preset.entered_system(mount_proc=False, mount_dev=False) as d:
+        devices, logical_volumes, mountpoint = d
+
+        checksums = list(dpkg_checksums(mountpoint))
+
+        manifest = ns.config.get("manifest")
+
+        if manifest:
+            checksums.extend(manifest_checksums(ns, manifest))
+
+        log.info("Verifying {0} files".format(len(checksums)))
+        result = verify_tree(mountpoint, checksums, processes=ns.jobs)
+
+    for path in sorted(result[MISSING]):
+        log.error("missing: {0}".format(path))
+
+    for path in sorted(result[MODIFIED]):
+        log.error("modified: {0}".format(path))
+
+    duration = max(result["duration"], 0.001)
+
+    log.info("Verified {0} files ({1:.1f} MB) in {2:.2f}s: "
+             "{3:.0f} files/s, {4:.1f} MB/s".format(
+                 result["files"], result["bytes"] / float(2 ** 20), duration,
+                 result["files"] / duration,
+                 result["bytes"] / float(2 ** 20) / duration))
+
+    if result[MISSING] or result[MODIFIED]:
+        log.error("{0} missing and {1} modified files".format(
+            len(result[MISSING]), len(result[MODIFIED])))
+        return 1
+
+    return 0
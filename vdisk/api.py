@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+A library interface to vdisk, for driving many builds from a single process.
+
+    from vdisk.api import Context
+
+    context = Context(root="/srv/images", cache_dir="/var/cache/vdisk")
+
+    with context.session("web.img", volume_group="VolWeb") as session:
+        session.create(size="8G")
+        session.bootstrap(engine="native")
+        session.install(selections="selections/web")
+
+    print context.session("web.img").inspect()["volume_groups"]
+
+Options are named like the command line options, with dashes replaced by
+underscores, and take the same values. Values given as strings are converted
+like on the command line, so both size="8G" and size=sizeunit("8G") work.
+Options of the context apply to all of its sessions, options of a session to
+all of its actions.
+
+The options of an action are keyword parameters of its method on Session,
+with the defaults of the command line. Any other keyword options are the
+global options, like preset or volume_group, and unknown ones are refused
+before anything is done.
+
+Actions return their exit code, and raise exceptions on failure, exactly like
+they do on the command line. Unlike the command line, nothing checks that the
+process runs as root.
+
+Images which are attached at the same time must use volume groups of their
+own, sessions of the same volume group are serialized. Read-only sessions, see
+Session.entered, are not. Every session mounts
+its image below a directory of its own in the mount point, unless a mount point
+is given explicitly.
+"""
+
+import os
+import argparse
+import threading
+import contextlib
+
+from vdisk import PRESETS
+from vdisk import create_preset
+from vdisk import run_action
+from vdisk import setup_argument_parser
+from vdisk.config import read_config
+from vdisk.imageinfo import inspect
+from vdisk.actions.info import inspect_system
+
+IGNORED_DESTS = set(["help", "version", argparse.SUPPRESS])
+
+
+def _parser_options(parser):
+    """
+    Read the defaults and conversions of all options of a parser.
+    """
+    defaults = dict()
+    types = dict()
+
+    for option in parser._actions:
+        if option.dest in IGNORED_DESTS:
+            continue
+
+        if isinstance(option, argparse._SubParsersAction):
+            continue
+
+        defaults[option.dest] = option.default
+
+        if option.type is not None:
+            types[option.dest] = option.type
+
+    defaults.update(parser._defaults)
+    return defaults, types
+
+
+def _action_parsers(parser):
+    for option in parser._actions:
+        if isinstance(option, argparse._SubParsersAction):
+            return option.choices
+
+    return dict()
+
+
+class Context(object):
+    """
+    Settings and state shared by many sessions.
+
+    Configurations are resolved once and then cached until any of their files
+    are modified.
+    """
+    def __init__(self, root=None, **options):
+        self.root = os.path.abspath(root or os.getcwd())
+        self.options = options
+        self.parser = setup_argument_parser()
+        self.lock = threading.Lock()
+        self.volume_groups = dict()
+
+        self.defaults, self.types = _parser_options(self.parser)
+        self.actions = dict(
+            (name, _parser_options(parser))
+            for name, parser in _action_parsers(self.parser).items())
+
+        for name in options:
+            if name not in self.defaults:
+                raise Exception("Unknown option: {0}".format(name))
+
+    def volume_group_lock(self, name):
+        with self.lock:
+            return self.volume_groups.setdefault(name, threading.RLock())
+
+    def namespace(self, image_path, action_name, *scopes, **options):
+        """
+        Build the namespace of an action, with the defaults of the command
+        line overridden by the options of all scopes and then by options.
+        """
+        if action_name not in self.actions:
+            raise Exception("No such action: {0}".format(action_name))
+
+        defaults, types = self.actions[action_name]
+
+        values = dict(self.defaults)
+        values.update(defaults)
+        values["root"] = self.root
+
+        converters = dict(self.types)
+        converters.update(types)
+
+        for scope in (self.options,) + scopes + (options,):
+            for name, value in scope.items():
+                if name not in values:
+                    if scope is options:
+                        raise Exception("Unknown option for {0}: {1}".format(
+                            action_name, name))
+
+                    continue
+
+                if name in converters and isinstance(value, basestring):
+                    value = converters[name](value)
+
+                values[name] = value
+
+        ns = argparse.Namespace(**values)
+        ns.image_path = image_path
+        ns.action_name = action_name
+
+        if ns.config is None:
+            ns.config = os.path.join(self.root, "vdisk.yaml")
+
+        ns.config, ns.config_digest = read_config(ns.config, ns.cache_dir)
+
+        if isinstance(ns.preset, basestring) and ns.preset not in PRESETS:
+            raise Exception("No such preset: {0}".format(ns.preset))
+
+        ns.preset = create_preset(ns)
+        return ns
+
+    def session(self, image_path, **options):
+        return Session(self, image_path, options)
+
+
+class Session(object):
+    """
+    Actions on a single image.
+
+    Used as a context manager, the volume group of the image is reserved
+    for the session as a whole instead of for every single action.
+    """
+    def __init__(self, context, image_path, options):
+        self.context = context
+        self.image_path = image_path
+        self.options = options
+
+        if "mountpoint" not in options and \
+                "mountpoint" not in context.options:
+            options["mountpoint"] = os.path.join(
+                context.defaults["mountpoint"], os.path.basename(image_path))
+
+        self.lock = context.volume_group_lock(
+            options.get("volume_group", context.options.get(
+                "volume_group", context.defaults["volume_group"])))
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+        return False
+
+    def namespace(self, action_name, **options):
+        return self.context.namespace(self.image_path, action_name,
+                                      self.options, **options)
+
+    def run(self, action_name, **options):
+        ns = self.namespace(action_name, **options)
+
+        with self.lock:
+            return run_action(ns, local=True)
+
+    @contextlib.contextmanager
+    def entered(self, read_only=False, **kw):
+        """
+        Attach and mount the image, for steps of your own.
+
+        Yields (devices, logical_volumes, mountpoint) like the presets. With
+        read_only set, the image is entered in a read-only session, which is
+        not serialized with other sessions.
+        """
+        preset = self.namespace("enter", read_only=read_only).preset
+
+        if read_only:
+            with preset.entered_system(**kw) as d:
+                yield d
+
+            return
+
+        with self.lock:
+            with preset.entered_system(**kw) as d:
+                yield d
+
+    def inspect(self, system=True):
+        """
+        Describe the image without mounting it, like the 'info' action.
+        """
+        info = inspect(self.image_path)
+
+        if system:
+            info["system"] = inspect_system(self.image_path, info)
+
+        return info
+
+    def _run(self, action_name, options, **arguments):
+        """
+        Run an action with its own arguments and global options. Arguments
+        which are None are left out, so that the options of the session or
+        the defaults of the command line apply, flags are off by default.
+        """
+        for name in options:
+            if name not in self.context.defaults:
+                raise Exception("Unknown option: {0}".format(name))
+
+        for name, value in arguments.items():
+            if value is not None:
+                options[name] = value
+
+        return self.run(action_name, **options)
+
+    def create(self, size=None, force=None, minimal_allocation=None,
+               auto_size=None, headroom=None, selections=None, suite=None,
+               arch=None, **options):
+        """
+        Create the image, like the 'create' action.
+
+        size defaults to 8G. With auto_size, the image is sized to fit
+        selections (default: selections/default) of suite (default: squeeze)
+        and arch (default: amd64) with headroom percent free (default: 25).
+        """
+        return self._run("create", options, size=size, force=force,
+                         minimal_allocation=minimal_allocation,
+                         auto_size=auto_size, headroom=headroom,
+                         selections=selections, suite=suite, arch=arch)
+
+    def bootstrap(self, suite=None, arch=None, engine=None, jobs=None,
+                  keyring=None, no_verify=None, keep_archives=None,
+                  **options):
+        """
+        Bootstrap a base system, like the 'bootstrap' action.
+
+        suite defaults to squeeze, arch to amd64 and engine to debootstrap.
+        jobs (default: one per cpu), keyring (default: the Debian archive
+        keyring), no_verify and keep_archives apply to the native engine.
+        """
+        return self._run("bootstrap", options, suite=suite, arch=arch,
+                         engine=engine, jobs=jobs, keyring=keyring,
+                         no_verify=no_verify, keep_archives=keep_archives)
+
+    def install(self, selections=None, download=None, repository=None,
+                defer_triggers=None, shrink_to_fit=None, resume=None,
+                **options):
+        """
+        Install packages and selections, like the 'install' action.
+
+        selections defaults to selections/default, repository to none.
+        """
+        return self._run("install", options, selections=selections,
+                         download=download, repository=repository,
+                         defer_triggers=defer_triggers,
+                         shrink_to_fit=shrink_to_fit, resume=resume)
+
+    def puppet(self, puppetpath, puppetargs, facts=None, top=None,
+               catalog_cache=None, read_only=None, **options):
+        """
+        Run puppet, like the 'puppet' action.
+
+        facts is a list of 'name=value', top defaults to 10.
+        """
+        return self._run("puppet", options, puppetpath=puppetpath,
+                         puppetargs=list(puppetargs), facts=facts, top=top,
+                         catalog_cache=catalog_cache, read_only=read_only)
+
+    def finalize(self, **options):
+        """
+        Finalize the image, like the 'finalize' action.
+        """
+        return self._run("finalize", options)
+
+    def verify(self, jobs=None, read_only=None, **options):
+        """
+        Verify the image, like the 'verify' action, with jobs hashing
+        processes (default: one per cpu).
+        """
+        return self._run("verify", options, jobs=jobs, read_only=read_only)
+
+    def variants(self, names=None, output=None, work_dir=None,
+                 variant_volume_group=None, jobs=None, skip_base=None,
+                 force=None, finalize=None, **options):
+        """
+        Build variants of the image, like the 'variants' action.
+
+        names defaults to all variants, output to the directory of the image,
+        work_dir to tmp/variants, variant_volume_group to VolGroup00 and jobs
+        to one per cpu.
+        """
+        return self._run("variants", options,
+                         names=list(names) if names is not None else None,
+                         output=output, work_dir=work_dir,
+                         variant_volume_group=variant_volume_group,
+                         jobs=jobs, skip_base=skip_base, force=force,
+                         finalize=finalize)
+
+    def delta(self, old_image, patch, block_size=None, compression=None,
+              jobs=None, force=None, **options):
+        """
+        Write a delta from old_image to patch, like the 'delta' action.
+
+        block_size defaults to 64K, compression to 6 and jobs to one per cpu.
+        """
+        return self._run("delta", options, old_image=old_image, patch=patch,
+                         block_size=block_size, compression=compression,
+                         jobs=jobs, force=force)
+
+    def apply(self, old_image, patch, jobs=None, force=None, **options):
+        """
+        Apply patch to old_image, like the 'apply' action, with jobs hashing
+        processes (default: one per cpu).
+        """
+        return self._run("apply", options, old_image=old_image, patch=patch,
+                         jobs=jobs, force=force)
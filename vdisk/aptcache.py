@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import shutil
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.events import output_handler
+from vdisk.externalcommand import ExternalCommand
+
+chroot = ExternalCommand("chroot")
+
+# Everything in an image which affects the result of 'apt-get update'.
+SOURCE_PATHS = [
+    "etc/apt/sources.list",
+    "etc/apt/sources.list.d",
+    "etc/apt/trusted.gpg",
+    "etc/apt/trusted.gpg.d",
+    "etc/apt/preferences",
+    "etc/apt/preferences.d",
+]
+
+LISTS_PATH = "var/lib/apt/lists"
+LISTS_IGNORED = set(["lock", "partial"])
+
+
+def _walk_files(root, path):
+    full = os.path.join(root, path)
+
+    if os.path.isfile(full):
+        yield path
+        return
+
+    if not os.path.isdir(full):
+        return
+
+    for name in sorted(os.listdir(full)):
+        for child in _walk_files(root, os.path.join(path, name)):
+            yield child
+
+
+def sources_digest(mountpoint):
+    """
+    Calculate a digest of the apt sources, keys and preferences in an image.
+    """
+    h = hashlib.sha1()
+
+    for path in SOURCE_PATHS:
+        for name in _walk_files(mountpoint, path):
+            h.update(name + "\0")
+
+            with open(os.path.join(mountpoint, name), "rb") as f:
+                h.update(f.read())
+
+            h.update("\0")
+
+    return h.hexdigest()
+
+
+def copy_lists(source, target):
+    """
+    Copy fetched index files, preserving their modification times.
+    """
+    if not os.path.isdir(target):
+        os.makedirs(target)
+
+    for name in os.listdir(source):
+        path = os.path.join(source, name)
+
+        if name in LISTS_IGNORED or not os.path.isfile(path):
+            continue
+
+        shutil.copy2(path, os.path.join(target, name))
+
+
+def store_lists(mountpoint, cached):
+    temporary = cached + ".tmp"
+
+    if os.path.isdir(temporary):
+        shutil.rmtree(temporary)
+
+    copy_lists(os.path.join(mountpoint, LISTS_PATH), temporary)
+
+    if os.path.isdir(cached):
+        shutil.rmtree(cached)
+
+    os.rename(temporary, cached)
+
+
+def update_apt(ns, apt_env, mountpoint, previous=None):
+    """
+    Run 'apt-get update' unless the sources are unchanged since previous.
+
+    Index files are cached on the host keyed by the digest of the sources.
+    Cached indexes are put in place before updating, which makes apt only
+    issue conditional requests for them and download what actually changed.
+
+    Returns the digest of the sources, to be passed in as previous for
+    subsequent updates.
+    """
+    digest = sources_digest(mountpoint)
+
+    if digest == previous:
+        log.info("Apt sources unchanged, skipping update")
+        return digest
+
+    cached = os.path.join(ns.cache_dir, "apt-lists", digest)
+    lists = os.path.join(mountpoint, LISTS_PATH)
+
+    if os.path.isdir(cached):
+        log.info("Restoring cached apt lists: {0}".format(cached))
+        copy_lists(cached, lists)
+
+    log.info("Updating apt")
+    chroot(mountpoint, ns.apt_get, "-y", "update", env=apt_env,
+           output_handler=output_handler())
+
+    store_lists(mountpoint, cached)
+    return digest
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Reading and writing of debian control files, .deb archives and flat apt
+repositories.
+"""
+
+import os
+import gzip
+import glob
+import time
+import hashlib
+import tarfile
+import logging
+import StringIO
+
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+from vdisk.externalcommand import ExternalCommand
+
+dpkg_deb = ExternalCommand("dpkg-deb")
+
+AR_MAGIC = "!<arch>\n"
+AR_HEADER_SIZE = 60
+
+# Fields which lead a Packages stanza, in this order.
+LEADING_FIELDS = ["Package", "Version", "Architecture"]
+
+CHECKSUMS = [
+    ("MD5Sum", "MD5sum", hashlib.md5),
+    ("SHA1", "SHA1", hashlib.sha1),
+    ("SHA256", "SHA256", hashlib.sha256),
+]
+
+
+def parse_stanza(text):
+    """
+    Parse a single deb822 stanza into an ordered dict.
+    """
+    fields = OrderedDict()
+    field = None
+
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+
+        if line[0] in " \t":
+            if field is None:
+                raise Exception("Continuation line without field: "
+                                "{0!r}".format(line))
+
+            fields[field] += "\n" + line
+            continue
+
+        field, value = line.split(":", 1)
+        fields[field] = value.strip()
+
+    return fields
+
+
+def iter_stanzas(lines):
+    """
+    Generate ordered dicts for all stanzas in an iterable of lines, like a
+    Packages or status file.
+    """
+    stanza = []
+
+    for line in lines:
+        if line.strip():
+            stanza.append(line.rstrip("\n"))
+            continue
+
+        if stanza:
+            yield parse_stanza("\n".join(stanza))
+            stanza = []
+
+    if stanza:
+        yield parse_stanza("\n".join(stanza))
+
+
+def format_stanza(fields):
+    return "".join("{0}: {1}\n".format(k, v) for k, v in fields.items())
+
+
+def _ar_members(f):
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise Exception("Not a debian archive: {0}".format(f.name))
+
+    while True:
+        header = f.read(AR_HEADER_SIZE)
+
+        if len(header) < AR_HEADER_SIZE:
+            return
+
+        name = header[0:16].strip().rstrip("/")
+        size = int(header[48:58])
+
+        yield name, size
+
+        # members are padded to an even size.
+        f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def read_deb_control(path):
+    """
+    Read the control file of a .deb.
+
+    Control members compressed with anything python can not read natively are
+    handed to dpkg-deb.
+    """
+    with open(path, "rb") as f:
+        for name, size in _ar_members(f):
+            if not name.startswith("control.tar"):
+                continue
+
+            if name not in ("control.tar", "control.tar.gz",
+                            "control.tar.bz2"):
+                break
+
+            member = StringIO.StringIO(f.read(size))
+            tar = tarfile.open(fileobj=member, mode="r:*")
+
+            try:
+                for info in tar:
+                    if info.name.lstrip("./") == "control":
+                        return parse_stanza(tar.extractfile(info).read())
+            finally:
+                tar.close()
+
+            raise Exception("No control file in: {0}".format(path))
+
+    exitcode, out, err = dpkg_deb("--field", path,
+                                  capture=True, split_output=False)
+    return parse_stanza(out)
+
+
+def file_checksums(path):
+    """
+    Calculate size and the checksums used in apt indexes for a file.
+    """
+    hashes = [(name, h()) for name, field, h in CHECKSUMS]
+    size = 0
+
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(2 ** 20)
+
+            if not data:
+                break
+
+            size += len(data)
+
+            for name, h in hashes:
+                h.update(data)
+
+    return size, OrderedDict((name, h.hexdigest()) for name, h in hashes)
+
+
+def package_stanza(path, filename):
+    control = read_deb_control(path)
+    size, checksums = file_checksums(path)
+
+    fields = OrderedDict()
+
+    for name in LEADING_FIELDS:
+        if name in control:
+            fields[name] = control.pop(name)
+
+    fields.update(control)
+    fields["Filename"] = filename
+    fields["Size"] = size
+
+    for name, field, h in CHECKSUMS:
+        fields[field] = checksums[name]
+
+    return fields
+
+
+def write_packages(path, stanzas):
+    """
+    Write an uncompressed and a gzipped Packages index.
+    """
+    content = "\n".join(format_stanza(s) for s in stanzas)
+
+    with open(os.path.join(path, "Packages"), "w") as f:
+        f.write(content)
+
+    gz = gzip.GzipFile(os.path.join(path, "Packages.gz"), "wb", mtime=0)
+
+    try:
+        gz.write(content)
+    finally:
+        gz.close()
+
+
+def write_release(path, indexes):
+    """
+    Write a Release file for the specified index files in path.
+    """
+    sums = [(name, []) for name, field, h in CHECKSUMS]
+
+    for index in indexes:
+        size, checksums = file_checksums(os.path.join(path, index))
+
+        for name, lines in sums:
+            lines.append(" {0} {1} {2}".format(checksums[name], size, index))
+
+    date = time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime())
+
+    with open(os.path.join(path, "Release"), "w") as f:
+        print >>f, "Origin: vdisk"
+        print >>f, "Label: vdisk"
+        print >>f, "Date: {0}".format(date)
+
+        for name, lines in sums:
+            print >>f, "{0}:".format(name)
+
+            for line in lines:
+                print >>f, line
+
+
+def build_repository(path):
+    """
+    Generate the Packages and Release indexes of a flat repository containing
+    the .deb files in path.
+
+    The repository is used with a 'deb file:<path> ./' source.
+    """
+    debs = sorted(glob.glob(os.path.join(path, "*.deb")))
+
+    log.info("Indexing {0} packages in {1}".format(len(debs), path))
+
+    stanzas = [package_stanza(deb, "./" + os.path.basename(deb))
+               for deb in debs]
+
+    write_packages(path, stanzas)
+    write_release(path, ["Packages", "Packages.gz"])
+    return len(stanzas)
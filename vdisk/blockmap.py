@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import errno
+import hashlib
+import logging
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+# Not exposed by the os module in python 2, values are the same on all
+# platforms supporting them (linux >= 3.1).
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+# number of blocks hashed by a single worker task.
+BLOCKS_PER_TASK = 256
+
+
+def data_extents(path):
+    """
+    Generate (offset, length) tuples for all data extents in path.
+
+    Holes are skipped using SEEK_DATA/SEEK_HOLE, if the filesystem does not
+    support these the whole file is treated as a single data extent.
+    """
+    size = os.path.getsize(path)
+
+    if size == 0:
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+
+    try:
+        offset = 0
+
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # no more data after offset.
+                    return
+
+                if e.errno == errno.EINVAL and offset == 0:
+                    log.warning("{0}: SEEK_DATA not supported, reading "
+                                "whole file".format(path))
+                    yield 0, size
+                    return
+
+                raise
+
+            end = os.lseek(fd, start, SEEK_HOLE)
+            yield start, end - start
+            offset = end
+    finally:
+        os.close(fd)
+
+
+def allocated_size(path):
+    """
+    Return a tuple of apparent and allocated size in bytes for path.
+    """
+    st = os.stat(path)
+    return st.st_size, st.st_blocks * 512
+
+
+def aligned_blocks(extents, block_size):
+    """
+    Align the specified extents to block_size and generate the offset of every
+    block touched by them, in order and without duplicates.
+    """
+    last = None
+
+    for offset, length in extents:
+        first = offset - offset % block_size
+
+        for block in xrange(first, offset + length, block_size):
+            if block == last:
+                continue
+
+            last = block
+            yield block
+
+
+def _hash_blocks(task):
+    path, block_size, offsets = task
+    result = []
+    zero = "\0" * block_size
+
+    with open(path, "rb") as f:
+        for offset in offsets:
+            f.seek(offset)
+            data = f.read(block_size)
+
+            if not data or data == zero[:len(data)]:
+                continue
+
+            result.append((offset, hashlib.sha1(data).hexdigest()))
+
+    return result
+
+
+def _chunked(iterable, size):
+    chunk = []
+
+    for item in iterable:
+        chunk.append(item)
+
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def block_digests(path, block_size=DEFAULT_BLOCK_SIZE, offsets=None,
+                  processes=None):
+    """
+    Hash all non-zero blocks of path in parallel.
+
+    Returns a dict mapping block offset to sha1 hex digest, blocks that are
+    holes or only contain zeroes are omitted.
+    """
+    if offsets is None:
+        offsets = aligned_blocks(data_extents(path), block_size)
+
+    tasks = ((path, block_size, chunk)
+             for chunk in _chunked(offsets, BLOCKS_PER_TASK))
+
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        digests = dict()
+
+        for result in pool.imap_unordered(_hash_blocks, tasks):
+            digests.update(result)
+
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return digests
+
+
+def content_digest(digests):
+    """
+    Calculate a digest for the content of an image from its block digests.
+
+    Holes and zero blocks do not contribute, which makes the digest
+    independent of how sparse the image is.
+    """
+    h = hashlib.sha1()
+
+    for offset in sorted(digests):
+        h.update("{0}:{1}\n".format(offset, digests[offset]))
+
+    return h.hexdigest()
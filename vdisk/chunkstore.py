@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+A content addressed store of image chunks, shared by many images.
+
+Images are split into chunks at boundaries defined by their content, so that
+data which is equal in two images ends up in equal chunks even when it is
+found at different offsets. Boundaries are placed after 4K blocks whose crc32
+matches a mask, which suits filesystems aligning their data to blocks. Holes
+and blocks of zeroes are never stored.
+
+Chunks are stored compressed below chunks/, named by their sha1. Images are
+stored as an index below images/, listing the offset, length and digest of
+every chunk.
+"""
+
+import os
+import zlib
+import fcntl
+import hashlib
+import logging
+import contextlib
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+from vdisk.blockmap import data_extents
+
+BLOCK_SIZE = 4096
+
+# A boundary after 1 in 64 blocks makes chunks of 256K on average.
+BOUNDARY_MASK = 63
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
+
+# Images are chunked in parallel, in segments at fixed offsets which always
+# end a chunk.
+SEGMENT_SIZE = 64 * 2 ** 20
+
+# Number of chunks restored by a single worker task.
+CHUNKS_PER_TASK = 64
+
+INDEX_MAGIC = "VDISKINDEX 1"
+
+_ZERO = "\0" * BLOCK_SIZE
+
+
+def chunk_path(store, digest):
+    return os.path.join(store, "chunks", digest[:2], digest[2:])
+
+
+def index_path(store, name):
+    if not name or "/" in name or name.startswith("."):
+        raise Exception("Invalid image name: {0!r}".format(name))
+
+    return os.path.join(store, "images", name)
+
+
+@contextlib.contextmanager
+def locked(store, exclusive=False):
+    """
+    Lock the store, shared while adding to it and exclusively while removing
+    from it.
+    """
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    with open(os.path.join(store, "lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def segments(extents, size=SEGMENT_SIZE):
+    """
+    Split extents at every multiple of size, and group them by the segment
+    they are in.
+    """
+    current = None
+    group = []
+
+    for offset, length in extents:
+        end = offset + length
+
+        while offset < end:
+            segment = offset // size
+            piece = min(end, (segment + 1) * size) - offset
+
+            if segment != current and group:
+                yield group
+                group = []
+
+            current = segment
+            group.append((offset, piece))
+            offset += piece
+
+    if group:
+        yield group
+
+
+def split_chunks(f, ranges):
+    """
+    Generate (offset, data) for all chunks of the data in ranges of f.
+    """
+    for offset, length in ranges:
+        # extents of filesystems are aligned to blocks, except for the end of
+        # the file.
+        end = offset + length
+        position = offset - offset % BLOCK_SIZE
+        f.seek(position)
+
+        start = position
+        parts = []
+        size = 0
+
+        while position < end:
+            block = f.read(min(BLOCK_SIZE, end - position))
+
+            if not block:
+                break
+
+            if block == _ZERO[:len(block)]:
+                if parts:
+                    yield start, "".join(parts)
+                    parts = []
+                    size = 0
+
+                position += len(block)
+                continue
+
+            if not parts:
+                start = position
+
+            parts.append(block)
+            size += len(block)
+            position += len(block)
+
+            if size >= MAX_CHUNK or size >= MIN_CHUNK and \
+                    zlib.crc32(block) & BOUNDARY_MASK == 0:
+                yield start, "".join(parts)
+                parts = []
+                size = 0
+
+        if parts:
+            yield start, "".join(parts)
+
+
+def store_chunk(store, digest, data, level):
+    """
+    Store a chunk unless it already is, returning the number of bytes added
+    to the store.
+    """
+    path = chunk_path(store, digest)
+
+    if os.path.isfile(path):
+        return 0
+
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    temporary = "{0}.{1}.tmp".format(path, os.getpid())
+    compressed = zlib.compress(data, level)
+
+    with open(temporary, "wb") as f:
+        f.write(compressed)
+
+    os.rename(temporary, path)
+    return len(compressed)
+
+
+def read_chunk(store, digest):
+    with open(chunk_path(store, digest), "rb") as f:
+        data = zlib.decompress(f.read())
+
+    if hashlib.sha1(data).hexdigest() != digest:
+        raise Exception("Corrupt chunk: {0}".format(digest))
+
+    return data
+
+
+def _push_segment(task):
+    path, store, ranges, level = task
+    result = []
+
+    with open(path, "rb") as f:
+        for offset, data in split_chunks(f, ranges):
+            digest = hashlib.sha1(data).hexdigest()
+            added = store_chunk(store, digest, data, level)
+            result.append((offset, len(data), digest, added))
+
+    return result
+
+
+def _pull_chunks(task):
+    path, store, entries = task
+    written = 0
+
+    with open(path, "r+b") as f:
+        for offset, length, digest in entries:
+            data = read_chunk(store, digest)
+
+            if len(data) != length:
+                raise Exception("Chunk {0} has the wrong length".format(
+                    digest))
+
+            f.seek(offset)
+            f.write(data)
+            written += length
+
+    return written
+
+
+def _run(function, tasks, processes):
+    pool = multiprocessing.Pool(processes)
+
+    try:
+        results = list(pool.imap_unordered(function, tasks))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
+
+
+def write_index(path, size, chunks):
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(path + ".tmp", "w") as f:
+        print >>f, INDEX_MAGIC
+        print >>f, "size", size
+
+        for offset, length, digest in chunks:
+            print >>f, offset, length, digest
+
+    os.rename(path + ".tmp", path)
+
+
+def read_index(path):
+    """
+    Read an index, returning the size of the image and its chunks.
+    """
+    if not os.path.isfile(path):
+        raise Exception("No such image in store: {0}".format(
+            os.path.basename(path)))
+
+    with open(path) as f:
+        if f.readline().rstrip("\n") != INDEX_MAGIC:
+            raise Exception("Not a vdisk index: {0}".format(path))
+
+        size = int(f.readline().split()[1])
+        chunks = []
+
+        for line in f:
+            offset, length, digest = line.split()
+            chunks.append((int(offset), int(length), digest))
+
+    return size, chunks
+
+
+def push(store, name, path, level=6, processes=None):
+    """
+    Add an image to the store, returning a dict of statistics.
+    """
+    size = os.path.getsize(path)
+
+    tasks = ((path, store, group, level)
+             for group in segments(data_extents(path)))
+
+    with locked(store):
+        results = _run(_push_segment, tasks, processes)
+
+        chunks = sorted((offset, length, digest)
+                        for result in results
+                        for offset, length, digest, added in result)
+
+        write_index(index_path(store, name), size, chunks)
+
+    added = [entry for result in results for entry in result if entry[3]]
+
+    return {
+        "size": size,
+        "data": sum(length for offset, length, digest in chunks),
+        "chunks": len(chunks),
+        "new_chunks": len(added),
+        "new_data": sum(entry[1] for entry in added),
+        "stored": sum(entry[3] for entry in added),
+    }
+
+
+def pull(store, name, path, processes=None):
+    """
+    Write an image from the store to path, as a sparse file.
+
+    Returns the number of bytes written.
+    """
+    with locked(store):
+        size, chunks = read_index(index_path(store, name))
+
+        with open(path, "wb") as f:
+            f.truncate(size)
+
+        tasks = ((path, store, chunks[i:i + CHUNKS_PER_TASK])
+                 for i in xrange(0, len(chunks), CHUNKS_PER_TASK))
+
+        return sum(_run(_pull_chunks, tasks, processes))
+
+
+def list_images(store):
+    directory = os.path.join(store, "images")
+
+    if not os.path.isdir(directory):
+        return []
+
+    return sorted(name for name in os.listdir(directory)
+                  if not name.endswith(".tmp"))
+
+
+def drop(store, name):
+    """
+    Remove an image from the store, and all chunks no other image uses.
+
+    Returns the number of chunks and bytes removed.
+    """
+    with locked(store, exclusive=True):
+        os.unlink(index_path(store, name))
+
+        used = set()
+
+        for other in list_images(store):
+            size, chunks = read_index(index_path(store, other))
+            used.update(digest for offset, length, digest in chunks)
+
+        removed = 0
+        freed = 0
+
+        for directory, dirs, files in os.walk(os.path.join(store, "chunks")):
+            for filename in files:
+                digest = os.path.basename(directory) + filename
+
+                if digest in used:
+                    continue
+
+                path = os.path.join(directory, filename)
+                freed += os.path.getsize(path)
+                os.unlink(path)
+                removed += 1
+
+    return removed, freed
+
+
+def store_usage(store):
+    """
+    Return the number of chunks in the store and their size on disk.
+    """
+    count = 0
+    total = 0
+
+    for directory, dirs, files in os.walk(os.path.join(store, "chunks")):
+        for filename in files:
+            count += 1
+            total += os.path.getsize(os.path.join(directory, filename))
+
+    return count, total
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Reading and resolving vdisk.yaml.
+
+A configuration can be based on others, given by 'extends' and 'include'
+relative to the file naming them:
+
+    extends: ../base/vdisk.yaml
+    include:
+        - monitoring.yaml
+
+Bases are merged in that order, with the configuration itself merged last.
+Dicts of the merged keys are merged recursively, and lists are appended to,
+where manifest entries replace earlier entries of the same target. All other
+keys are replaced as a whole.
+
+Resolved configurations are cached in the cache directory, and stay valid for
+as long as none of the files they were resolved from have changed.
+"""
+
+import os
+import errno
+import hashlib
+import logging
+import cPickle
+import threading
+
+import yaml
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+log = logging.getLogger(__name__)
+
+from vdisk.journal import input_digest
+
+MERGED_KEYS = set(["packages", "pre-packages", "manifest", "postinst",
+                   "sources"])
+
+CACHE_DIR = "configs"
+CACHE_VERSION = 1
+
+_memory = dict()
+_memory_lock = threading.Lock()
+
+
+def config_digest(config):
+    """
+    Calculate a digest of a resolved configuration, or of a part of one,
+    suitable as a cache key.
+    """
+    return input_digest(config)
+
+
+def _paths(value):
+    if value is None:
+        return []
+
+    if isinstance(value, basestring):
+        return [value]
+
+    return list(value)
+
+
+def merge_lists(base, override):
+    targets = set(item["target"] for item in override
+                  if isinstance(item, dict) and "target" in item)
+
+    result = [item for item in base
+              if not isinstance(item, dict) or
+              item.get("target") not in targets]
+
+    for item in override:
+        if item not in result:
+            result.append(item)
+
+    return result
+
+
+def merge(base, override):
+    """
+    Deep merge two values of a merged key.
+    """
+    if isinstance(base, dict) and isinstance(override, dict):
+        result = dict(base)
+
+        for key, value in override.items():
+            if key in result:
+                value = merge(result[key], value)
+
+            result[key] = value
+
+        return result
+
+    if isinstance(base, list) and isinstance(override, list):
+        return merge_lists(base, override)
+
+    return override
+
+
+def merge_config(base, override):
+    result = dict(base)
+
+    for key, value in override.items():
+        if key in MERGED_KEYS and result.get(key) is not None:
+            value = merge(result[key], value)
+
+        result[key] = value
+
+    return result
+
+
+def _load(path, files):
+    """
+    Load a single file, recording its modification time, size and digest.
+    """
+    try:
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            raise Exception("Missing configuration: {0}".format(path))
+
+        raise
+
+    files.append((path, st.st_mtime, st.st_size,
+                  hashlib.sha1(data).hexdigest()))
+
+    config = yaml.load(data, Loader=Loader)
+
+    if config is None:
+        return dict()
+
+    if not isinstance(config, dict):
+        raise Exception("Configuration is not a mapping: {0}".format(path))
+
+    return config
+
+
+def resolve(path, files, parents=()):
+    """
+    Resolve a configuration and all of its bases, recording every file read
+    in files.
+    """
+    path = os.path.abspath(path)
+
+    if path in parents:
+        raise Exception("Configuration includes itself: {0}".format(path))
+
+    config = _load(path, files)
+    directory = os.path.dirname(path)
+
+    bases = _paths(config.pop("extends", None)) + \
+        _paths(config.pop("include", None))
+
+    result = dict()
+
+    for base in bases:
+        result = merge_config(result, resolve(
+            os.path.join(directory, base), files, parents + (path,)))
+
+    return merge_config(result, config)
+
+
+def is_current(files):
+    """
+    Check that none of the files has changed, comparing digests only of those
+    which were touched.
+    """
+    for path, mtime, size, digest in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+
+        if st.st_mtime == mtime and st.st_size == size:
+            continue
+
+        with open(path, "rb") as f:
+            if hashlib.sha1(f.read()).hexdigest() != digest:
+                return False
+
+    return True
+
+
+def _cache_path(cache_dir, path):
+    return os.path.join(cache_dir, CACHE_DIR,
+                        hashlib.sha1(path).hexdigest())
+
+
+def _read_cached(cache_path):
+    if not os.path.isfile(cache_path):
+        return None
+
+    try:
+        with open(cache_path, "rb") as f:
+            entry = cPickle.load(f)
+    except Exception, e:
+        log.warning("Ignoring broken config cache: {0}: {1}".format(
+            cache_path, e))
+        return None
+
+    if entry.get("version") != CACHE_VERSION:
+        return None
+
+    return entry
+
+
+def _write_cached(cache_path, entry):
+    directory = os.path.dirname(cache_path)
+
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        temporary = "{0}.{1}.tmp".format(cache_path, os.getpid())
+
+        with open(temporary, "wb") as f:
+            cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+
+        os.rename(temporary, cache_path)
+    except (IOError, OSError), e:
+        log.warning("Unable to cache config: {0}".format(e))
+
+
+def read_config(path, cache_dir=None):
+    """
+    Read and resolve a configuration, returning it together with its digest.
+
+    Resolved configurations are kept in memory, and in the cache directory
+    if one is given.
+    """
+    path = os.path.abspath(path)
+
+    with _memory_lock:
+        entry = _memory.get(path)
+
+    if entry is not None and is_current(entry["files"]):
+        return entry["config"], entry["digest"]
+
+    entry = None
+    cache_path = None
+
+    if cache_dir is not None:
+        cache_path = _cache_path(cache_dir, path)
+        entry = _read_cached(cache_path)
+
+        if entry is not None and not is_current(entry["files"]):
+            entry = None
+
+    if entry is None:
+        files = []
+        config = resolve(path, files)
+
+        entry = {
+            "version": CACHE_VERSION,
+            "files": files,
+            "config": config,
+            "digest": config_digest(config),
+        }
+
+        if cache_path is not None:
+            _write_cached(cache_path, entry)
+
+    with _memory_lock:
+        _memory[path] = entry
+
+    return entry["config"], entry["digest"]
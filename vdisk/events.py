@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+A stream of build events as JSON lines, for orchestrators following builds.
+
+Every line is an object with the name of the event, the time it happened and
+the pid of vdisk, and the data of the event:
+
+    action-started       action, image
+    action-finished      action, image, success, duration
+    stage-started        stage
+    stage-finished       stage, success, duration
+    command-started      stage, args
+    command-finished     stage, args, exitcode, duration
+    downloaded           source, bytes, total_bytes
+    package-installed    package, total_packages
+    teardown-started     image
+    teardown-finished    image, success, duration
+
+Downloads and installed packages are followed in the output of apt-get and
+dpkg, which is passed through to stdout while a stream is open.
+"""
+
+import os
+import re
+import json
+import time
+import socket
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+from vdisk.stages import notify
+
+_APT_GET = re.compile(r"^Get:\d+ (.*) \[([\d.,]+) ([kMG]?B)\]$")
+_SETTING_UP = re.compile(r"^Setting up ([^\s:]+)(?::\S+)? ")
+
+UNITS = {"B": 1, "kB": 1000, "MB": 1000 ** 2, "GB": 1000 ** 3}
+
+# Streams which are currently open.
+_streams = []
+
+
+def open_stream(target):
+    """
+    Open the target of an event stream, which is either 'fd:<number>',
+    'unix:<path>' of a listening stream socket, or the path of a file which
+    is appended to.
+    """
+    # the descriptor is duplicated, so that it outlives the stream.
+    if target.startswith("fd:"):
+        return os.fdopen(os.dup(int(target[3:])), "w")
+
+    if target.startswith("unix:"):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(target[5:])
+        return s.makefile("w")
+
+    return open(target, "a")
+
+
+def follow_output(line):
+    """
+    Notify downloads and installed packages found in a line of output from
+    apt-get or dpkg.
+    """
+    line = line.rstrip()
+    m = _APT_GET.match(line)
+
+    if m:
+        size = float(m.group(2).replace(",", ""))
+        notify("downloaded", source=m.group(1),
+               bytes=int(size * UNITS[m.group(3)]))
+        return
+
+    m = _SETTING_UP.match(line)
+
+    if m:
+        notify("package-installed", package=m.group(1))
+
+
+def output_handler():
+    """
+    The handler of apt-get and dpkg output, if any event stream is open.
+    """
+    if _streams:
+        return follow_output
+
+    return None
+
+
+class EventStream(object):
+    """
+    Event listener writing every event as a line of JSON, with running totals
+    of the bytes downloaded and the packages installed.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.total_packages = 0
+        _streams.append(self)
+
+    def __call__(self, event, data):
+        record = dict(data)
+        record["event"] = event
+        record["time"] = time.time()
+        record["pid"] = os.getpid()
+
+        with self.lock:
+            if event == "downloaded":
+                self.total_bytes += data["bytes"]
+                record["total_bytes"] = self.total_bytes
+            elif event == "package-installed":
+                self.total_packages += 1
+                record["total_packages"] = self.total_packages
+
+            self.f.write(json.dumps(record, sort_keys=True, default=str))
+            self.f.write("\n")
+            self.f.flush()
+
+    def close(self):
+        if self in _streams:
+            _streams.remove(self)
+
+        with self.lock:
+            try:
+                self.f.close()
+            except (IOError, socket.error), e:
+                log.warning("Failed to close event stream: {0}".format(e))
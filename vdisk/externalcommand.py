@@ -15,8 +15,13 @@
 
 import logging
 import os
+import sys
+import time
 import subprocess as sp
 
+from vdisk.stages import current_stage
+from vdisk.stages import notify
+
 log = logging.getLogger(__name__)
 
 
@@ -60,6 +65,7 @@ class ExternalCommand(object):
         remove_empty = opts.get("remove_empty", False)
         env = opts.get("env")
         input_fd = opts.get("input_fd")
+        output_handler = opts.get("output_handler")
 
         args = [self.binary] + map(str, args)
 
@@ -78,11 +84,19 @@ class ExternalCommand(object):
         if capture:
             kwargs["stdout"] = sp.PIPE
             kwargs["stderr"] = sp.PIPE
+        elif output_handler:
+            kwargs["stdout"] = sp.PIPE
+
+        stage = current_stage()
+        notify("command-started", stage=stage, args=args)
+        started = time.time()
 
         try:
             p = sp.Popen(args, **kwargs)
         except Exception:
             log.error("Exception thrown when executing: %s" % " ".join(args))
+            notify("command-finished", stage=stage, args=args, exitcode=None,
+                   duration=time.time() - started)
             raise
 
         if capture:
@@ -90,8 +104,20 @@ class ExternalCommand(object):
         else:
             stdout, stderr = (None, None)
 
+        if output_handler and not capture:
+            # pass output through, line by line.
+            for line in iter(p.stdout.readline, ""):
+                sys.stdout.write(line)
+                sys.stdout.flush()
+                output_handler(line)
+
+            p.stdout.close()
+
         exitcode = p.wait()
 
+        notify("command-finished", stage=stage, args=args, exitcode=exitcode,
+               duration=time.time() - started)
+
         if capture and split_output:
             stdout = stdout.split(os.linesep)
             stderr = stderr.split(os.linesep)
@@ -14,13 +14,17 @@
 # the License.
 
 import os
+import sys
+import time
 import shutil
 import contextlib
 import logging
 
 log = logging.getLogger(__name__)
 
+from vdisk.events import output_handler
 from vdisk.externalcommand import ExternalCommand
+from vdisk.stages import notify
 
 losetup = ExternalCommand("losetup")
 kpartx = ExternalCommand("kpartx")
@@ -107,6 +111,11 @@ def mounted_device(device, mountpoint, **opts):
     if mount_bind:
         args.extend(["--bind"])
 
+    mount_options = opts.get("mount_options")
+
+    if mount_options:
+        args.extend(["-o", mount_options])
+
     args.extend([device, mountpoint])
 
     mount(*args)
@@ -119,42 +128,109 @@ def mounted_device(device, mountpoint, **opts):
         umount(mountpoint)
 
 
+def submounts(mountpoint):
+    """
+    List the mount points at or below mountpoint, relative to it and ordered
+    so that parents come before their children.
+    """
+    base = os.path.realpath(mountpoint)
+    found = []
+
+    with open("/proc/mounts") as f:
+        for line in f:
+            path = line.split()[1].decode("string_escape")
+
+            if path == base:
+                found.append("")
+            elif path.startswith(base + "/"):
+                found.append(path[len(base) + 1:])
+
+    return sorted(set(found), key=lambda p: (p.count("/"), p))
+
+
 @contextlib.contextmanager
-def entered_system(path, volume_group, mountpoint, **kw):
+def mounted_system(devices, lv, mountpoint, **kw):
+    """
+    Mount the root of an attached system at mountpoint, with proc, dev, boot
+    and any extra mounts below it.
+    """
     extra_mounts = kw.pop("extra_mounts", None)
     mount_proc = kw.pop("mount_proc", True)
     mount_dev = kw.pop("mount_dev", True)
 
-    with mounted_loopback(path) as devices:
-        with available_lvm(volume_group) as lv:
-            mounts = [
-                mounted_device(lv['root'], mountpoint),
-            ]
+    mounts = [
+        mounted_device(lv['root'], mountpoint),
+    ]
+
+    if mount_proc:
+        mounts.append(
+            mounted_device(
+                "null", "{0}/proc".format(mountpoint),
+                mount_type="proc")
+        )
+
+    if mount_dev:
+        mounts.append(
+            mounted_device(
+                "/dev", "{0}/dev".format(mountpoint),
+                mount_bind=True)
+        )
+
+    # mount boot if available.
+    if 'boot' in lv:
+        mounts.append(
+            mounted_device(lv['boot'], "{0}/boot".format(mountpoint)))
+
+    if extra_mounts:
+        mounts.extend(m(devices, lv) for m in extra_mounts)
+
+    with contextlib.nested(*mounts):
+        yield
+
 
-            if mount_proc:
-                mounts.append(
-                    mounted_device(
-                        "null", "{0}/proc".format(mountpoint),
-                        mount_type="proc")
-                )
+@contextlib.contextmanager
+def teardown_events(path):
+    """
+    Notify when an image starts to be released, and when it has been.
 
-            if mount_dev:
-                mounts.append(
-                    mounted_device(
-                        "/dev", "{0}/dev".format(mountpoint),
-                        mount_bind=True)
-                )
+    Yields a context manager for the block using the image, the release is
+    successful even if that block failed.
+    """
+    state = {"started": None, "error": None}
+
+    @contextlib.contextmanager
+    def in_use():
+        try:
+            yield
+        except:
+            state["error"] = sys.exc_info()[1]
+            raise
+        finally:
+            state["started"] = time.time()
+            notify("teardown-started", image=path)
 
-            # mount boot if available.
-            if 'boot' in lv:
-                mounts.append(
-                    mounted_device(lv['boot'], "{0}/boot".format(mountpoint)))
+    try:
+        yield in_use
+    except:
+        if state["started"] is not None:
+            notify("teardown-finished", image=path,
+                   success=sys.exc_info()[1] is state["error"],
+                   duration=time.time() - state["started"])
+        raise
+    else:
+        if state["started"] is not None:
+            notify("teardown-finished", image=path, success=True,
+                   duration=time.time() - state["started"])
 
-            if extra_mounts:
-                mounts.extend(m(devices, lv) for m in extra_mounts)
 
-            with contextlib.nested(*mounts):
-                yield devices, lv, mountpoint
+@contextlib.contextmanager
+def entered_system(path, volume_group, mountpoint, **kw):
+    with teardown_events(path) as in_use:
+        with mounted_loopback(path) as devices:
+            with available_lvm(volume_group) as lv:
+                with mounted_system(devices, lv, mountpoint, **kw):
+                    with in_use():
+                        yield devices, lv, mountpoint
 
 
 def install_packages(ns, path, packages, env=None, extra=[]):
@@ -176,7 +252,8 @@ def install_packages(ns, path, packages, env=None, extra=[]):
 
             args.extend(["-y", "install", package])
 
-            chroot(path, ns.apt_get, *args, env=env)
+            chroot(path, ns.apt_get, *args, env=env,
+                   output_handler=output_handler())
 
 
 def find_first_device(devices):
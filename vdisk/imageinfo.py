@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Read partition tables, LVM2 metadata and filesystem superblocks directly from
+an image file, without attaching it to any devices.
+"""
+
+import re
+import struct
+import uuid
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.blockmap import allocated_size
+from vdisk.blockmap import data_extents
+
+SECTOR_SIZE = 512
+
+MBR_ENTRY = struct.Struct("<B3sB3sII")
+MBR_TYPE_GPT = 0xee
+MBR_TYPE_LVM = 0x8e
+
+GPT_HEADER = struct.Struct("<8s12xQQQQQ16sQIII")
+GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+
+GPT_TYPES = {
+    "e6d6d379-f507-44c2-a23c-238f2a3df928": "lvm",
+    "21686148-6449-6e6f-744e-656564454649": "bios_grub",
+    "0fc63daf-8483-4772-8e79-3d69d8477de4": "linux",
+    "0657fd6d-a4ab-43c4-84e5-0933c84b4f4f": "swap",
+}
+
+MBR_TYPES = {
+    0x83: "linux",
+    0x82: "swap",
+    MBR_TYPE_LVM: "lvm",
+}
+
+LVM_LABEL = struct.Struct("<8sQII8s")
+LVM_DISK_LOCN = struct.Struct("<QQ")
+LVM_MDA_HEADER = struct.Struct("<I16sIQQ")
+LVM_RAW_LOCN = struct.Struct("<QQII")
+LVM_MDA_MAGIC = " LVM2 x[5A%r0N*>"
+LVM_MDA_HEADER_SIZE = 512
+
+EXT_MAGIC = 0xef53
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+
+
+def _read(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+
+    if len(data) != size:
+        raise Exception("Short read at {0} in {1}".format(offset, f.name))
+
+    return data
+
+
+def read_partitions(f):
+    """
+    Read the partition table of an image.
+
+    Returns a tuple of the table type ('gpt', 'msdos' or None) and a list of
+    partition dicts with number, start, size and type, offsets are in bytes.
+    """
+    mbr = _read(f, 0, SECTOR_SIZE)
+
+    if mbr[510:512] != "\x55\xaa":
+        return None, []
+
+    partitions = []
+
+    for i in range(4):
+        entry = mbr[446 + i * 16:446 + (i + 1) * 16]
+        status, chs1, ptype, chs2, lba, sectors = MBR_ENTRY.unpack(entry)
+
+        if ptype == MBR_TYPE_GPT:
+            return "gpt", _read_gpt(f)
+
+        if ptype == 0 or sectors == 0:
+            continue
+
+        partitions.append({
+            "number": i + 1,
+            "start": lba * SECTOR_SIZE,
+            "size": sectors * SECTOR_SIZE,
+            "type": MBR_TYPES.get(ptype, "0x{0:02x}".format(ptype)),
+        })
+
+    return "msdos", partitions
+
+
+def _read_gpt(f):
+    header = GPT_HEADER.unpack(_read(f, SECTOR_SIZE, GPT_HEADER.size))
+    signature = header[0]
+
+    if signature != "EFI PART":
+        raise Exception("Invalid GPT signature in {0}".format(f.name))
+
+    entries_lba, entry_count, entry_size = header[7], header[8], header[9]
+    table = _read(f, entries_lba * SECTOR_SIZE, entry_count * entry_size)
+
+    partitions = []
+
+    for i in range(entry_count):
+        entry = table[i * entry_size:i * entry_size + GPT_ENTRY.size]
+        ptype, unique, first, last, attrs, name = GPT_ENTRY.unpack(entry)
+
+        if ptype == "\0" * 16:
+            continue
+
+        type_guid = str(uuid.UUID(bytes_le=ptype))
+
+        partitions.append({
+            "number": i + 1,
+            "start": first * SECTOR_SIZE,
+            "size": (last - first + 1) * SECTOR_SIZE,
+            "type": GPT_TYPES.get(type_guid, type_guid),
+            "name": name.decode("utf-16-le").rstrip(u"\0"),
+        })
+
+    return partitions
+
+
+_TOKEN = re.compile(r'\s*(?:#[^\n]*\n?\s*)*'
+                    r'("(?:[^"\\]|\\.)*"|-?\d+|[A-Za-z0-9_.+-]+|[{}\[\]=,])')
+
+
+def _tokenize(text):
+    position = 0
+    text = text.rstrip("\0")
+
+    while position < len(text):
+        m = _TOKEN.match(text, position)
+
+        if not m:
+            if text[position:].strip():
+                raise Exception("Invalid LVM metadata at: {0!r}".format(
+                    text[position:position + 20]))
+            return
+
+        position = m.end()
+        yield m.group(1)
+
+
+def _parse_value(token):
+    if token.startswith('"'):
+        return token[1:-1].decode("string_escape")
+
+    try:
+        return int(token)
+    except ValueError:
+        return token
+
+
+def parse_lvm_metadata(text):
+    """
+    Parse the LVM2 text metadata format into nested dicts.
+    """
+    tokens = list(_tokenize(text))
+    root = dict()
+    stack = [root]
+    i = 0
+
+    while i < len(tokens):
+        token = tokens[i]
+
+        if token == "}":
+            stack.pop()
+            i += 1
+            continue
+
+        following = tokens[i + 1] if i + 1 < len(tokens) else None
+
+        if following == "{":
+            section = dict()
+            stack[-1][token] = section
+            stack.append(section)
+            i += 2
+            continue
+
+        if following != "=":
+            raise Exception("Invalid LVM metadata near: {0}".format(token))
+
+        i += 2
+
+        if tokens[i] == "[":
+            values = []
+            i += 1
+
+            while tokens[i] != "]":
+                if tokens[i] != ",":
+                    values.append(_parse_value(tokens[i]))
+                i += 1
+
+            stack[-1][token] = values
+        else:
+            stack[-1][token] = _parse_value(tokens[i])
+
+        i += 1
+
+    return root
+
+
+def read_lvm_metadata(f, offset):
+    """
+    Read the current LVM2 metadata of the physical volume at offset.
+
+    Returns None if there is no physical volume at offset.
+    """
+    for sector in range(4):
+        label = _read(f, offset + sector * SECTOR_SIZE, SECTOR_SIZE)
+
+        if label.startswith("LABELONE"):
+            break
+    else:
+        return None
+
+    (label_id, sector_xl, crc,
+     header_offset, label_type) = LVM_LABEL.unpack(label[:LVM_LABEL.size])
+
+    if not label_type.startswith("LVM2"):
+        return None
+
+    # pv_header: uuid, device size, then zero-terminated lists of data and
+    # metadata areas.
+    position = header_offset + 32 + 8
+    areas = [[], []]
+
+    for area in areas:
+        while True:
+            locn = LVM_DISK_LOCN.unpack(
+                label[position:position + LVM_DISK_LOCN.size])
+            position += LVM_DISK_LOCN.size
+
+            if locn[0] == 0:
+                break
+
+            area.append(locn)
+
+    for mda_offset, mda_size in areas[1]:
+        mda = offset + mda_offset
+        header = _read(f, mda, LVM_MDA_HEADER_SIZE)
+        checksum, magic, version, start, size = LVM_MDA_HEADER.unpack(
+            header[:LVM_MDA_HEADER.size])
+
+        if magic != LVM_MDA_MAGIC:
+            continue
+
+        raw_offset, raw_size, raw_checksum, raw_flags = LVM_RAW_LOCN.unpack(
+            header[LVM_MDA_HEADER.size:LVM_MDA_HEADER.size +
+                   LVM_RAW_LOCN.size])
+
+        if raw_size == 0:
+            continue
+
+        # the metadata area is a circular buffer following the header.
+        head = min(raw_size, size - raw_offset)
+        text = _read(f, mda + raw_offset, head)
+
+        if head < raw_size:
+            text += _read(f, mda + LVM_MDA_HEADER_SIZE, raw_size - head)
+
+        return parse_lvm_metadata(text)
+
+    return None
+
+
+def volume_groups(metadata, pv_offset):
+    """
+    Map the logical volumes in metadata to byte ranges of the image.
+
+    Only segments residing on the physical volume at pv_offset are mapped,
+    which covers the single-pv volume groups created by vdisk.
+    """
+    for name, vg in metadata.items():
+        if not isinstance(vg, dict) or "extent_size" not in vg:
+            continue
+
+        extent_size = vg["extent_size"] * SECTOR_SIZE
+        pvs = vg.get("physical_volumes", {})
+
+        logical_volumes = []
+
+        for lv_name, lv in sorted(vg.get("logical_volumes", {}).items()):
+            ranges = []
+            size = 0
+            mapped = True
+
+            for key, segment in sorted(lv.items()):
+                if not key.startswith("segment") or \
+                        not isinstance(segment, dict):
+                    continue
+
+                length = segment["extent_count"] * extent_size
+                size += length
+                stripes = segment.get("stripes")
+
+                if segment.get("type") != "striped" or \
+                        segment.get("stripe_count") != 1 or not stripes:
+                    mapped = False
+                    continue
+
+                pv = pvs.get(stripes[0])
+
+                if pv is None:
+                    mapped = False
+                    continue
+
+                start = (pv_offset + pv["pe_start"] * SECTOR_SIZE +
+                         stripes[1] * extent_size)
+                ranges.append((start, length))
+
+            logical_volumes.append({
+                "name": lv_name,
+                "size": size,
+                "ranges": ranges if mapped else None,
+            })
+
+        yield {
+            "name": name,
+            "extent_size": extent_size,
+            "extent_count": sum(pv.get("pe_count", 0)
+                                for pv in pvs.values()),
+            "logical_volumes": logical_volumes,
+        }
+
+
+def read_filesystem(f, offset):
+    """
+    Identify the filesystem at offset by its superblock.
+    """
+    head = _read(f, offset, 4096)
+
+    if head[4086:4096] in ("SWAPSPACE2", "SWAP-SPACE"):
+        return {"type": "swap"}
+
+    if head[0:4] == "XFSB":
+        return {"type": "xfs"}
+
+    if head[0:4] == "hsqs":
+        return {"type": "squashfs"}
+
+    sb = head[1024:2048]
+    magic, = struct.unpack("<H", sb[56:58])
+
+    if magic != EXT_MAGIC:
+        return None
+
+    blocks, reserved, free = struct.unpack("<III", sb[4:16])
+    log_block_size, = struct.unpack("<I", sb[24:28])
+    incompat, = struct.unpack("<I", sb[96:100])
+
+    if incompat & EXT_FEATURE_INCOMPAT_64BIT:
+        blocks_hi, reserved_hi, free_hi = struct.unpack("<III", sb[336:348])
+        blocks |= blocks_hi << 32
+        free |= free_hi << 32
+
+    block_size = 1024 << log_block_size
+
+    return {
+        "type": "ext",
+        "block_size": block_size,
+        "size": blocks * block_size,
+        "used": (blocks - free) * block_size,
+        "label": sb[120:136].rstrip("\0"),
+        "uuid": str(uuid.UUID(bytes=sb[104:120])),
+    }
+
+
+def allocated_in(extents, ranges):
+    """
+    Count the bytes of the data extents which fall inside of ranges.
+    """
+    total = 0
+
+    for start, length in ranges:
+        end = start + length
+
+        for e_start, e_length in extents:
+            overlap = min(end, e_start + e_length) - max(start, e_start)
+
+            if overlap > 0:
+                total += overlap
+
+    return total
+
+
+def inspect(path):
+    """
+    Describe the layout and allocation of the image at path.
+    """
+    apparent, allocated = allocated_size(path)
+    extents = list(data_extents(path))
+
+    info = {
+        "image": path,
+        "size": apparent,
+        "allocated": allocated,
+        "partition_table": None,
+        "partitions": [],
+        "volume_groups": [],
+    }
+
+    with open(path, "rb") as f:
+        table, partitions = read_partitions(f)
+        info["partition_table"] = table
+
+        for partition in partitions:
+            ranges = [(partition["start"], partition["size"])]
+            partition["allocated"] = allocated_in(extents, ranges)
+
+            metadata = read_lvm_metadata(f, partition["start"])
+
+            if metadata is None:
+                partition["filesystem"] = read_filesystem(
+                    f, partition["start"])
+                info["partitions"].append(partition)
+                continue
+
+            partition["filesystem"] = {"type": "LVM2_member"}
+            info["partitions"].append(partition)
+
+            for vg in volume_groups(metadata, partition["start"]):
+                for lv in vg["logical_volumes"]:
+                    ranges = lv.pop("ranges")
+
+                    if ranges is None:
+                        lv["allocated"] = None
+                        lv["filesystem"] = None
+                        continue
+
+                    lv["offset"] = ranges[0][0]
+                    lv["allocated"] = allocated_in(extents, ranges)
+                    lv["filesystem"] = read_filesystem(f, ranges[0][0])
+
+                    # only a contiguous volume can be read in place.
+                    if len(ranges) > 1:
+                        lv["offset"] = None
+
+                info["volume_groups"].append(vg)
+
+    return info
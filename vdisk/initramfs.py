@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import glob
+import shutil
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.aptrepo import iter_stanzas
+from vdisk.externalcommand import ExternalCommand
+
+chroot = ExternalCommand("chroot")
+
+# Configuration, hooks and scripts which end up in the initramfs.
+INPUT_PATHS = [
+    "etc/initramfs-tools",
+    "usr/share/initramfs-tools",
+    "etc/modprobe.d",
+    "lib/modprobe.d",
+]
+
+HOOK_PREFIXES = tuple("/" + path + "/" for path in INPUT_PATHS[:2])
+
+STAMP_PATH = "var/lib/vdisk/initramfs.digest"
+
+
+def kernel_versions(mountpoint):
+    modules = os.path.join(mountpoint, "lib/modules")
+
+    if not os.path.isdir(modules):
+        return []
+
+    return sorted(os.listdir(modules))
+
+
+def _update_tree(h, mountpoint, path):
+    full = os.path.join(mountpoint, path)
+
+    if os.path.islink(full):
+        h.update("{0} -> {1}\0".format(path, os.readlink(full)))
+        return
+
+    if os.path.isdir(full):
+        for name in sorted(os.listdir(full)):
+            _update_tree(h, mountpoint, os.path.join(path, name))
+        return
+
+    if os.path.isfile(full):
+        h.update(path + "\0")
+
+        with open(full, "rb") as f:
+            h.update(f.read())
+
+        h.update("\0")
+
+
+def hook_packages(mountpoint):
+    """
+    Generate (package, version) tuples for installed packages which ship
+    initramfs hooks or scripts, these determine what the hooks copy from the
+    system.
+    """
+    info = os.path.join(mountpoint, "var/lib/dpkg/info")
+    owners = set()
+
+    for path in glob.glob(os.path.join(info, "*.list")):
+        with open(path) as f:
+            if any(line.startswith(HOOK_PREFIXES) for line in f):
+                name = os.path.basename(path)[:-len(".list")]
+                owners.add(name.split(":")[0])
+
+    status = os.path.join(mountpoint, "var/lib/dpkg/status")
+
+    if not os.path.isfile(status):
+        return
+
+    with open(status) as f:
+        for stanza in iter_stanzas(f):
+            if stanza.get("Package") in owners:
+                yield stanza["Package"], stanza.get("Version")
+
+
+def initramfs_digest(mountpoint):
+    """
+    Calculate a digest of everything that goes into the initramfs images of
+    the system at mountpoint.
+    """
+    h = hashlib.sha1()
+
+    for version in kernel_versions(mountpoint):
+        h.update("kernel {0}\0".format(version))
+        _update_tree(h, mountpoint, "boot/vmlinuz-{0}".format(version))
+
+    for path in INPUT_PATHS:
+        _update_tree(h, mountpoint, path)
+
+    for package, version in sorted(hook_packages(mountpoint)):
+        h.update("package {0} {1}\0".format(package, version))
+
+    return h.hexdigest()
+
+
+def initramfs_image(directory, version):
+    return os.path.join(directory, "initrd.img-{0}".format(version))
+
+
+def has_images(directory, versions):
+    """
+    Check whether directory has an initramfs image of every kernel version.
+    """
+    return all(os.path.isfile(initramfs_image(directory, version))
+               for version in versions)
+
+
+def initramfs_images(mountpoint):
+    return sorted(glob.glob(os.path.join(mountpoint, "boot", "initrd.img-*")))
+
+
+def update_initramfs(ns, mountpoint):
+    """
+    Update the initramfs of the system at mountpoint, unless it is already
+    built from the same inputs.
+
+    Generated images are cached on the host by the digest of their inputs and
+    reused by other builds.
+    """
+    versions = kernel_versions(mountpoint)
+
+    if not versions:
+        log.info("No kernel installed, not generating an initramfs")
+        return
+
+    boot = os.path.join(mountpoint, "boot")
+    digest = initramfs_digest(mountpoint)
+    stamp = os.path.join(mountpoint, STAMP_PATH)
+
+    if os.path.isfile(stamp) and has_images(boot, versions):
+        with open(stamp) as f:
+            if f.read().strip() == digest:
+                log.info("Initramfs is up to date")
+                return
+
+    cached = os.path.join(ns.cache_dir, "initramfs", digest)
+
+    # caches without an image for every kernel are regenerated.
+    if has_images(cached, versions):
+        log.info("Restoring cached initramfs: {0}".format(cached))
+
+        for path in glob.glob(os.path.join(cached, "initrd.img-*")):
+            shutil.copy2(path, boot)
+    else:
+        for version in versions:
+            image = initramfs_image(boot, version)
+
+            # '-u' only updates existing images, kernels installed while
+            # update-initramfs was deferred have none.
+            if os.path.isfile(image):
+                chroot(mountpoint, "update-initramfs", "-u", "-k", version)
+            else:
+                chroot(mountpoint, "update-initramfs", "-c", "-k", version)
+
+            if not os.path.isfile(image):
+                raise Exception("No initramfs generated for: {0}".format(
+                    version))
+
+        temporary = cached + ".tmp"
+
+        if os.path.isdir(temporary):
+            shutil.rmtree(temporary)
+
+        os.makedirs(temporary)
+
+        for path in initramfs_images(mountpoint):
+            shutil.copy2(path, temporary)
+
+        if os.path.isdir(cached):
+            shutil.rmtree(cached)
+
+        os.rename(temporary, cached)
+
+    if not os.path.isdir(os.path.dirname(stamp)):
+        os.makedirs(os.path.dirname(stamp))
+
+    with open(stamp, "w") as f:
+        print >>f, digest
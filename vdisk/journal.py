@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import json
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+JOURNAL_PATH = "var/lib/vdisk/journal"
+
+
+def input_digest(inputs):
+    """
+    Calculate a digest of the inputs of a step, any structure of plain data.
+    """
+    data = json.dumps(inputs, sort_keys=True, default=repr)
+    return hashlib.sha1(data).hexdigest()
+
+
+def read_journal(path):
+    entries = []
+
+    if not os.path.isfile(path):
+        return entries
+
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+
+            if not line:
+                continue
+
+            digest, name = line.split(" ", 1)
+            entries.append((name, digest))
+
+    return entries
+
+
+class Journal(object):
+    """
+    The completed steps of a build, in order, stored in the image.
+
+    When resuming, steps are skipped for as long as they match the steps of
+    the journal by name and input digest. From the first step which failed or
+    changed, all steps run again.
+    """
+    def __init__(self, mountpoint, resume=False):
+        self.path = os.path.join(mountpoint, JOURNAL_PATH)
+        self.previous = read_journal(self.path) if resume else []
+        self.entries = []
+        self.resuming = resume
+
+        if not resume:
+            self._write()
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(self.path + ".tmp", "w") as f:
+            for name, digest in self.entries:
+                print >>f, digest, name
+
+        os.rename(self.path + ".tmp", self.path)
+
+    def run(self, name, inputs, function, *args, **kw):
+        """
+        Run a step unless it is completed with the same inputs.
+        """
+        entry = (name, input_digest(inputs))
+        index = len(self.entries)
+
+        if self.resuming and index < len(self.previous) and \
+                self.previous[index] == entry:
+            log.info("Skipping completed step: {0}".format(name))
+            self.entries.append(entry)
+            return
+
+        if self.resuming:
+            log.info("Resuming from step: {0}".format(name))
+            self.resuming = False
+
+        function(*args, **kw)
+
+        self.entries.append(entry)
+        self._write()
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+The logical volumes of an image, their filesystems and how they are mounted,
+as declared under 'layout' in vdisk.yaml:
+
+    layout:
+        fstab: uuid
+        volumes:
+            - name: boot
+              size: 512M
+            - name: root
+              size: 8G
+              filesystem: xfs
+              options: noatime,nobarrier
+            - name: data
+              size: 20G
+              mount: /var/lib/postgresql
+              inode_ratio: 65536
+              journal_size: 128
+              stride: 16
+              stripe_width: 64
+            - name: swap
+              size: 100%FREE
+              filesystem: swap
+
+Without a declaration, the layout is boot, root of '--root-size' and swap on
+the rest, like it always was.
+"""
+
+import re
+
+FILESYSTEMS = ["ext4", "ext3", "xfs", "swap", "none"]
+
+FSTAB_MODES = ["device", "uuid"]
+
+VOLUME_KEYS = set(["name", "size", "filesystem", "mount", "options", "dump",
+                   "pass", "inode_ratio", "journal_size", "stride",
+                   "stripe_width", "mkfs_options"])
+
+BLOCK_SIZE = 4096
+
+# Leave inode tables and the journal to be initialized by the kernel, and
+# discard the device, which punches holes in the image through the loop
+# device.
+MINIMAL_EXT4_OPTIONS = "lazy_itable_init=1,lazy_journal_init=1,discard"
+
+# Multipliers of the units of 'lvcreate -L', which are all binary.
+LVM_UNITS = {"b": 1, "s": 512, "k": 2 ** 10, "m": 2 ** 20, "g": 2 ** 30,
+             "t": 2 ** 40, "p": 2 ** 50, "e": 2 ** 60}
+
+_NAME = re.compile(r"^[a-zA-Z0-9+_.-]+$")
+_SIZE = re.compile(r"^\d+[bBsSkKmMgGtTpPeE]?$")
+_EXTENTS = re.compile(r"^\d+%(FREE|VG|PVS)$")
+
+
+def default_layout(root_size):
+    return [
+        {"name": "boot", "size": "512M", "mount": None},
+        {"name": "root", "size": root_size, "options": "noatime"},
+        {"name": "swap", "size": "100%FREE", "filesystem": "swap"},
+    ]
+
+
+def _normalize(volume, root_size):
+    unknown = set(volume) - VOLUME_KEYS
+
+    if unknown:
+        raise Exception("Unknown layout keys for {0}: {1}".format(
+            volume.get("name"), ", ".join(sorted(unknown))))
+
+    name = volume.get("name")
+
+    if not name or not _NAME.match(str(name)):
+        raise Exception("Invalid volume name in layout: {0!r}".format(name))
+
+    size = str(volume.get("size") or (root_size if name == "root" else ""))
+
+    if _EXTENTS.match(size):
+        extents = True
+    elif _SIZE.match(size):
+        extents = False
+    else:
+        raise Exception("Invalid size of volume {0}: {1!r}".format(
+            name, size))
+
+    filesystem = volume.get("filesystem", "ext4")
+
+    if filesystem not in FILESYSTEMS:
+        raise Exception("Unsupported filesystem of volume {0}: {1}".format(
+            name, filesystem))
+
+    if filesystem == "swap":
+        mount = "none"
+        default_options = "sw"
+    elif name == "root":
+        mount = "/"
+        default_options = "defaults"
+    elif name == "boot":
+        mount = "/boot"
+        default_options = "defaults"
+    else:
+        mount = None
+        default_options = "defaults"
+
+    mount = volume.get("mount", mount)
+    options = volume.get("options", default_options)
+
+    if isinstance(options, list):
+        options = ",".join(options)
+
+    if filesystem in ("swap", "none"):
+        passno = 0
+    else:
+        passno = 1 if mount == "/" else 2
+
+    return {
+        "name": name,
+        "size": size,
+        "extents": extents,
+        "filesystem": filesystem,
+        "mount": mount,
+        "options": options,
+        "dump": int(volume.get("dump", 0)),
+        "pass": int(volume.get("pass", passno)),
+        "inode_ratio": volume.get("inode_ratio"),
+        "journal_size": volume.get("journal_size"),
+        "stride": volume.get("stride"),
+        "stripe_width": volume.get("stripe_width"),
+        "mkfs_options": [str(o) for o in volume.get("mkfs_options") or []],
+    }
+
+
+def read_layout(config, root_size):
+    """
+    Read and validate the layout of a configuration.
+
+    Returns a tuple of the fstab mode and a list of volume dicts, in the
+    order they are created.
+    """
+    declared = (config or {}).get("layout")
+
+    if declared is None:
+        volumes = default_layout(root_size.formatted)
+        fstab = "device"
+    else:
+        volumes = declared.get("volumes") or []
+        fstab = declared.get("fstab", "device")
+
+    if fstab not in FSTAB_MODES:
+        raise Exception("Invalid fstab mode of layout: {0}".format(fstab))
+
+    volumes = [_normalize(volume, root_size.formatted) for volume in volumes]
+    names = [volume["name"] for volume in volumes]
+
+    if "root" not in names:
+        raise Exception("Layout has no root volume")
+
+    if len(set(names)) != len(names):
+        raise Exception("Layout has duplicate volumes")
+
+    mounts = [volume["mount"] for volume in volumes
+              if volume["mount"] not in (None, "none")]
+
+    if len(set(mounts)) != len(mounts):
+        raise Exception("Layout has duplicate mount points")
+
+    for volume in volumes[:-1]:
+        if volume["size"] == "100%FREE":
+            raise Exception("Only the last volume can take all free space")
+
+    return fstab, volumes
+
+
+def volume_bytes(volume):
+    """
+    The size of a volume in bytes, or None if it is sized in extents.
+    """
+    if volume["extents"]:
+        return None
+
+    size = volume["size"]
+
+    if size[-1].isdigit():
+        return int(size) * LVM_UNITS["m"]
+
+    return int(size[:-1]) * LVM_UNITS[size[-1].lower()]
+
+
+def lvcreate_args(args, minimal_allocation=False):
+    """
+    Build the arguments of 'lvm lvcreate' from the arguments describing the
+    volume.
+    """
+    if minimal_allocation:
+        # wipe signatures instead of zeroing the start of the volume.
+        return ["lvcreate", "-Z", "n", "-W", "y", "--yes"] + list(args)
+
+    return ["lvcreate"] + list(args)
+
+
+def ext4_args(minimal_allocation=False):
+    """
+    Build the arguments of mkfs.ext4 for a volume outside of the layout, not
+    including the device.
+    """
+    if minimal_allocation:
+        return ["-E", MINIMAL_EXT4_OPTIONS]
+
+    return []
+
+
+def mkfs_args(volume, minimal_allocation=False):
+    """
+    Build the arguments of the mkfs command of a volume, not including the
+    device.
+    """
+    filesystem = volume["filesystem"]
+    args = []
+
+    if filesystem == "swap":
+        return ["-f"] + volume["mkfs_options"]
+
+    if filesystem == "xfs":
+        args.append("-f")
+
+        if volume["inode_ratio"]:
+            raise Exception("xfs has no inode ratio: {0}".format(
+                volume["name"]))
+
+        if volume["journal_size"]:
+            args.extend(["-l", "size={0}m".format(volume["journal_size"])])
+
+        if volume["stride"]:
+            data = ["su={0}".format(volume["stride"] * BLOCK_SIZE)]
+
+            if volume["stripe_width"]:
+                data.append("sw={0}".format(
+                    volume["stripe_width"] // volume["stride"]))
+
+            args.extend(["-d", ",".join(data)])
+
+        return args + volume["mkfs_options"]
+
+    extended = []
+
+    if volume["inode_ratio"]:
+        args.extend(["-i", str(volume["inode_ratio"])])
+
+    if volume["journal_size"]:
+        args.extend(["-J", "size={0}".format(volume["journal_size"])])
+
+    if volume["stride"]:
+        extended.append("stride={0}".format(volume["stride"]))
+
+    if volume["stripe_width"]:
+        extended.append("stripe_width={0}".format(volume["stripe_width"]))
+
+    if minimal_allocation:
+        extended.append(MINIMAL_EXT4_OPTIONS)
+
+    if extended:
+        args.extend(["-E", ",".join(extended)])
+
+    return args + volume["mkfs_options"]
+
+
+def fstab_line(device, volume):
+    return "{0} {1:<7} {2:<7} {3:<7} {4} {5}".format(
+        device, volume["mount"], volume["filesystem"], volume["options"],
+        volume["dump"], volume["pass"])
+
+
+def mounted_volumes(volumes):
+    """
+    List the volumes mounted below root, parents first. boot is left out,
+    it is always mounted at /boot.
+    """
+    mounted = [volume for volume in volumes
+               if volume["mount"] not in (None, "none", "/") and
+               volume["name"] != "boot"]
+
+    return sorted(mounted, key=lambda volume: volume["mount"].count("/"))
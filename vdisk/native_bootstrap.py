@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+A bootstrap engine which resolves, downloads and extracts the base system in
+parallel, and then lets dpkg inside of the target configure it.
+
+Like debootstrap, the Release file of the mirror is verified with gpgv against
+a keyring, the Packages indexes against the checksums in the Release file and
+packages against the checksums in the Packages index. Verification can be
+turned off for unsigned local repositories, like the ones written by
+'install --repository'.
+"""
+
+import os
+import re
+import bz2
+import zlib
+import shutil
+import hashlib
+import logging
+import urllib2
+import tempfile
+import contextlib
+
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+from vdisk.aptrepo import iter_stanzas
+from vdisk.aptrepo import parse_stanza
+from vdisk.events import output_handler
+from vdisk.helpers import mounted_device
+from vdisk.helpers import write_mounted
+from vdisk.stages import inherit
+from vdisk.stages import notify
+from vdisk.stages import stage
+from vdisk.externalcommand import ExternalCommand
+from vdisk.externalcommand import ExternalCommandException
+
+chroot = ExternalCommand("chroot")
+dpkg_deb = ExternalCommand("dpkg-deb")
+gpgv = ExternalCommand("gpgv")
+
+BASE_PRIORITIES = ["required", "important"]
+
+# Installed one at a time, in order, before unpacking everything else.
+CORE_PACKAGES = ["base-passwd", "base-files", "dpkg", "libc6"]
+
+ARCHIVES_PATH = "var/cache/apt/archives"
+
+DEFAULT_KEYRING = "/usr/share/keyrings/debian-archive-keyring.gpg"
+
+INDEX_NAMES = [
+    ("Packages.gz", lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS)),
+    ("Packages.bz2", bz2.decompress),
+    ("Packages", lambda data: data),
+]
+
+DOWNLOAD_BUFFER = 2 ** 16
+
+_DEPENDENCY = re.compile(r"^\s*([^\s(:]+)(?::\S+)?\s*(?:\(.*\))?\s*$")
+
+
+def _fetch(url):
+    f = urllib2.urlopen(url)
+
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def verify_signature(data, signature, keyring):
+    """
+    Verify a detached signature of data with gpgv against keyring.
+    """
+    directory = tempfile.mkdtemp(prefix="vdisk-gpgv-")
+
+    try:
+        data_path = os.path.join(directory, "Release")
+        signature_path = os.path.join(directory, "Release.gpg")
+
+        with open(data_path, "wb") as f:
+            f.write(data)
+
+        with open(signature_path, "wb") as f:
+            f.write(signature)
+
+        gpgv("--keyring", keyring, signature_path, data_path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def read_release(base, keyring):
+    """
+    Fetch and verify the Release file at base, and return a dict of the
+    paths of the indexes it lists to their size and SHA256.
+
+    Nothing is verified without a keyring, and None is returned. Without a
+    Release file, nothing can be verified and the dict is empty.
+    """
+    if keyring is None:
+        return None
+
+    try:
+        release = _fetch("{0}/Release".format(base))
+    except (urllib2.URLError, IOError):
+        return dict()
+
+    try:
+        signature = _fetch("{0}/Release.gpg".format(base))
+    except (urllib2.URLError, IOError):
+        raise Exception("Release file is not signed: {0}".format(base))
+
+    try:
+        verify_signature(release, signature, keyring)
+    except ExternalCommandException:
+        raise Exception("Bad signature of Release file: {0}".format(base))
+
+    log.info("Verified Release file: {0}".format(base))
+
+    checksums = dict()
+
+    for line in parse_stanza(release).get("SHA256", "").splitlines():
+        fields = line.split()
+
+        if len(fields) == 3:
+            checksums[fields[2]] = (int(fields[1]), fields[0])
+
+    return checksums
+
+
+def _read_index(base, path, packages, checksums):
+    for name, decompress in INDEX_NAMES:
+        index = "/".join(filter(None, [path, name]))
+
+        # only indexes listed in a verified Release file are read.
+        if checksums is not None and index not in checksums:
+            continue
+
+        url = "{0}/{1}".format(base, index)
+
+        try:
+            raw = _fetch(url)
+        except (urllib2.URLError, IOError):
+            continue
+
+        if checksums is not None and checksums[index] != \
+                (len(raw), hashlib.sha256(raw).hexdigest()):
+            raise Exception("Checksum mismatch: {0}".format(url))
+
+        data = decompress(raw)
+
+        log.info("Read index: {0}".format(url))
+
+        for stanza in iter_stanzas(data.splitlines()):
+            packages.setdefault(stanza["Package"], stanza)
+
+        return True
+
+    return False
+
+
+def fetch_index(mirror, suite, components, arch, keyring=None):
+    """
+    Fetch the Packages indexes of a mirror and return a dict of package name
+    to stanza.
+
+    Mirrors without a dists/ hierarchy are read as flat repositories, like
+    the ones written by 'install --download --repository'. With a keyring,
+    only indexes listed in a Release file signed by it are read.
+    """
+    mirror = mirror.rstrip("/")
+    packages = dict()
+
+    dists = "{0}/dists/{1}".format(mirror, suite)
+    checksums = read_release(dists, keyring)
+
+    for component in components:
+        _read_index(dists, "{0}/binary-{1}".format(component, arch),
+                    packages, checksums)
+
+    if not packages:
+        _read_index(mirror, None, packages, read_release(mirror, keyring))
+
+    if not packages:
+        if keyring is not None:
+            raise Exception("No verified package index found at: "
+                            "{0}".format(mirror))
+
+        raise Exception("No package index found at: {0}".format(mirror))
+
+    return packages
+
+
+def parse_dependencies(value):
+    """
+    Parse a dependency field into a list of alternatives, each alternative
+    is a list of package names.
+    """
+    if not value:
+        return []
+
+    result = []
+
+    for clause in value.split(","):
+        alternatives = []
+
+        for alternative in clause.split("|"):
+            m = _DEPENDENCY.match(alternative)
+
+            if m:
+                alternatives.append(m.group(1))
+
+        if alternatives:
+            result.append(alternatives)
+
+    return result
+
+
+def resolve(packages, priorities=BASE_PRIORITIES, include=[]):
+    """
+    Resolve the base system, all packages of the specified priorities and
+    everything they depend on.
+    """
+    providers = dict()
+
+    for name, stanza in sorted(packages.items()):
+        for provided in parse_dependencies(stanza.get("Provides")):
+            providers.setdefault(provided[0], name)
+
+    queue = [name for name, stanza in sorted(packages.items())
+             if stanza.get("Priority") in priorities]
+    queue.extend(include)
+
+    selected = set()
+
+    while queue:
+        name = queue.pop()
+
+        if name in selected:
+            continue
+
+        if name not in packages:
+            raise Exception("Package not in index: {0}".format(name))
+
+        selected.add(name)
+        stanza = packages[name]
+
+        for field in ("Pre-Depends", "Depends"):
+            for alternatives in parse_dependencies(stanza.get(field)):
+                for candidate in alternatives:
+                    candidate = candidate if candidate in packages \
+                        else providers.get(candidate)
+
+                    if candidate is not None:
+                        queue.append(candidate)
+                        break
+                else:
+                    log.warning("{0}: unsatisfiable dependency: {1}".format(
+                        name, " | ".join(alternatives)))
+
+    return sorted(selected)
+
+
+def _expected_checksum(stanza):
+    if "SHA256" in stanza:
+        return hashlib.sha256, stanza["SHA256"]
+
+    return hashlib.md5, stanza["MD5sum"]
+
+
+def _verified(path, stanza):
+    if not os.path.isfile(path):
+        return False
+
+    h, expected = _expected_checksum(stanza)
+    h = h()
+
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(DOWNLOAD_BUFFER), ""):
+            h.update(data)
+
+    return h.hexdigest() == expected
+
+
+def download(stanza, mirror, archives):
+    """
+    Download a package into archives, unless it is already there.
+    """
+    filename = stanza["Filename"]
+    path = os.path.join(archives, os.path.basename(filename))
+
+    if _verified(path, stanza):
+        return path
+
+    if filename.startswith("./"):
+        filename = filename[2:]
+
+    url = "{0}/{1}".format(mirror.rstrip("/"), filename)
+    temporary = path + ".partial"
+
+    source = urllib2.urlopen(url)
+
+    try:
+        with open(temporary, "wb") as f:
+            shutil.copyfileobj(source, f, DOWNLOAD_BUFFER)
+    finally:
+        source.close()
+
+    if not _verified(temporary, stanza):
+        os.unlink(temporary)
+        raise Exception("Checksum mismatch: {0}".format(url))
+
+    os.rename(temporary, path)
+    notify("downloaded", source=url, bytes=os.path.getsize(path))
+    return path
+
+
+def _map(jobs, function, items):
+    pool = ThreadPool(jobs)
+
+    try:
+        result = pool.map(inherit(function), items)
+        pool.close()
+        return result
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def setup_dpkg(mountpoint, mirror, suite, components):
+    for path in ("var/lib/dpkg/info", "var/lib/dpkg/updates",
+                 "var/lib/dpkg/alternatives", "etc/apt"):
+        full = os.path.join(mountpoint, path)
+
+        if not os.path.isdir(full):
+            os.makedirs(full)
+
+    for path in ("var/lib/dpkg/status", "var/lib/dpkg/available"):
+        open(os.path.join(mountpoint, path), "a").close()
+
+    # maintainer scripts need awk before mawk is configured.
+    awk = os.path.join(mountpoint, "usr/bin/awk")
+
+    if os.path.isfile(os.path.join(mountpoint, "usr/bin/mawk")) and \
+            not os.path.lexists(awk):
+        os.symlink("mawk", awk)
+
+    write_mounted(mountpoint, "etc/apt/sources.list", [
+        "deb {0} {1} {2}".format(mirror, suite, " ".join(components))])
+
+
+def configure(mountpoint, debs, env):
+    """
+    Install the core packages and unpack and configure the rest with dpkg
+    inside of the target.
+    """
+    target_debs = dict(
+        (name, "/" + os.path.join(ARCHIVES_PATH, os.path.basename(path)))
+        for name, path in debs.items())
+
+    for name in CORE_PACKAGES:
+        if name in target_debs:
+            log.info("Installing core package: {0}".format(name))
+            chroot(mountpoint, "dpkg", "--force-depends", "--install",
+                   target_debs[name], env=env,
+                   output_handler=output_handler())
+
+    rest = [path for name, path in sorted(target_debs.items())
+            if name not in CORE_PACKAGES]
+
+    log.info("Unpacking {0} packages".format(len(rest)))
+    chroot(mountpoint, "dpkg", "--force-depends", "--force-overwrite",
+           "--force-confold", "--skip-same-version", "--unpack", *rest,
+           env=env)
+
+    log.info("Configuring packages")
+    write_mounted(mountpoint, "usr/sbin/policy-rc.d", ["exit 101"])
+    chroot(mountpoint, "chmod", "755", "/usr/sbin/policy-rc.d")
+
+    try:
+        chroot(mountpoint, "dpkg", "--configure", "--pending",
+               "--force-configure-any", "--force-depends", env=env,
+               output_handler=output_handler())
+    finally:
+        os.unlink(os.path.join(mountpoint, "usr/sbin/policy-rc.d"))
+
+
+def bootstrap(mountpoint, mirror, suite, arch, env, components=["main"],
+              include=[], jobs=None, keyring=DEFAULT_KEYRING,
+              keep_archives=False):
+    """
+    Bootstrap a base system at mountpoint from mirror.
+
+    Downloaded packages are removed from the archives of the target once
+    configured, like debootstrap does, unless keep_archives is set.
+    """
+    with stage("resolve"):
+        packages = fetch_index(mirror, suite, components, arch, keyring)
+        selected = resolve(packages, include=include)
+
+    log.info("Resolved {0} packages".format(len(selected)))
+
+    archives = os.path.join(mountpoint, ARCHIVES_PATH)
+
+    if not os.path.isdir(archives):
+        os.makedirs(archives)
+
+    log.info("Downloading {0} packages".format(len(selected)))
+
+    with stage("download"):
+        paths = _map(jobs,
+                     lambda name: download(packages[name], mirror, archives),
+                     selected)
+
+    debs = dict(zip(selected, paths))
+
+    log.info("Extracting {0} packages".format(len(selected)))
+
+    with stage("extract"):
+        _map(jobs, lambda path: dpkg_deb("-x", path, mountpoint), paths)
+
+    setup_dpkg(mountpoint, mirror, suite, components)
+
+    with contextlib.nested(
+            mounted_device("null", os.path.join(mountpoint, "proc"),
+                           mount_type="proc"),
+            mounted_device("/dev", os.path.join(mountpoint, "dev"),
+                           mount_bind=True)):
+        with stage("configure"):
+            configure(mountpoint, debs, env)
+
+    if not keep_archives:
+        for path in paths:
+            os.unlink(path)
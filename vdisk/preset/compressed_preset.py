@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import logging
+import multiprocessing
+
+from vdisk.externalcommand import ExternalCommand
+from vdisk.helpers import mounted_loopback
+from vdisk.helpers import available_lvm
+from vdisk.helpers import mounted_device
+from vdisk.helpers import write_mounted
+from vdisk.preset.generic_preset import GenericPreset
+
+log = logging.getLogger(__name__)
+
+OVERLAY_SCRIPT = "etc/initramfs-tools/scripts/init-bottom/vdisk-overlay"
+INITRAMFS_MODULES = "etc/initramfs-tools/modules"
+
+# Runs after the initramfs has mounted the compressed root read-only, and
+# puts a writable overlay on top of it.
+OVERLAY_SCRIPT_TEMPLATE = """#!/bin/sh
+PREREQ=""
+prereqs()
+{{
+    echo "$PREREQ"
+}}
+
+case $1 in
+prereqs)
+    prereqs
+    exit 0
+    ;;
+esac
+
+lvm lvchange -aly --ignorelockingfailure {volume_group}/overlay
+
+mkdir -p /vdisk/ro /vdisk/rw
+mount -n -o move ${{rootmnt}} /vdisk/ro
+mount -n -t ext4 /dev/mapper/{volume_group}-overlay /vdisk/rw
+mkdir -p /vdisk/rw/upper /vdisk/rw/work
+
+mount -n -t overlay \\
+    -o lowerdir=/vdisk/ro,upperdir=/vdisk/rw/upper,workdir=/vdisk/rw/work \\
+    overlay ${{rootmnt}}
+
+mkdir -p ${{rootmnt}}/media/root-ro ${{rootmnt}}/media/root-rw
+mount -n -o move /vdisk/ro ${{rootmnt}}/media/root-ro
+mount -n -o move /vdisk/rw ${{rootmnt}}/media/root-rw
+"""
+
+
+class CompressedRootPreset(GenericPreset):
+    """
+    Builds the system on a regular ext4 root, which is replaced by a
+    read-only compressed image of itself by the 'finalize' action.
+
+    Changes at runtime go to an overlay backed by the 'overlay' volume.
+    """
+    blkdiscard = ExternalCommand("blkdiscard")
+    blkid = ExternalCommand("blkid")
+
+    filesystem = None
+    default_compressor = None
+
+    def __init__(self, ns):
+        super(CompressedRootPreset, self).__init__(ns)
+
+        if self.thin:
+            raise Exception("The {0} preset has no thin layout".format(
+                self.filesystem))
+
+        if self.custom_layout:
+            raise Exception("The {0} preset has a fixed layout".format(
+                self.filesystem))
+
+        self.compressor = ns.compressor or self.default_compressor
+        self.compression_jobs = (ns.compression_jobs or
+                                 multiprocessing.cpu_count())
+
+    def setup_volumes(self):
+        self.lvcreate(
+            "-L", "512M", "-n", "boot", self.volume_group
+        )
+
+        self.lvcreate(
+            "-L", self.root_size.formatted,
+            "-n", "root", self.volume_group
+        )
+
+        self.lvcreate(
+            "-l", '100%FREE', "-n", "overlay", self.volume_group
+        )
+
+        with available_lvm(self.volume_group) as lv:
+            log.info("formatting logical volumes")
+            self.format_ext4(lv['boot'])
+            self.format_ext4(lv['root'])
+            self.format_ext4(lv['overlay'])
+
+    def setup_boot(self, devices, path):
+        super(CompressedRootPreset, self).setup_boot(devices, path)
+
+        log.info("Installing overlay root initramfs script")
+        write_mounted(path, OVERLAY_SCRIPT, [OVERLAY_SCRIPT_TEMPLATE.format(
+            volume_group=self.volume_group)])
+        os.chmod(os.path.join(path, OVERLAY_SCRIPT), 0755)
+
+        modules_path = os.path.join(path, INITRAMFS_MODULES)
+        modules = []
+
+        if os.path.isfile(modules_path):
+            with open(modules_path) as f:
+                modules = [line.rstrip("\n") for line in f]
+
+        for module in (self.filesystem, "overlay"):
+            if module not in modules:
+                modules.append(module)
+
+        write_mounted(path, INITRAMFS_MODULES, modules)
+
+    def generate_fstab(self):
+        yield "# auto-generated fstab from vdisk"
+        yield ("# / is a {0} image with an overlay, set up by the "
+               "initramfs").format(self.filesystem)
+        yield "overlay                 /       overlay rw      0 0"
+        yield ("/dev/mapper/{0}-boot /boot   ext4    "
+               "noatime 0 2").format(self.volume_group)
+
+    def finalize(self):
+        """
+        Replace the content of the root volume with a compressed image of it,
+        written by compress(source, target) of the subclass.
+        """
+        staging = "{0}.root.{1}".format(self.image_path, self.filesystem)
+
+        if os.path.exists(staging):
+            os.unlink(staging)
+
+        with mounted_loopback(self.image_path):
+            with available_lvm(self.volume_group) as lv:
+                exitcode, out, err = self.blkid(
+                    "-s", "TYPE", "-o", "value", lv['root'],
+                    capture=True, remove_empty=True, raise_on_exit=False)
+
+                if out == [self.filesystem]:
+                    raise Exception("Root is already a {0} image".format(
+                        self.filesystem))
+
+                with mounted_device(lv['root'], self.mountpoint,
+                                    mount_options="ro"):
+                    log.info("Compressing root to {0} image".format(
+                        self.filesystem))
+                    self.compress(self.mountpoint, staging)
+
+                size = os.path.getsize(staging)
+
+                log.info("Writing {0} bytes of compressed root".format(size))
+                # discarding the volume punches holes in the image file.
+                self.blkdiscard(lv['root'])
+
+                with open(staging, "rb") as source:
+                    with open(lv['root'], "r+b") as target:
+                        for data in iter(lambda: source.read(2 ** 20), ""):
+                            target.write(data)
+
+                os.unlink(staging)
+
+            self.lvm("lvreduce", "-f", "-L", "{0}b".format(size),
+                     "{0}/root".format(self.volume_group))
+
+
+class SquashfsPreset(CompressedRootPreset):
+    mksquashfs = ExternalCommand("mksquashfs")
+
+    filesystem = "squashfs"
+    default_compressor = "xz"
+
+    def compress(self, source, target):
+        self.mksquashfs(source, target, "-noappend", "-xattrs",
+                        "-comp", self.compressor,
+                        "-processors", self.compression_jobs)
+
+
+class ErofsPreset(CompressedRootPreset):
+    mkfs_erofs = ExternalCommand("mkfs.erofs")
+
+    filesystem = "erofs"
+    default_compressor = "lz4hc"
+
+    def compress(self, source, target):
+        self.mkfs_erofs("-z", self.compressor,
+                        "--workers={0}".format(self.compression_jobs),
+                        target, source)
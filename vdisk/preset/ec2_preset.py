@@ -22,6 +22,11 @@ from vdisk.helpers import available_lvm
 from vdisk.helpers import entered_system
 from vdisk.helpers import find_first_device
 from vdisk.helpers import mounted_device
+from vdisk.layout import ext4_args
+from vdisk.layout import lvcreate_args
+from vdisk.readonly import entered_session
+from vdisk.readonly import new_session
+from vdisk.readonly import session_mountpoint
 
 log = logging.getLogger(__name__)
 
@@ -37,6 +42,21 @@ class EC2Preset(object):
         self.volume_group = ns.volume_group
         self.root_size = ns.root_size
         self.mountpoint = ns.mountpoint
+        self.minimal_allocation = getattr(ns, "minimal_allocation", False)
+        self.read_only = getattr(ns, "read_only", False)
+        self.session_dir = ns.session_dir
+
+        if ns.thin:
+            raise Exception("The ec2 preset has no thin layout")
+
+        if (ns.config or {}).get("layout") is not None:
+            raise Exception("The ec2 preset has a fixed layout")
+
+    def lvcreate(self, *args):
+        self.lvm(*lvcreate_args(args, self.minimal_allocation))
+
+    def format_ext4(self, device):
+        self.mkfs_ext4(*(ext4_args(self.minimal_allocation) + [device]))
 
     def setup_disks(self):
         """
@@ -63,39 +83,49 @@ class EC2Preset(object):
                     log.warning("Ignoring {0}: too few partitions")
                     continue
 
-                self.mkfs_ext4(partitions[0])
+                self.format_ext4(partitions[0])
 
                 self.lvm(
                     "pvcreate", partitions[1])
                 self.lvm(
                     "vgcreate", self.volume_group, partitions[1])
-                self.lvm(
-                    "lvcreate", "-L", self.root_size.formatted,
+                self.lvcreate(
+                    "-L", self.root_size.formatted,
                     "-n", "root", self.volume_group)
-                self.lvm(
-                    "lvcreate", "-l", '100%FREE', "-n", "swap",
+                self.lvcreate(
+                    "-l", '100%FREE', "-n", "swap",
                     self.volume_group)
 
                 with available_lvm(self.volume_group) as lv:
                     log.info("formatting logical volumes")
-                    self.mkfs_ext4(lv['root'])
+                    self.format_ext4(lv['root'])
                     self.mkswap("-f", lv['swap'])
 
-    def _extra_mounts(self):
+    def _extra_mounts(self, mountpoint):
         def __ec2_extra_mounts(devices, logical_volumes):
             first_device, partitions = find_first_device(devices)
 
             return mounted_device(
-                partitions[0], "{0}/boot".format(self.mountpoint))
+                partitions[0], "{0}/boot".format(mountpoint))
 
         return [__ec2_extra_mounts]
 
     def entered_system(self, **kw):
+        if self.read_only:
+            name, session = new_session(self.session_dir)
+
+            return entered_session(
+                self.image_path,
+                self.volume_group,
+                name, session,
+                extra_mounts=self._extra_mounts(session_mountpoint(session)),
+                **kw)
+
         return entered_system(
             self.image_path,
             self.volume_group,
             self.mountpoint,
-            extra_mounts=self._extra_mounts(), **kw)
+            extra_mounts=self._extra_mounts(self.mountpoint), **kw)
 
     def setup_boot(self, devices, path):
         """
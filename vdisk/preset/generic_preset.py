@@ -21,7 +21,18 @@ from vdisk.helpers import available_lvm
 from vdisk.helpers import entered_system
 from vdisk.helpers import find_first_device
 from vdisk.helpers import generate_devicemap
+from vdisk.helpers import mounted_device
 from vdisk.helpers import write_mounted
+from vdisk.layout import ext4_args
+from vdisk.layout import fstab_line
+from vdisk.layout import lvcreate_args
+from vdisk.layout import mkfs_args
+from vdisk.layout import mounted_volumes
+from vdisk.layout import read_layout
+from vdisk.readonly import entered_session
+from vdisk.readonly import new_session
+from vdisk.readonly import session_mountpoint
+from vdisk.snapshots import POOL
 
 log = logging.getLogger(__name__)
 
@@ -32,12 +43,34 @@ class GenericPreset(object):
     lvm = ExternalCommand("lvm")
     mkfs_ext4 = ExternalCommand("mkfs.ext4")
     mkswap = ExternalCommand("mkswap")
+    blkid = ExternalCommand("blkid")
 
     def __init__(self, ns):
         self.image_path = ns.image_path
         self.volume_group = ns.volume_group
         self.root_size = ns.root_size
         self.mountpoint = ns.mountpoint
+        self.thin = ns.thin
+        self.minimal_allocation = getattr(ns, "minimal_allocation", False)
+        self.read_only = getattr(ns, "read_only", False)
+        self.session_dir = ns.session_dir
+
+        self.config = ns.config
+        self.custom_layout = (ns.config or {}).get("layout") is not None
+        # also validates the layout before anything is done to the image.
+        self.fstab_mode = read_layout(ns.config, ns.root_size)[0]
+
+        if self.thin and self.custom_layout:
+            raise Exception("Thin layouts can not be declared in the "
+                            "configuration")
+
+    @property
+    def layout(self):
+        """
+        The volumes of the image, read on every use since the root size may
+        change after the preset is created, like with 'create --auto-size'.
+        """
+        return read_layout(self.config, self.root_size)[1]
 
     def setup_disks(self):
         parted = self.parted.prefix("-s", "--", self.image_path)
@@ -64,32 +97,126 @@ class GenericPreset(object):
 
                 self.lvm("pvcreate", partitions[1])
                 self.lvm("vgcreate", self.volume_group, partitions[1])
+                self.setup_volumes()
 
-                self.lvm(
-                    "lvcreate", "-L", "512M", "-n", "boot", self.volume_group
-                )
+    def lvcreate(self, *args):
+        self.lvm(*lvcreate_args(args, self.minimal_allocation))
 
-                self.lvm(
-                    "lvcreate", "-L", self.root_size.formatted,
-                    "-n", "root", self.volume_group
-                )
+    def format_ext4(self, device):
+        self.mkfs_ext4(*(ext4_args(self.minimal_allocation) + [device]))
 
-                self.lvm(
-                    "lvcreate", "-l", '100%FREE', "-n", "swap", self.volume_group
-                )
+    def setup_volumes(self):
+        volumes = self.layout
 
-                with available_lvm(self.volume_group) as lv:
-                    log.info("formatting logical volumes")
-                    self.mkfs_ext4(lv['boot'])
-                    self.mkfs_ext4(lv['root'])
-                    self.mkswap("-f", lv['swap'])
+        if self.thin:
+            volumes = [volume for volume in volumes
+                       if volume["name"] not in ("root", "swap")]
+
+        for volume in volumes:
+            self.lvcreate(
+                "-l" if volume["extents"] else "-L", volume["size"],
+                "-n", volume["name"], self.volume_group
+            )
+
+        if self.thin:
+            self.setup_thin_volumes()
+
+        with available_lvm(self.volume_group) as lv:
+            log.info("formatting logical volumes")
+
+            for volume in self.layout:
+                if volume["name"] in lv:
+                    self.format_volume(volume, lv[volume["name"]])
+
+    def format_volume(self, volume, device):
+        filesystem = volume["filesystem"]
+
+        if filesystem == "none":
+            return
+
+        if filesystem == "swap":
+            command = self.mkswap
+        elif filesystem == "ext4":
+            command = self.mkfs_ext4
+        else:
+            command = ExternalCommand("mkfs.{0}".format(filesystem))
+
+        args = mkfs_args(volume, self.minimal_allocation)
+        command(*(args + [device]))
+
+    def setup_thin_volumes(self):
+        """
+        Put root in a thin pool on all of the free space, which leaves room
+        for snapshots. Swap is created when the image is flattened.
+        """
+        self.lvcreate(
+            "-l", '100%FREE', "-T",
+            "{0}/{1}".format(self.volume_group, POOL)
+        )
+
+        self.lvm(
+            "lvcreate", "-V", self.root_size.formatted,
+            "-T", "{0}/{1}".format(self.volume_group, POOL),
+            "-n", "root"
+        )
+
+    def _volume_mounts(self, mountpoint):
+        def mount_volume(volume):
+            def mounted(devices, logical_volumes):
+                return mounted_device(
+                    logical_volumes[volume["name"]],
+                    mountpoint + volume["mount"])
+
+            return mounted
+
+        return [mount_volume(volume)
+                for volume in mounted_volumes(self.layout)]
 
     def entered_system(self, **kw):
+        if self.read_only:
+            name, session = new_session(self.session_dir)
+            mountpoint = session_mountpoint(session)
+        else:
+            mountpoint = self.mountpoint
+
+        kw["extra_mounts"] = self._volume_mounts(mountpoint) + \
+            list(kw.get("extra_mounts") or [])
+
+        if self.read_only:
+            return entered_session(
+                self.image_path,
+                self.volume_group,
+                name, session, **kw)
+
         return entered_system(
             self.image_path,
             self.volume_group,
             self.mountpoint, **kw)
 
+    def volume_device(self, volume):
+        device = "/dev/mapper/{0}-{1}".format(
+            self.volume_group, volume["name"].replace("-", "--"))
+
+        if self.fstab_mode != "uuid":
+            return device
+
+        exitcode, out, err = self.blkid("-s", "UUID", "-o", "value", device,
+                                        capture=True, remove_empty=True)
+
+        if not out:
+            raise Exception("No filesystem UUID of: {0}".format(device))
+
+        return "UUID={0}".format(out[0])
+
+    def generate_fstab(self):
+        yield "# auto-generated fstab from vdisk"
+
+        for volume in self.layout:
+            if volume["mount"] is None:
+                continue
+
+            yield fstab_line(self.volume_device(volume), volume)
+
     def setup_boot(self, devices, path):
         first_device, partitions = find_first_device(devices)
 
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Summaries of the reports puppet writes after every run.
+"""
+
+import os
+import yaml
+
+# Where puppet 3 and later versions keep the report of the last run.
+REPORT_PATHS = [
+    "var/lib/puppet/state/last_run_report.yaml",
+    "opt/puppetlabs/puppet/cache/state/last_run_report.yaml",
+]
+
+_BaseLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class ReportLoader(_BaseLoader):
+    """
+    Loads reports as plain data, ignoring the ruby types they are tagged
+    with.
+    """
+
+
+def _construct_ruby(loader, suffix, node):
+    if isinstance(node, yaml.MappingNode):
+        return loader.construct_mapping(node, deep=True)
+
+    if isinstance(node, yaml.SequenceNode):
+        return loader.construct_sequence(node, deep=True)
+
+    return loader.construct_scalar(node)
+
+
+ReportLoader.add_multi_constructor("!ruby/", _construct_ruby)
+
+
+def find_report(mountpoint, since=None):
+    """
+    Find the latest report in the system at mountpoint, which is written
+    after since.
+    """
+    found = []
+
+    for path in REPORT_PATHS:
+        full = os.path.join(mountpoint, path)
+
+        if not os.path.isfile(full):
+            continue
+
+        mtime = os.path.getmtime(full)
+
+        if since is None or mtime >= since:
+            found.append((mtime, full))
+
+    if not found:
+        return None
+
+    return max(found)[1]
+
+
+def read_report(path):
+    with open(path) as f:
+        return yaml.load(f, Loader=ReportLoader)
+
+
+def time_metrics(report):
+    """
+    Read the time metrics of a report, seconds spent per resource type as
+    well as in fact generation and catalog retrieval.
+    """
+    metric = (report.get("metrics") or {}).get("time") or {}
+    result = dict()
+
+    for value in metric.get("values") or []:
+        name, label, seconds = value
+        result[str(name)] = float(seconds)
+
+    return result
+
+
+def _classes(containment_path):
+    # the path starts with the stage and ends with the resource itself.
+    for entry in containment_path[1:-1]:
+        if "[" not in entry:
+            yield entry
+
+
+def summarize(report, top=10):
+    """
+    Summarize a report into its slowest resources and classes.
+
+    The time of a class includes the time of all classes it contains.
+    """
+    statuses = (report.get("resource_statuses") or {}).values()
+
+    resources = []
+    classes = dict()
+
+    for status in statuses:
+        seconds = float(status.get("evaluation_time") or 0)
+
+        resources.append({
+            "resource": status.get("resource"),
+            "time": seconds,
+            "changed": bool(status.get("changed")),
+            "failed": bool(status.get("failed")),
+        })
+
+        for name in _classes(status.get("containment_path") or []):
+            entry = classes.setdefault(name, {
+                "class": name, "time": 0.0, "resources": 0})
+            entry["time"] += seconds
+            entry["resources"] += 1
+
+    by_time = lambda entry: -entry["time"]
+
+    return {
+        "time": str(report.get("time")),
+        "status": report.get("status"),
+        "puppet_version": report.get("puppet_version"),
+        "metrics": time_metrics(report),
+        "resource_count": len(resources),
+        "resources": sorted(resources, key=by_time)[:top],
+        "classes": sorted(classes.values(), key=by_time)[:top],
+    }
+
+
+def write_summary(path, summary):
+    with open(path, "w") as f:
+        yaml.safe_dump(summary, f, default_flow_style=False)
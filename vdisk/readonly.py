@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Read-only sessions, which let any number of processes enter the same image at
+once.
+
+The image is attached read-only, and a device mapper snapshot is put on top of
+it with its copy-on-write store in a sparse file of the session. Everything
+written during a session goes to that file, and is thrown away with it. The
+volume group on the snapshot is renamed with vgimportclone, so that every
+session has a volume group of its own and none of them conflicts with the
+volume group of the image.
+"""
+
+import os
+import uuid
+import fcntl
+import shutil
+import logging
+import contextlib
+
+log = logging.getLogger(__name__)
+
+from vdisk.externalcommand import ExternalCommand
+from vdisk.helpers import available_lvm
+from vdisk.helpers import mounted_system
+from vdisk.helpers import teardown_events
+
+losetup = ExternalCommand("losetup")
+kpartx = ExternalCommand("kpartx")
+dmsetup = ExternalCommand("dmsetup")
+blockdev = ExternalCommand("blockdev")
+blkid = ExternalCommand("blkid")
+udevadm = ExternalCommand("udevadm")
+vgimportclone = ExternalCommand("vgimportclone")
+
+# Chunk size of the snapshot, in 512 byte sectors.
+CHUNK_SIZE = 8
+
+
+def new_session(directory):
+    """
+    Pick the name and directory of a new session, the directory is created
+    when the session is entered.
+    """
+    name = uuid.uuid4().hex[:8]
+    return name, os.path.join(os.path.abspath(directory), name)
+
+
+def session_mountpoint(path):
+    return os.path.join(path, "mount")
+
+
+@contextlib.contextmanager
+def locked(directory):
+    """
+    Serialize the setup of sessions, so that no two of them see each others
+    volume groups before they are renamed.
+    """
+    with open(os.path.join(directory, "lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def attached_loop(path, read_only=False):
+    args = ["--show", "-f"]
+
+    if read_only:
+        args.append("-r")
+
+    exitcode, out, err = losetup(*(args + [path]), capture=True)
+    loop = out[0]
+
+    try:
+        yield loop
+    finally:
+        losetup("-d", loop)
+
+
+@contextlib.contextmanager
+def snapshot_device(name, origin, cow):
+    exitcode, out, err = blockdev("--getsz", origin, capture=True)
+    table = "0 {0} snapshot {1} {2} N {3}".format(
+        int(out[0]), origin, cow, CHUNK_SIZE)
+
+    dmsetup("create", name, "--table", table)
+    udevadm("settle")
+
+    try:
+        yield "/dev/mapper/{0}".format(name)
+    finally:
+        dmsetup("remove", name)
+        udevadm("settle")
+
+
+def is_physical_volume(device):
+    exitcode, out, err = blkid("-s", "TYPE", "-o", "value", device,
+                               capture=True, remove_empty=True,
+                               raise_on_exit=False)
+
+    return out == ["LVM2_member"]
+
+
+@contextlib.contextmanager
+def cloned_partitions(device, volume_group, lock_directory):
+    """
+    Map the partitions of device, and rename the volume group on them.
+    """
+    with locked(lock_directory):
+        exitcode, out, err = kpartx("-v", "-a", "-p", "p", device,
+                                    capture=True, remove_empty=True)
+
+        try:
+            udevadm("settle")
+
+            partitions = ["/dev/mapper/{0}".format(line.split()[2])
+                          for line in out]
+
+            physical = [partition for partition in partitions
+                        if is_physical_volume(partition)]
+
+            if not physical:
+                raise Exception("No physical volumes on: {0}".format(device))
+
+            vgimportclone("-n", volume_group, *physical)
+            udevadm("settle")
+        except:
+            kpartx("-d", "-p", "p", device)
+            raise
+
+    try:
+        yield partitions
+    finally:
+        kpartx("-d", "-p", "p", device)
+
+
+@contextlib.contextmanager
+def attached_snapshot(path, cow_path, name, volume_group, directory):
+    """
+    Attach an image read-only with a snapshot on top, and yield its devices
+    like mounted_loopback.
+    """
+    with attached_loop(path, read_only=True) as origin:
+        with attached_loop(cow_path) as cow:
+            with snapshot_device("vdisk-" + name, origin, cow) as device:
+                with cloned_partitions(device, volume_group,
+                                       directory) as partitions:
+                    yield {device: partitions}
+
+
+@contextlib.contextmanager
+def entered_session(path, volume_group, name, session, **kw):
+    """
+    Enter an image in a read-only session, like entered_system.
+
+    The system is mounted below the session directory, which is removed at
+    the end of the session together with everything written to it.
+    """
+    directory = os.path.dirname(session)
+    mountpoint = session_mountpoint(session)
+    session_group = "{0}_{1}".format(volume_group, name)
+    cow_path = os.path.join(session, "cow")
+
+    os.makedirs(mountpoint)
+
+    try:
+        # as large as the image, so the snapshot never runs out of space.
+        with open(cow_path, "wb") as f:
+            f.truncate(os.path.getsize(path))
+
+        log.info("Entering read-only session {0} of {1}".format(name, path))
+
+        with teardown_events(path) as in_use:
+            with attached_snapshot(path, cow_path, name, session_group,
+                                   directory) as devices:
+                with available_lvm(session_group) as lv:
+                    with mounted_system(devices, lv, mountpoint, **kw):
+                        with in_use():
+                            yield devices, lv, mountpoint
+    finally:
+        shutil.rmtree(session, ignore_errors=True)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Sampling of host resources used by a build.
+
+Disk activity is read from /proc/diskstats for the loop devices backed by the
+image. The device holding the image file is sampled as a separate series, it
+carries the same I/O once more, along with that of everything else on the host,
+which shows contention with the rest of the host. CPU time and memory are read
+for the whole process tree of vdisk, including everything running in chroots.
+"""
+
+import os
+import glob
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+from vdisk.stages import notify
+
+SECTOR_SIZE = 512
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+MEMORY_FIELDS = ["MemAvailable", "Cached", "Dirty", "Writeback"]
+
+
+def image_devices(path):
+    """
+    Names of the loop devices backed by an image.
+    """
+    path = os.path.realpath(path)
+    devices = []
+
+    for backing in glob.glob("/sys/block/loop*/loop/backing_file"):
+        try:
+            with open(backing) as f:
+                if f.read().strip() == path:
+                    devices.append(backing.split("/")[3])
+        except IOError:
+            continue
+
+    return devices
+
+
+def backing_device(path):
+    """
+    Name of the block device holding the image file, or None if it is not on
+    a block device.
+    """
+    try:
+        st = os.stat(os.path.realpath(path))
+    except OSError:
+        return None
+
+    sysfs = "/sys/dev/block/{0}:{1}".format(os.major(st.st_dev),
+                                            os.minor(st.st_dev))
+
+    if not os.path.exists(sysfs):
+        return None
+
+    return os.path.basename(os.path.realpath(sysfs))
+
+
+def disk_counters(devices):
+    """
+    Read (read ops, read bytes, write ops, written bytes) of devices.
+    """
+    counters = dict()
+
+    with open("/proc/diskstats") as f:
+        for line in f:
+            fields = line.split()
+
+            if fields[2] not in devices:
+                continue
+
+            counters[fields[2]] = (
+                int(fields[3]), int(fields[5]) * SECTOR_SIZE,
+                int(fields[7]), int(fields[9]) * SECTOR_SIZE)
+
+    return counters
+
+
+def _read_stat(pid):
+    with open("/proc/{0}/stat".format(pid)) as f:
+        data = f.read()
+
+    # the command name may contain spaces, fields continue after it.
+    return data[data.rindex(")") + 2:].split()
+
+
+def process_tree_usage(root):
+    """
+    Sum the cpu ticks and resident memory of a process and all of its
+    descendants.
+
+    Ticks of exited children are included through the times of their
+    parents, which accumulate them when they are reaped.
+    """
+    parents = dict()
+    stats = dict()
+
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+
+        try:
+            fields = _read_stat(entry)
+        except (IOError, ValueError):
+            continue
+
+        pid = int(entry)
+        parents[pid] = int(fields[1])
+        stats[pid] = fields
+
+    ticks = 0
+    rss = 0
+
+    for pid, fields in stats.items():
+        current = pid
+
+        while current not in (root, 0, 1) and current in parents:
+            current = parents[current]
+
+        if current != root:
+            continue
+
+        ticks += sum(int(value) for value in fields[11:15])
+        rss += int(fields[21]) * PAGE_SIZE
+
+    return ticks, rss
+
+
+def memory_state():
+    state = dict()
+
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+
+            if name in MEMORY_FIELDS:
+                state[name] = int(value.split()[0]) * 1024
+
+    return state
+
+
+class StageUsage(object):
+    def __init__(self):
+        self.started = time.time()
+        self.read_ops = 0
+        self.read_bytes = 0
+        self.write_ops = 0
+        self.write_bytes = 0
+        self.backing = [0, 0, 0, 0]
+        self.ticks = 0
+        self.peak_rss = 0
+        self.peak_dirty = 0
+        self.cached = None
+        self.samples = 0
+
+    def add(self, disk, backing, ticks, rss, memory):
+        self.read_ops += disk[0]
+        self.read_bytes += disk[1]
+        self.write_ops += disk[2]
+        self.write_bytes += disk[3]
+
+        for i in range(4):
+            self.backing[i] += backing[i]
+
+        self.ticks += ticks
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_dirty = max(self.peak_dirty,
+                              memory.get("Dirty", 0) +
+                              memory.get("Writeback", 0))
+
+        if self.cached is None:
+            self.cached = memory.get("Cached", 0)
+
+        self.samples += 1
+
+    def summary(self, memory):
+        duration = max(time.time() - self.started, 0.001)
+
+        return {
+            "duration": duration,
+            "read_bytes": self.read_bytes,
+            "write_bytes": self.write_bytes,
+            "read_iops": self.read_ops / duration,
+            "write_iops": self.write_ops / duration,
+            "backing_read_bytes": self.backing[1],
+            "backing_write_bytes": self.backing[3],
+            "backing_read_iops": self.backing[0] / duration,
+            "backing_write_iops": self.backing[2] / duration,
+            "cpu": 100.0 * self.ticks / CLOCK_TICKS / duration,
+            "peak_rss": self.peak_rss,
+            "peak_dirty": self.peak_dirty,
+            "cache_growth": memory.get("Cached", 0) - (self.cached or 0),
+            "samples": self.samples,
+        }
+
+
+def format_summary(summary):
+    mb = lambda value: "{0:.1f}MB".format(value / float(2 ** 20))
+
+    text = ("{0} read, {1} written, {2:.0f}/{3:.0f} read/write iops, "
+            "{4:.0f}% cpu, {5} peak rss, {6} peak dirty, "
+            "{7} page cache growth").format(
+                mb(summary["read_bytes"]), mb(summary["write_bytes"]),
+                summary["read_iops"], summary["write_iops"], summary["cpu"],
+                mb(summary["peak_rss"]), mb(summary["peak_dirty"]),
+                mb(summary["cache_growth"]))
+
+    # summaries recorded before the backing device was sampled have none.
+    if summary["backing_read_bytes"] is None:
+        return text
+
+    return ("{0}; backing device: {1} read, {2} written, {3:.0f}/{4:.0f} "
+            "read/write iops").format(
+                text, mb(summary["backing_read_bytes"]),
+                mb(summary["backing_write_bytes"]),
+                summary["backing_read_iops"], summary["backing_write_iops"])
+
+
+class ResourceSampler(object):
+    """
+    Stage listener sampling resources in a background thread.
+
+    Every sample is attributed to all stages running at the time, so the
+    summary of a stage includes the stages nested in it.
+    """
+    def __init__(self, image_path, interval=1.0):
+        self.image_path = image_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.active = dict()
+        self.disk = dict()
+        self.ticks = 0
+        self.memory = dict()
+
+    def start(self):
+        with self.lock:
+            self._read()
+
+        self.thread = threading.Thread(target=self._run,
+                                       name="resource-sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception, e:
+                log.warning("Failed to sample resources: {0}".format(e))
+
+    def _read(self):
+        """
+        Read all counters and return the difference from the last read.
+        """
+        devices = image_devices(self.image_path)
+        backing = backing_device(self.image_path)
+        disk = disk_counters(devices + filter(None, [backing]))
+        delta = [0, 0, 0, 0]
+        backing_delta = [0, 0, 0, 0]
+
+        for device, counters in disk.items():
+            # devices attached since the last read are counted from here.
+            previous = self.disk.get(device, counters)
+            target = backing_delta if device == backing else delta
+
+            for i in range(4):
+                target[i] += max(counters[i] - previous[i], 0)
+
+        ticks, rss = process_tree_usage(os.getpid())
+        ticks_delta = max(ticks - self.ticks, 0)
+
+        self.disk = disk
+        self.ticks = ticks
+        self.memory = memory_state()
+
+        return delta, backing_delta, ticks_delta, rss
+
+    def sample(self):
+        with self.lock:
+            disk, backing, ticks, rss = self._read()
+
+            for usage in self.active.values():
+                usage.add(disk, backing, ticks, rss, self.memory)
+
+    def __call__(self, event, data):
+        if event == "stage-started":
+            self.sample()
+
+            with self.lock:
+                self.active[data["stage"]] = StageUsage()
+        elif event == "stage-finished":
+            self.sample()
+
+            with self.lock:
+                usage = self.active.pop(data["stage"], None)
+
+            if usage is None:
+                return
+
+            summary = usage.summary(self.memory)
+            log.info("{0}: {1}".format(data["stage"], format_summary(summary)))
+            notify("stage-resources", stage=data["stage"], **summary)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Estimating the size of an image before it is created, from the Installed-Size
+and Size of every package it will contain.
+"""
+
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+from vdisk.layout import read_layout
+from vdisk.layout import volume_bytes
+from vdisk.native_bootstrap import fetch_index
+from vdisk.native_bootstrap import resolve
+
+MB = 2 ** 20
+
+# Space of the partition table, bios_grub partition, LVM metadata and the
+# backup GPT.
+LAYOUT_OVERHEAD = 8 * MB
+
+# Space left for every volume sized in extents, like swap on the rest of the
+# volume group.
+EXTENTS_SIZE = 512 * MB
+
+# Part of an ext4 filesystem taken by its inode tables, journal and reserved
+# blocks.
+EXT4_OVERHEAD = 0.1
+
+# Sizes are rounded up to this, which is also a multiple of the LVM extent
+# size.
+ALIGNMENT = 64 * MB
+
+
+def round_up(value, unit=ALIGNMENT):
+    return (value + unit - 1) // unit * unit
+
+
+def read_selections(path):
+    """
+    Read the names of the packages selected for install in a selections
+    file, as written by 'dpkg --get-selections'.
+    """
+    names = []
+
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+
+            if len(parts) == 2 and parts[1] == "install":
+                names.append(parts[0].split(":")[0])
+
+    return names
+
+
+def fetch_indexes(ns):
+    """
+    Fetch the index of the bootstrap mirror and of all configured sources,
+    earlier ones taking precedence.
+    """
+    packages = fetch_index(ns.mirror, ns.suite, ["main"], ns.arch)
+
+    for name, source in sorted((ns.config.get("sources") or {}).items()):
+        try:
+            index = fetch_index(source["url"], source["suite"],
+                                source.get("components", ["main"]), ns.arch)
+        except Exception, e:
+            log.warning("Ignoring source {0}: {1}".format(name, e))
+            continue
+
+        for package, stanza in index.items():
+            packages.setdefault(package, stanza)
+
+    return packages
+
+
+def requested_packages(ns):
+    names = []
+
+    for key in ("pre-packages", "packages"):
+        for suite, packages in (ns.config.get(key) or {}).items():
+            names.extend(packages)
+
+    selections = ns.selections or os.path.join(ns.root, "selections",
+                                               "default")
+
+    if os.path.isfile(selections):
+        names.extend(read_selections(selections))
+
+    return names
+
+
+def manifest_size(ns):
+    total = 0
+
+    for item in ns.config.get("manifest") or []:
+        source = item.get("source")
+
+        if source:
+            total += os.path.getsize(os.path.join(ns.root, source))
+
+    return total
+
+
+def layout_size(ns, root_size):
+    """
+    The size of all volumes of the layout, with root_size for a root volume
+    without a size of its own.
+    """
+    from vdisk import sizeunit
+
+    fstab, volumes = read_layout(
+        ns.config, sizeunit("{0}M".format(root_size // MB)))
+
+    total = 0
+
+    for volume in volumes:
+        size = volume_bytes(volume)
+
+        if size is None:
+            size = EXTENTS_SIZE
+        elif volume["name"] == "root" and size < root_size:
+            log.warning("Declared root size {0}MB is below the estimated "
+                        "{1}MB".format(size // MB, root_size // MB))
+
+        total += size
+
+    return total
+
+
+def estimate(ns):
+    """
+    Estimate the sizes of the root volume and of the whole image.
+
+    Returns a tuple of (root_size, image_size) in bytes.
+    """
+    packages = fetch_indexes(ns)
+    requested = requested_packages(ns)
+    missing = sorted(set(name for name in requested if name not in packages))
+
+    for name in missing:
+        log.warning("Not in any index, size unknown: {0}".format(name))
+
+    selected = resolve(packages, include=[name for name in requested
+                                          if name in packages])
+
+    # downloaded packages are kept in the apt archives.
+    installed = sum(int(packages[name].get("Installed-Size", 0)) * 1024
+                    for name in selected)
+    downloaded = sum(int(packages[name].get("Size", 0)) for name in selected)
+    files = manifest_size(ns)
+
+    content = installed + downloaded + files
+
+    log.info("{0} packages, {1}MB installed, {2}MB downloaded, {3}MB of "
+             "files".format(len(selected), installed // MB,
+                            downloaded // MB, files // MB))
+
+    root_size = round_up(int(content * (1 + ns.headroom / 100.0) /
+                             (1 - EXT4_OVERHEAD)))
+    image_size = LAYOUT_OVERHEAD + layout_size(ns, root_size)
+
+    return root_size, image_size
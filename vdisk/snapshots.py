@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Snapshots of the root volume of images with a thin layout.
+
+In a thin layout root is a thin volume in the pool 'pool', and snapshots of it
+only take up the space of what changed since they were taken. Such images are
+meant for building, they are flattened into the regular layout before they are
+shipped.
+"""
+
+import os
+import re
+import sys
+import time
+import logging
+import contextlib
+
+log = logging.getLogger(__name__)
+
+from vdisk.helpers import available_lvm
+from vdisk.helpers import mounted_loopback
+from vdisk.imageinfo import read_lvm_metadata
+from vdisk.imageinfo import read_partitions
+
+from vdisk.externalcommand import ExternalCommand
+
+lvm = ExternalCommand("lvm")
+e2image = ExternalCommand("e2image")
+mkswap = ExternalCommand("mkswap")
+
+POOL = "pool"
+
+# Tag of the snapshots taken before actions.
+AUTOMATIC_TAG = "vdisk_automatic"
+
+# Number of automatic snapshots kept, older ones are dropped.
+KEEP_AUTOMATIC = 5
+
+RESERVED_NAMES = set(["boot", "root", "swap", POOL])
+
+_NAME = re.compile(r"^[a-zA-Z0-9+_.-]+$")
+
+
+def has_thin_root(path):
+    """
+    Check whether the root volume of an image is a thin volume, by reading the
+    LVM metadata of the image without attaching it.
+    """
+    if not os.path.isfile(path):
+        return False
+
+    with open(path, "rb") as f:
+        table, partitions = read_partitions(f)
+
+        for partition in partitions:
+            metadata = read_lvm_metadata(f, partition["start"])
+
+            if metadata is None:
+                continue
+
+            for vg in metadata.values():
+                if not isinstance(vg, dict):
+                    continue
+
+                root = vg.get("logical_volumes", {}).get("root", {})
+
+                for key, segment in root.items():
+                    if key.startswith("segment") and \
+                            isinstance(segment, dict) and \
+                            segment.get("type") == "thin":
+                        return True
+
+    return False
+
+
+def _lvs(volume_group, *fields):
+    exitcode, out, err = lvm("lvs", "--noheadings", "--nosuffix",
+                             "--units", "b", "--separator", "|",
+                             "-o", ",".join(fields), volume_group,
+                             capture=True, remove_empty=True)
+
+    return [dict(zip(fields, [value.strip() for value in line.split("|")]))
+            for line in out]
+
+
+def list_snapshots(volume_group):
+    """
+    List the snapshots in the pool of a volume group, oldest first.
+    """
+    snapshots = []
+
+    for lv in _lvs(volume_group, "lv_name", "pool_lv", "lv_time",
+                   "data_percent", "lv_tags"):
+        if lv["pool_lv"] != POOL or lv["lv_name"] == "root":
+            continue
+
+        snapshots.append({
+            "name": lv["lv_name"],
+            "time": lv["lv_time"],
+            "data_percent": lv["data_percent"],
+            "automatic": AUTOMATIC_TAG in lv["lv_tags"].split(","),
+        })
+
+    return sorted(snapshots, key=lambda s: s["time"])
+
+
+def _check_name(name):
+    if not _NAME.match(name) or name in RESERVED_NAMES:
+        raise Exception("Invalid snapshot name: {0}".format(name))
+
+
+def _check_exists(volume_group, name):
+    if name not in [s["name"] for s in list_snapshots(volume_group)]:
+        raise Exception("No such snapshot: {0}".format(name))
+
+
+def create_snapshot(volume_group, name, automatic=False):
+    _check_name(name)
+
+    args = ["lvcreate", "-s", "-n", name]
+
+    if automatic:
+        args.extend(["--addtag", AUTOMATIC_TAG])
+
+    log.info("Taking snapshot of root: {0}".format(name))
+    lvm(*(args + ["{0}/root".format(volume_group)]))
+
+
+def restore_snapshot(volume_group, name):
+    """
+    Replace root with a snapshot of the given snapshot, keeping the snapshot
+    so that it can be restored again.
+    """
+    _check_exists(volume_group, name)
+
+    log.info("Restoring root from snapshot: {0}".format(name))
+    lvm("lvremove", "-f", "{0}/root".format(volume_group))
+    lvm("lvcreate", "-s", "-k", "n", "-n", "root",
+        "{0}/{1}".format(volume_group, name))
+
+
+def drop_snapshot(volume_group, name):
+    _check_exists(volume_group, name)
+
+    log.info("Dropping snapshot: {0}".format(name))
+    lvm("lvremove", "-f", "{0}/{1}".format(volume_group, name))
+
+
+def prune_automatic(volume_group, keep=KEEP_AUTOMATIC):
+    automatic = [s for s in list_snapshots(volume_group) if s["automatic"]]
+
+    for snapshot in automatic[:-keep]:
+        drop_snapshot(volume_group, snapshot["name"])
+
+
+def flatten(image_path, volume_group):
+    """
+    Convert a thin layout into the regular layout, dropping all snapshots.
+
+    Root is copied out to a sparse file next to the image while the pool is
+    replaced by a regular root volume and swap on the space left.
+    """
+    staging = "{0}.root".format(image_path)
+
+    with mounted_loopback(image_path):
+        with available_lvm(volume_group) as lv:
+            for snapshot in list_snapshots(volume_group):
+                drop_snapshot(volume_group, snapshot["name"])
+
+            size = [v["lv_size"] for v in _lvs(volume_group, "lv_name",
+                                                 "lv_size")
+                    if v["lv_name"] == "root"][0]
+
+            log.info("Copying root to {0}".format(staging))
+
+            try:
+                e2image("-ra", "-p", lv["root"], staging)
+            except:
+                # root is untouched, the partial copy is of no use.
+                if os.path.exists(staging):
+                    os.unlink(staging)
+                raise
+
+            try:
+                lvm("lvremove", "-f", "{0}/root".format(volume_group))
+                lvm("lvremove", "-f", "{0}/{1}".format(volume_group, POOL))
+                lvm("lvcreate", "-L", "{0}b".format(size), "-n", "root",
+                    volume_group)
+
+                log.info("Copying root back from {0}".format(staging))
+                e2image("-ra", "-p", staging, lv["root"])
+            except:
+                # the staging file is the only copy of root left.
+                log.error("Flattening failed, root is kept in: {0}".format(
+                    staging))
+                raise
+
+            os.unlink(staging)
+
+            lvm("lvcreate", "-l", "100%FREE", "-n", "swap", volume_group)
+            mkswap("-f", "/dev/mapper/{0}-swap".format(volume_group))
+
+
+@contextlib.contextmanager
+def rollback_on_failure(ns):
+    """
+    Take a snapshot of root of an image with a thin layout, and restore it if
+    the enclosed action fails.
+    """
+    if ns.no_rollback or not has_thin_root(ns.image_path):
+        yield
+        return
+
+    name = "{0}-{1}".format(ns.action_name, time.strftime("%Y%m%d-%H%M%S"))
+
+    with mounted_loopback(ns.image_path):
+        with available_lvm(ns.volume_group):
+            create_snapshot(ns.volume_group, name, automatic=True)
+            prune_automatic(ns.volume_group)
+
+    try:
+        yield
+    except:
+        exc_info = sys.exc_info()
+        log.error("{0} failed, rolling back to snapshot {1}".format(
+            ns.action_name, name))
+
+        try:
+            with mounted_loopback(ns.image_path):
+                with available_lvm(ns.volume_group):
+                    restore_snapshot(ns.volume_group, name)
+        except Exception, e:
+            log.error("Unable to roll back: {0}".format(e))
+
+        raise exc_info[0], exc_info[1], exc_info[2]
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Build stages and the events emitted while running them.
+
+Stages nest, the name of a stage is the path of all enclosing stages, like
+'install/selections'. Listeners are called with the name of an event and a
+dict of its data, and are never allowed to fail a build.
+"""
+
+import time
+import logging
+import threading
+import contextlib
+
+log = logging.getLogger(__name__)
+
+_listeners = []
+_local = threading.local()
+
+
+def _context():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+        _local.listeners = []
+
+    return _local
+
+
+def add_listener(listener, local=False):
+    """
+    Add a listener of the events of all threads, or if local is set, only
+    of the current thread and threads started through inherit().
+    """
+    if local:
+        _context().listeners.append(listener)
+    else:
+        _listeners.append(listener)
+
+
+def remove_listener(listener, local=False):
+    listeners = _context().listeners if local else _listeners
+
+    if listener in listeners:
+        listeners.remove(listener)
+
+
+def notify(event, **data):
+    for listener in _listeners + list(_context().listeners):
+        try:
+            listener(event, data)
+        except Exception, e:
+            log.warning("Event listener failed: {0}".format(e))
+
+
+def inherit(function):
+    """
+    Wrap function to run in the current stage of the calling thread, and with
+    its local listeners, when called from another thread.
+    """
+    context = _context()
+    stack = list(context.stack)
+    listeners = context.listeners
+
+    def wrapper(*args, **kw):
+        _local.stack = list(stack)
+        _local.listeners = listeners
+        return function(*args, **kw)
+
+    return wrapper
+
+
+def current_stage():
+    stack = _context().stack
+
+    if not stack:
+        return None
+
+    return "/".join(stack)
+
+
+@contextlib.contextmanager
+def stage(name):
+    stack = _context().stack
+    stack.append(name)
+    path = "/".join(stack)
+
+    notify("stage-started", stage=path)
+    started = time.time()
+
+    try:
+        yield
+    except:
+        notify("stage-finished", stage=path, success=False,
+               duration=time.time() - started)
+        raise
+    else:
+        notify("stage-finished", stage=path, success=True,
+               duration=time.time() - started)
+    finally:
+        stack.pop()
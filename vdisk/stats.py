@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013 Spotify AB
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+A local database of build, stage and command durations.
+"""
+
+import os
+import time
+import errno
+import socket
+import sqlite3
+import hashlib
+import logging
+import platform
+import threading
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+STATS_DB = "stats.db"
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS builds (
+        id INTEGER PRIMARY KEY,
+        action TEXT,
+        image TEXT,
+        started REAL,
+        finished REAL,
+        success INTEGER,
+        pid INTEGER,
+        hostname TEXT,
+        kernel TEXT,
+        cpus INTEGER,
+        memory INTEGER,
+        config_digest TEXT,
+        selections_digest TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS stages (
+        id INTEGER PRIMARY KEY,
+        build INTEGER,
+        name TEXT,
+        started REAL,
+        duration REAL,
+        success INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS commands (
+        id INTEGER PRIMARY KEY,
+        build INTEGER,
+        stage TEXT,
+        command TEXT,
+        arguments TEXT,
+        started REAL,
+        duration REAL,
+        exitcode INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS resources (
+        id INTEGER PRIMARY KEY,
+        build INTEGER,
+        stage TEXT,
+        read_bytes INTEGER,
+        write_bytes INTEGER,
+        read_iops REAL,
+        write_iops REAL,
+        backing_read_bytes INTEGER,
+        backing_write_bytes INTEGER,
+        backing_read_iops REAL,
+        backing_write_iops REAL,
+        cpu REAL,
+        peak_rss INTEGER,
+        peak_dirty INTEGER,
+        cache_growth INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS stages_name ON stages (name, build)",
+    "CREATE INDEX IF NOT EXISTS resources_build ON resources (build)",
+    "CREATE INDEX IF NOT EXISTS commands_build ON commands (build)",
+]
+
+# Columns added to databases created by earlier versions.
+ADDED_COLUMNS = [
+    ("resources", "backing_read_bytes", "INTEGER"),
+    ("resources", "backing_write_bytes", "INTEGER"),
+    ("resources", "backing_read_iops", "REAL"),
+    ("resources", "backing_write_iops", "REAL"),
+]
+
+# Number of earlier runs a stage is compared against.
+DEFAULT_WINDOW = 5
+
+
+def stats_path(ns):
+    return os.path.join(ns.cache_dir, STATS_DB)
+
+
+def connect(path):
+    directory = os.path.dirname(path)
+
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+
+    for statement in SCHEMA:
+        db.execute(statement)
+
+    for table, column, column_type in ADDED_COLUMNS:
+        columns = [row["name"] for row in
+                   db.execute("PRAGMA table_info({0})".format(table))]
+
+        if column not in columns:
+            db.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                table, column, column_type))
+
+    db.commit()
+    return db
+
+
+def file_digest(path):
+    if path is None or not os.path.isfile(path):
+        return None
+
+    h = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(2 ** 16), ""):
+            h.update(data)
+
+    return h.hexdigest()
+
+
+def memory_total():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    return None
+
+
+def host_info():
+    return {
+        "hostname": socket.gethostname(),
+        "kernel": platform.release(),
+        "cpus": multiprocessing.cpu_count(),
+        "memory": memory_total(),
+    }
+
+
+def median(values):
+    values = sorted(values)
+
+    if not values:
+        return None
+
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def is_running(build):
+    """
+    Check if a build without a finish time is still in progress.
+    """
+    if build["finished"] is not None:
+        return False
+
+    if build["hostname"] != socket.gethostname():
+        return True
+
+    try:
+        os.kill(build["pid"], 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+
+    return True
+
+
+def recent_builds(db, image=None, limit=10):
+    query = "SELECT * FROM builds"
+    params = []
+
+    if image is not None:
+        query += " WHERE image = ?"
+        params.append(image)
+
+    query += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+
+    return db.execute(query, params).fetchall()
+
+
+def build_stages(db, build):
+    return db.execute(
+        "SELECT * FROM stages WHERE build = ? ORDER BY started, id",
+        (build,)).fetchall()
+
+
+def build_commands(db, build):
+    return db.execute(
+        "SELECT command, COUNT(*) AS count, SUM(duration) AS duration "
+        "FROM commands WHERE build = ? GROUP BY command "
+        "ORDER BY duration DESC", (build,)).fetchall()
+
+
+def build_resources(db, build):
+    return dict((row["stage"], row) for row in db.execute(
+        "SELECT * FROM resources WHERE build = ?", (build,)))
+
+
+def _history(db, name, build, window, same_inputs):
+    query = ("SELECT stages.duration FROM stages "
+             "JOIN builds ON builds.id = stages.build "
+             "WHERE stages.name = ? AND stages.success = 1 "
+             "AND builds.hostname = ? AND stages.build < ?")
+    params = [name, build["hostname"], build["id"]]
+
+    if same_inputs:
+        query += (" AND builds.config_digest IS ?"
+                  " AND builds.selections_digest IS ?")
+        params.extend([build["config_digest"], build["selections_digest"]])
+
+    query += " ORDER BY stages.build DESC LIMIT ?"
+    params.append(window)
+
+    return [row[0] for row in db.execute(query, params)]
+
+
+def stage_history(db, name, build, window=DEFAULT_WINDOW):
+    """
+    Durations of the latest successful runs of a stage in builds before
+    build on the same host.
+
+    Only builds of the same config and selections are compared, builds of
+    other inputs only when there are none of those.
+    """
+    return _history(db, name, build, window, True) or \
+        _history(db, name, build, window, False)
+
+
+def baseline(db, name, build, window=DEFAULT_WINDOW):
+    """
+    The rolling baseline of a stage, the median of its latest runs.
+    """
+    return median(stage_history(db, name, build, window))
+
+
+class StatsRecorder(object):
+    """
+    Event listener writing the stages and commands of a single build to the
+    database as they happen, which allows other processes to follow builds in
+    progress.
+    """
+    def __init__(self, path, ns):
+        self.db = connect(path)
+        self.lock = threading.Lock()
+        self.host = host_info()
+        self.running = dict()
+
+        selections = getattr(ns, "selections", None)
+
+        if hasattr(ns, "selections") and selections is None:
+            selections = os.path.join(ns.root, "selections", "default")
+
+        cursor = self.db.execute(
+            "INSERT INTO builds (action, image, started, pid, hostname, "
+            "kernel, cpus, memory, config_digest, selections_digest) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                ns.action_name, os.path.abspath(ns.image_path), time.time(),
+                os.getpid(), self.host["hostname"], self.host["kernel"],
+                self.host["cpus"], self.host["memory"],
+                getattr(ns, "config_digest", None),
+                file_digest(selections)))
+
+        self.build = cursor.lastrowid
+        self.db.commit()
+
+        self.row = self.db.execute("SELECT * FROM builds WHERE id = ?",
+                                   (self.build,)).fetchone()
+
+    def __call__(self, event, data):
+        with self.lock:
+            if event == "stage-started":
+                self.stage_started(data["stage"])
+            elif event == "stage-finished":
+                self.stage_finished(data["stage"], data["duration"],
+                                    data["success"])
+            elif event == "command-finished":
+                self.command_finished(data["stage"], data["args"],
+                                      data["duration"], data["exitcode"])
+            elif event == "stage-resources":
+                self.stage_resources(data)
+            else:
+                return
+
+            self.db.commit()
+
+    def stage_started(self, name):
+        cursor = self.db.execute(
+            "INSERT INTO stages (build, name, started) VALUES (?, ?, ?)",
+            (self.build, name, time.time()))
+        self.running[name] = cursor.lastrowid
+
+        expected = baseline(self.db, name, self.row)
+
+        if expected is not None:
+            log.info("{0}: usually takes {1:.0f}s".format(name, expected))
+
+    def stage_finished(self, name, duration, success):
+        self.db.execute(
+            "UPDATE stages SET duration = ?, success = ? WHERE id = ?",
+            (duration, int(success), self.running.pop(name)))
+
+    def command_finished(self, stage, args, duration, exitcode):
+        self.db.execute(
+            "INSERT INTO commands (build, stage, command, arguments, started, "
+            "duration, exitcode) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                self.build, stage, os.path.basename(args[0]),
+                " ".join(args[1:]), time.time() - duration, duration,
+                exitcode))
+
+    def stage_resources(self, data):
+        self.db.execute(
+            "INSERT INTO resources (build, stage, read_bytes, write_bytes, "
+            "read_iops, write_iops, backing_read_bytes, backing_write_bytes, "
+            "backing_read_iops, backing_write_iops, cpu, peak_rss, "
+            "peak_dirty, cache_growth) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                self.build, data["stage"], data["read_bytes"],
+                data["write_bytes"], data["read_iops"], data["write_iops"],
+                data["backing_read_bytes"], data["backing_write_bytes"],
+                data["backing_read_iops"], data["backing_write_iops"],
+                data["cpu"], data["peak_rss"], data["peak_dirty"],
+                data["cache_growth"]))
+
+    def finish(self, success):
+        with self.lock:
+            self.db.execute(
+                "UPDATE builds SET finished = ?, success = ? WHERE id = ?",
+                (time.time(), int(success), self.build))
+            self.db.commit()
+            self.db.close()